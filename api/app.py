@@ -4,56 +4,84 @@ Postgres database connected with SQLAlchemy
 
 Flask endpoints:
 
-+---------------+------------+----------------------+---------------------+
-| PATH          | METHOD     | FUNCTION             | DEPENDENCIES        |
-+---------------+------------+----------------------+---------------------+
-| /config/*     | GET        | load_config          | storage             |
-| /session      | PUT        | create_session       |                     |
-| /session      | POST       | authenticate_session |                     |
-| /session      | DELETE     | delete_session       |                     |
-| /auth         | GET        | verify_session       |                     |
-| /graphql      | ---        | GraphQLView          | Postgres            |
-| /account      | PUT        | create_account       | Postgres, SendGrid  |
-| /account      | POST       | update_account       | Postgres, SendGrid  |
-| /account      | DELETE     | delete_account       | Postgres, SendGrid  |
-| /photo        | PUT        | create_photo         | Postgres, storage   |
-| /photo        | POST       | update_photo         | Postgres, storage   |
-| /photo        | DELETE     | delete_photo         | Postgres, storage   |
-| /edit         | PUT        | create_edit          | Postgres, storage   |
-| /edit         | POST       | update_edit          | Postgres, storage   |
-| /edit         | DELETE     | delete_edit          | Postgres, storage   |
-| /reply        | PUT        | create_reply         | Postgres            |
-| /reply        | POST       | update_reply         | Postgres            |
-| /reply        | DELETE     | delete_reply         | Postgres            |
-| /reaction     | PUT        | create_reaction      | Postgres            |
-| /reaction     | DELETE     | delete_reaction      | Postgres            |
-+---------------+------------+----------------------+---------------------+
++--------------------+--------+------------------------+--------------------+
+| PATH               | METHOD | FUNCTION               | DEPENDENCIES       |
++--------------------+--------+------------------------+--------------------+
+| /config/*          | GET    | load_config            | storage            |
+| /session           | PUT    | create_session         |                    |
+| /session           | POST   | authenticate_session   |                    |
+| /session           | DELETE | delete_session         |                    |
+| /session/stats     | GET    | session_stats          | Postgres           |
+| /cache/stats       | GET    | response_cache.stats   | Postgres           |
+| /auth              | GET    | verify_session         |                    |
+| /graphql           | ---    | GraphQLView            | Postgres           |
+| /account           | PUT    | create_account         | Postgres, SendGrid |
+| /account           | POST   | update_account         | Postgres, SendGrid |
+| /account           | DELETE | delete_account         | Postgres, SendGrid |
+| /notifications     | GET    | select_notifications   | Postgres           |
+| /photo             | PUT    | create_photo           | Postgres, storage  |
+| /photo             | POST   | update_photo           | Postgres, storage  |
+| /photo             | DELETE | delete_photo           | Postgres, storage  |
+| /photo/*/tags      | PUT    | attach_photo_tags      | Postgres           |
+| /photo/*/reactions | PUT    | attach_photo_reactions | Postgres           |
+| /edit              | PUT    | create_edit            | Postgres, storage  |
+| /edit              | POST   | update_edit            | Postgres, storage  |
+| /edit              | DELETE | delete_edit            | Postgres, storage  |
+| /edit/*/tags       | PUT    | attach_edit_tags       | Postgres           |
+| /tags              | PUT    | create_tags            | Postgres           |
+| /reply             | PUT    | create_reply           | Postgres           |
+| /reply             | POST   | update_reply           | Postgres           |
+| /reply             | DELETE | delete_reply           | Postgres           |
+| /reaction          | PUT    | create_reaction        | Postgres           |
+| /reaction          | DELETE | delete_reaction        | Postgres           |
+| /reactions         | PUT    | create_reactions       | Postgres           |
+| /equipment         | PUT    | create_cameras, ...    | Postgres           |
++--------------------+--------+------------------------+--------------------+
 
 Every endpoint performs authentication by comparing for a hash from the API
 call's cookie to that of a session in Redis, avoiding the database entirely.
 
 Account creation sends a verification email to supplied email address.
-Login sends a magic link to the supplied email address.
+Login sends a magic link to the supplied email address. Emails are queued in
+a local outbox and sent by a background thread, see outbox.py.
 
-Expensive queries' results can be cached in Redis.
+The global feed is built from new events by a background thread in each
+worker, see feed.py. Notifications for the creator's followers are written
+by another, see fanout.py.
+
+GraphQL responses are cached in each worker and optionally in Redis, and
+purged when the rows they read are written, see response_cache.py.
 """
 
 import os
 import sys
-import io
+from datetime import datetime
 from flask import Flask, jsonify, request
-from flask_graphql import GraphQLView
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from urllib.parse import unquote
-from PIL import Image
 
-from utils import load_config, hash_file, read_extension
+from utils import load_config, supported_extensions, read_extension, del_prop, remove_file
+from ingest import IngestRequest
+from imaging import get_image_pool
+from rawpreview import extract_embedded_jpeg
+from exif import read_metadata
 from model import Base
 from schema import schema
+from graphql_view import FocalGraphQLView, single_flight
+from persisted_queries import persisted_queries
+from response_cache import response_cache
 from db import (
     engine,
+    db_session,
+    reset_query_stats,
+    get_query_stats,
+    catalog,
+    UnitOfWork,
     select_account,
+    select_photo,
+    select_edit,
+    select_notifications,
     create_account,
     update_account,
     delete_account,
@@ -67,42 +95,74 @@ from db import (
     update_reply,
     delete_reply,
     create_reaction,
+    create_reactions,
+    attach_photo_reactions,
     delete_reaction,
     create_file,
-    delete_file,
+    update_file,
+    create_file_renditions,
     create_tag,
+    create_tags,
+    attach_photo_tags,
+    attach_edit_tags,
     delete_tag,
     create_editor,
     update_editor,
     delete_editor,
-    create_camera,
+    create_cameras,
     update_camera,
-    delete_camera,
-    create_lens,
+    create_lenses,
     update_lens,
-    delete_lens,
-    create_manufacturer,
+    create_manufacturers,
     update_manufacturer,
-    delete_manufacturer,
 )
-from session import create_session, authenticate_session, delete_session, verify_session, get_session
+from outbox import get_outbox
+from feed import feed_builder
+from fanout import fanout_worker
+from session import (create_session, authenticate_session, delete_session, verify_session,
+                     get_session, session_stats)
 
-db_session = scoped_session(
-    sessionmaker(
-        autocommit=False,
-        autoflush=False,
-        bind=engine
-    )
-)
 Base.metadata.create_all(engine)
 Base.query = db_session.query_property()
 
+# Start sending any emails queued before this worker started
+get_outbox()
+
+# Start this worker's feed builder thread
+feed_builder.start()
+
+# Start this worker's notification fan-out thread
+fanout_worker.start()
+
+# Load the equipment catalog before the first upload needs it
+catalog.warm()
+
+# Load the web app's persisted GraphQL queries
+if load_config('persisted_queries').get('manifest'):
+    persisted_queries.load_manifest(load_config('persisted_queries')['manifest'])
+
 # Create Flask app and add API routes
 app = Flask(__name__)
+app.request_class = IngestRequest
+
+@app.before_request
+def start_query_stats():
+    reset_query_stats()
+
+@app.after_request
+def add_query_stats(response):
+    """Report the request's connection checkouts and queries in a Server-Timing header"""
+    stats = get_query_stats()
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={stats["duration"] * 1000:.1f};'
+        f'desc="{stats["queries"]} queries, {stats["checkouts"]} checkouts"'
+    )
+    return response
 
 app.add_url_rule(
     '/graphql',
-    view_func=GraphQLView.as_view(
+    view_func=FocalGraphQLView.as_view(
         'graphql',
         schema=schema,
         graphiql=True
@@ -153,6 +213,30 @@ def handle_auth(token):
 def handle_get_session(session):
     return jsonify({ 'session': session }), 200
 
+@app.route('/session/stats', methods=['GET'])
+@with_session
+def handle_session_stats(session):
+    """Flask route for reporting live, expired and evicted session counts to admins"""
+    account = select_account(account_email=session['account_email'])
+    if account is None or account.account_role != 'admin':
+        return 'Forbidden', 403
+    return jsonify(session_stats()), 200
+
+@app.route('/cache/stats', methods=['GET'])
+@with_session
+def handle_cache_stats(session):
+    """
+    Flask route for reporting this worker's GraphQL response cache and request
+    coalescing counters to admins
+    """
+    account = select_account(account_email=session['account_email'])
+    if account is None or account.account_role != 'admin':
+        return 'Forbidden', 403
+    return jsonify({
+        'responses': response_cache.stats(),
+        'single_flight': single_flight.stats(),
+    }), 200
+
 @app.route('/session', methods=['PUT'])
 def handle_create_session():
     """Flask route for creating sessions"""
@@ -193,6 +277,33 @@ def handle_get_account(session):
     account = select_account(account_email=session['account_email'])
     return jsonify({ 'account': map_account_details(account) }), 200
 
+def map_notification(notification):
+    return {
+        'notification_id': notification.notification_id,
+        'event_id': notification.event_id,
+        'event_type': notification.event.event_type,
+        'account_id': notification.event.account_id,
+        'created_at': notification.created_at,
+        'viewed_at': notification.viewed_at,
+    }
+
+@app.route('/notifications', methods=['GET'])
+@with_session
+def handle_get_notifications(session):
+    """Flask route for listing a session's newest notifications, before a date if given"""
+    account = select_account(account_email=session['account_email'])
+    if account is None:
+        return 'Account not found', 404
+    try:
+        before = datetime.fromisoformat(request.args.get('before', datetime.max.isoformat()))
+        limit = max(0, min(int(request.args.get('limit', 10)),
+                           load_config('graphql_limits')['max_page_size']))
+    except ValueError as err:
+        return str(err), 400
+    notifications = select_notifications(account.account_id, before=before, limit=limit)
+    return jsonify({ 'notifications': [map_notification(notification)
+                                       for notification in notifications] }), 200
+
 @app.route('/account', methods=['POST'])
 @with_session
 def handle_account(session):
@@ -239,130 +350,53 @@ def handle_delete_account(account_handle):
     delete_account(account.account_id)
     return '', 204
 
-@app.route('/photo', methods=['PUT'])
-@with_session
-def handle_create_photo(session):
-    """Flask route for creating a photo"""
-    if request.form is None:
-        return 'Bad request', 400
-
-    account = select_account(account_email=session['account_email'])
-    if account is None:
-        return 'Account not found', 404
-
-    photo_options = {}
-    for key in request.form:
-        v = request.form[key]
-        if v != 'null':
-            photo_options[key] = v
-    photo_options['account_id'] = account.account_id
-
-    created_camera_id = None
-    created_camera_manufacturer_id = None
-    created_lens_id = None
-    created_lens_manufacturer_id = None
-
-    if ('photo_title' not in photo_options or len(photo_options['photo_title']) == 0) \
-       and ('photo_text' not in photo_options or len(photo_options['photo_text']) == 0):
-        return 'Neither title nor description found', 400
-
-    if 'raw_file' not in request.files and 'preview_file' not in request.files:
-        return 'Attachment not found', 400
-
-    # Insert camera
-    # """Create camera and manufacturer rows"""
+def resolve_equipment(photo_options, uow):
+    """Replace camera and lens details in photo_options with catalog ids"""
+    # Resolve camera
+    # """Look up or create camera and manufacturer rows in the catalog"""
     try:
-        # Get camera ID from request or after insertion
         if 'camera_id' not in photo_options and 'camera_model' in photo_options \
                                             and len(photo_options['camera_model']) > 0:
-            camera_options = {
-                'camera_model': photo_options['camera_model']
-            }
-            # Get manufacturer ID from request or after insertion
-            if camera_manufacturer_id in photo_options:
-                camera_options['manufacturer_id'] = photo_options['camera_manufacturer_id']
-            elif camera_manufacturer_name in photo_options \
-                 and len(photo_options['camera_manufacturer_name']) > 0:
-                # Insert manufacturer row
-                mfr = create_manufacturer(
-
-                    manufacturer_name=photo_options['camera_manufacturer_name']
-                )
-                if mfr is None:
-                    raise ValueError('Error creating manufacturer', 409)
-                camera_options['manufacturer_id'] = mfr.manufacturer_id
-                created_camera_manufacturer_id = mfr.manufacturer_id
-            if 'manufacturer_id' in camera_options:
-                # Insert camera row
-                camera = create_camera(**camera_options)
-                if camera is None:
-                    raise ValueError('Error creating camera', 409)
-                photo_options['camera_id'] = camera.camera_id
-                created_camera_id = camera.camera_id
+            manufacturer_id = photo_options.get('camera_manufacturer_id')
+            if manufacturer_id is None and 'camera_manufacturer_name' in photo_options \
+               and len(photo_options['camera_manufacturer_name']) > 0:
+                manufacturer_id = catalog.manufacturer_id(
+                    photo_options['camera_manufacturer_name'], uow)
+            if manufacturer_id is not None:
+                photo_options['camera_id'] = catalog.camera_id(manufacturer_id,
+                                                               photo_options['camera_model'], uow)
     except Exception as err:
         print('Could not process camera equipment:\n', err)
-        # clean up any created rows
-        if created_camera_id is not None:
-            delete_camera(created_camera_id)
-            created_camera_id = None
-        if created_camera_manufacturer_id is not None:
-            delete_manufacturer(created_camera_manufacturer_id)
-            created_camera_manufacturer_id = None
         pass # tolerate camera failure while posting
     del_prop(photo_options, 'camera_model')
     del_prop(photo_options, 'camera_manufacturer_id')
     del_prop(photo_options, 'camera_manufacturer_name')
 
-    # Insert lens
-    # """Create lens and manufacturer rows"""
+    # Resolve lens
+    # """Look up or create lens and manufacturer rows in the catalog"""
     try:
-        # Get camera ID from request or after insertion
         if 'lens_id' not in photo_options and 'lens_model' in photo_options \
                                           and len(photo_options['lens_model']) > 0:
-            lens_options = {
-                'lens_model': photo_options['lens_model']
-            }
-            if 'aperture_min' in photo_options:
+            lens_options = {}
+            if 'lens_aperture_min' in photo_options:
                 lens_options['aperture_min'] = photo_options['lens_aperture_min']
-            if 'aperture_max' in photo_options:
+            if 'lens_aperture_max' in photo_options:
                 lens_options['aperture_max'] = photo_options['lens_aperture_max']
-            if 'focal_length_min' in photo_options:
+            if 'lens_focal_length_min' in photo_options:
                 lens_options['focal_length_min'] = photo_options['lens_focal_length_min']
-            if 'focal_length_max' in photo_options:
+            if 'lens_focal_length_max' in photo_options:
                 lens_options['focal_length_max'] = photo_options['lens_focal_length_max']
-            # Get manufacturer ID from request or after insertion
-            if lens_manufacturer_id in photo_options:
-                lens_options['manufacturer_id'] = photo_options['lens_manufacturer_id']
-            elif 'lens_manufacturer_name' in photo_options \
-                  and len(photo_options['lens_manufacturer_name']) > 0:
-                # Insert manufacturer row
-                mfr = create_manufacturer(
-
-                    manufacturer_name=photo_options['lens_manufacturer_name']
-                )
-                if mfr is None:
-                    raise ValueError('Error creating manufacturer', 409)
-                lens_options['manufacturer_id'] = mfr.manufacturer_id
-                created_lens_manufacturer_id = mfr.manufacturer_id
-            if 'manufacturer_id' in lens_options:
-                # Insert lens row
-                lens = create_lens(**lens_options)
-                if lens is None:
-                    raise ValueError('Error creating lens', 409)
-                photo_options['lens_id'] = lens.lens_id
-                created_lens_id = lens.lens_id
+            manufacturer_id = photo_options.get('lens_manufacturer_id')
+            if manufacturer_id is None and 'lens_manufacturer_name' in photo_options \
+               and len(photo_options['lens_manufacturer_name']) > 0:
+                manufacturer_id = catalog.manufacturer_id(
+                    photo_options['lens_manufacturer_name'], uow)
+            if manufacturer_id is not None:
+                photo_options['lens_id'] = catalog.lens_id(manufacturer_id,
+                                                           photo_options['lens_model'], uow,
+                                                           **lens_options)
     except Exception as err:
         print('Could not process lens equipment:\n', err)
-        # clean up any created rows
-        if created_lens_id is not None:
-            delete_lens(created_lens_id)
-            created_lens_id = None
-        if created_lens_manufacturer_id is not None and \
-           created_lens_manufacturer_id != created_camera_manufacturer_id:
-            # don't delete the camera's manufacturer in case the camera row
-            # insertion was successful but the lens insertion failed
-            delete_manufacturer(created_lens_manufacturer_id)
-            created_lens_manufacturer_id = None
         pass # tolerate lens failure while posting
     del_prop(photo_options, 'lens_model')
     del_prop(photo_options, 'lens_aperture_min')
@@ -372,136 +406,185 @@ def handle_create_photo(session):
     del_prop(photo_options, 'lens_manufacturer_id')
     del_prop(photo_options, 'lens_manufacturer_name')
 
-    # Attach files
-    # """Process raw and preview files"""
-    config = load_config()
-    raw_file_path = None
-    preview_file_path = None
+def pending_preview_path(config, file_name):
+    """Return where a preview waits for the image pool"""
+    pending_path = os.path.join(config['file_storage_path'], '.pending')
+    os.makedirs(pending_path, exist_ok=True)
+    return os.path.join(pending_path, secure_filename(file_name))
+
+def queue_preview(file, source_path, photo_options, pending_previews, config, uow):
+    """Create a pending preview file row for an image the image pool will render"""
+    file_path = os.path.join(config['file_storage_path'],
+                             secure_filename(file.stream.hexdigest() + '.'
+                                             + config['preview_image_format']))
     try:
-        if 'preview_file' in request.files:
-            file = request.files['preview_file']
-            if '.' not in file.filename:
-                raise ValueError('Extension not found', 415)
-
-            extension = read_extension(file.filename)
-            if extension not in config['supported_file_extensions']['preview_file']:
-                raise ValueError(f'Unsupported extension ({extension})', 415)
-
-            file_path = os.path.join(
-                config['file_storage_path'],
-                secure_filename(hash_file(file).hexdigest() + '.' + config['preview_image_format'])
-            )
-            if os.path.exists(file_path):
-                raise FileExistsError(f'Preview file is a likely duplicate of {str(file_path)}')
-            image = Image.open(file)
-            image.thumbnail(config['preview_image_size'])
-            image.save(file_path)
-            preview_file_path = file_path
-            size = os.stat(file_path).st_size
-
-            preview_entry = create_file(
-                file_path=str(file_path), file_name=str(file.filename),
-                file_extension=config['preview_image_format'], file_size=size,
-                image_width=image.size[0], image_height=image.size[1])
-            if preview_entry is None:
-                raise Exception('Error creating preview')
-            photo_options['preview_file_id'] = preview_entry.file_id
-    except Exception as err:
-        print('Could not process photo preview file. Error:', str(err))
-        if preview_file_path is not None:
-            os.remove(preview_file_path)
-            preview_file_path = None
-        if 'preview_file_id' in photo_options:
-            delete_file(photo_options['preview_file_id'])
-            del_prop(photo_options, 'preview_file_id')
+        if os.path.exists(file_path):
+            raise FileExistsError(f'Preview file is a likely duplicate of {str(file_path)}')
+        preview_entry = create_file(
+            file_path=str(file_path), file_name=str(file.filename),
+            file_extension=config['preview_image_format'], file_size=0,
+            file_status='pending', uow=uow)
+        if preview_entry is None:
+            raise Exception('Error creating preview')
+    except Exception:
+        remove_file(source_path)
+        raise
+    uow.on_rollback(remove_file, source_path)
+    photo_options['preview_file_id'] = preview_entry.file_id
+    pending_previews.append((preview_entry.file_id, source_path, file_path))
+
+def attach_preview(file, photo_options, pending_previews, config, uow):
+    """Keep an uploaded preview for the image pool, which renders it in the background"""
+    if '.' not in file.filename:
+        raise ValueError('Extension not found', 415)
+
+    extension = read_extension(file.filename)
+    if extension not in supported_extensions('preview_file'):
+        raise ValueError(f'Unsupported extension ({extension})', 415)
+
+    source_path = file.stream.store(
+        pending_preview_path(config, file.stream.hexdigest() + '.' + extension))
+    queue_preview(file, source_path, photo_options, pending_previews, config, uow)
+
+def attach_raw(file, photo_options, config, uow):
+    """Store an uploaded raw file"""
+    if '.' not in file.filename:
+        raise ValueError('Extension not found', 415)
+
+    extension = read_extension(file.filename)
+    if extension not in supported_extensions('raw_file'):
+        raise ValueError(f'Unsupported extension ({extension})', 415)
+
+    file_path = os.path.join(
+        config['file_storage_path'],
+        secure_filename(file.stream.hexdigest() + '.' + extension)
+    )
+    try:
+        file.stream.store(file_path)
+    except FileExistsError as err:
+        raise FileExistsError(f'Raw file is a likely duplicate of {str(file_path)}') from err
+    try:
+        raw_entry = create_file(file_path=str(file_path), file_name=str(file.filename),
+                                file_extension=extension, file_size=file.stream.size, uow=uow)
+        if raw_entry is None:
+            raise Exception('Error creating raw file')
+    except Exception:
+        remove_file(file_path)
+        raise
+    uow.on_rollback(remove_file, file_path)
+    photo_options['raw_file_id'] = raw_entry.file_id
+
+def extract_raw_preview(file, photo_options, pending_previews, config, uow):
+    """Queue the largest JPEG embedded in a stored raw file as the photo's preview"""
+    raw_file_path = os.path.join(
+        config['file_storage_path'],
+        secure_filename(file.stream.hexdigest() + '.' + read_extension(file.filename))
+    )
+    source_path = pending_preview_path(config, file.stream.hexdigest() + '.embedded.jpg')
+    if not extract_embedded_jpeg(raw_file_path, source_path):
+        return
+    queue_preview(file, source_path, photo_options, pending_previews, config, uow)
 
+def finish_preview(file_id, result):
+    """Record the outcome of a background preview job"""
     try:
-        if 'raw_file' in request.files:
-            file = request.files['raw_file']
-            if '.' not in file.filename:
-                raise ValueError('Extension not found', 415)
-
-            extension = read_extension(file.filename)
-            if extension not in config['supported_file_extensions']['raw_file']:
-                raise ValueError(f'Unsupported extension ({extension})', 415)
-
-            file_path = os.path.join(
-                config['file_storage_path'],
-                secure_filename(hash_file(file).hexdigest() + '.' + extension)
-            )
-            if os.path.exists(file_path):
-                raise FileExistsError(f'Preview file is a likely duplicate of {str(file_path)}')
-            file.save(file_path)
-            raw_file_path = file_path
-            size = os.stat(file_path).st_size
-
-            raw_entry = create_file(file_path=str(file_path), file_name=str(file.filename),
-                                    file_extension=extension, file_size=size)
-            if raw_entry is None:
-                raise Exception('Error creating raw file')
-            photo_options['raw_file_id'] = raw_entry.file_id
-            # if 'preview_file_id' not in photo_options:
-            #     # try to extract an embedded image from the raw file to use as the preview
-            #     try:
-            #         # get thumbnail image
-            #         # write to disk
-            #         # insert into File table in database
-            #         # set photo_options['preview_file_id'] to the new File.file_id
-            #         # set preview_file_path = file_path
-            #     except Exception as err:
-            #         print('Failed to extract thumbnail from raw file')
+        if result is None:
+            update_file(file_id, file_status='failed')
+            return
+        renditions = result.pop('renditions')
+        with UnitOfWork() as uow:
+            if renditions:
+                create_file_renditions(file_id, renditions, uow=uow)
+            update_file(file_id, file_status='ready', uow=uow, **result)
     except Exception as err:
-        print('Could not process photo raw file. Error:', str(err))
-        if raw_file_path is not None:
-            os.remove(raw_file_path)
-            raw_file_path = None
-        if 'raw_file_id' in photo_options:
-            delete_file(photo_options['raw_file_id'])
-            del_prop(photo_options, 'raw_file_id')
+        print(f'Could not update preview file ({file_id}):', str(err))
+    finally:
+        # runs on an image pool thread, outside of any request
+        db_session.remove()
+
+@app.route('/photo', methods=['PUT'])
+@with_session
+def handle_create_photo(session):
+    """Flask route for creating a photo"""
+    if request.form is None:
+        return 'Bad request', 400
 
+    # Everything below runs in one transaction. Optional pieces use savepoints
+    # and files on disk are removed by rollback hooks if the photo isn't created.
     try:
-        if not ('preview_file_id' in photo_options or 'raw_file_id' in photo_options):
-            raise ValueError('Photo posts must include at least one raw file or preview image')
-        # Insert photo row and return its photo_id
-        photo = create_photo(**photo_options)
-        if photo is None:
-            raise Exception('Error creating photo')
-        return jsonify({ 'photoId': photo.photo_id }), 201
+        with UnitOfWork() as uow:
+            account = select_account(account_email=session['account_email'], uow=uow)
+            if account is None:
+                return 'Account not found', 404
+
+            photo_options = {}
+            for key in request.form:
+                v = request.form[key]
+                if v != 'null':
+                    photo_options[key] = v
+            photo_options['account_id'] = account.account_id
+
+            if ('photo_title' not in photo_options or len(photo_options['photo_title']) == 0) \
+               and ('photo_text' not in photo_options or len(photo_options['photo_text']) == 0):
+                return 'Neither title nor description found', 400
+
+            if 'raw_file' not in request.files and 'preview_file' not in request.files:
+                return 'Attachment not found', 400
+
+            # Fill in camera, lens and exposure details the client didn't send from EXIF,
+            # preferring the raw file over the preview
+            for key in ('raw_file', 'preview_file'):
+                if key in request.files:
+                    stream = request.files[key].stream
+                    stream.flush()
+                    for prop, value in read_metadata(stream.path).items():
+                        photo_options.setdefault(prop, value)
+
+            resolve_equipment(photo_options, uow)
+
+            # Attach files
+            # """Process raw and preview files"""
+            config = load_config()
+            pending_previews = []
+            try:
+                if 'preview_file' in request.files:
+                    with uow.savepoint():
+                        attach_preview(request.files['preview_file'], photo_options,
+                                       pending_previews, config, uow)
+            except Exception as err:
+                print('Could not process photo preview file. Error:', str(err))
+                del_prop(photo_options, 'preview_file_id')
+
+            try:
+                if 'raw_file' in request.files:
+                    with uow.savepoint():
+                        attach_raw(request.files['raw_file'], photo_options, config, uow)
+                    if 'preview_file_id' not in photo_options:
+                        # try to extract an embedded image from the raw file to use as the preview
+                        try:
+                            with uow.savepoint():
+                                extract_raw_preview(request.files['raw_file'], photo_options,
+                                                    pending_previews, config, uow)
+                        except Exception as err:
+                            print('Failed to extract thumbnail from raw file:', str(err))
+                            del_prop(photo_options, 'preview_file_id')
+            except Exception as err:
+                print('Could not process photo raw file. Error:', str(err))
+                del_prop(photo_options, 'raw_file_id')
+
+            if not ('preview_file_id' in photo_options or 'raw_file_id' in photo_options):
+                raise ValueError('Photo posts must include at least one raw file or preview image')
+            # Insert photo row and render its previews once it is committed
+            photo = create_photo(**photo_options, uow=uow)
+            for file_id, source_path, file_path in pending_previews:
+                uow.on_commit(get_image_pool().submit_preview, file_id, source_path, file_path,
+                              config['preview_image_size'], finish_preview,
+                              config['preview_rendition_widths'],
+                              config['preview_rendition_formats'])
     except Exception as err:
         print('Could not create_photo:', str(err))
-
-        # delete any files written to disk
-        if preview_file_path is not None:
-            os.remove(preview_file_path)
-            preview_file_path = None
-        if raw_file_path is not None:
-            os.remove(raw_file_path)
-            raw_file_path = None
-
-        # back out any database insertions
-        if 'preview_file_id' in photo_options:
-            delete_file(photo_options['preview_file_id'])
-            del_prop(photo_options, 'preview_file_id')
-        if 'raw_file_id' in photo_options:
-            delete_file(photo_options['raw_file_id'])
-            del_prop(photo_options, 'raw_file_id')
-        if created_camera_id is not None:
-            delete_camera(created_camera_id)
-        if created_camera_manufacturer_id is not None:
-            delete_manufacturer(created_camera_manufacturer_id)
-        if created_lens_id is not None:
-            delete_lens(created_lens_id)
-        if created_lens_manufacturer_id is not None:
-            delete_manufacturer(created_lens_manufacturer_id)
-
         return str(err), 500
-
-    # Create notifications
-    # actor_id = account.account_id
-    # follower_ids = select follower_id from account_follow where following_id == actor_id
-    # notify_options = {}
-    # for each id in follower_ids:
-    #     insert notification
+    return jsonify({ 'photoId': photo.photo_id }), 201
 
 @app.route('/photo/<photo_id>', methods=['POST'])
 def handle_update_photo(photo_id):
@@ -587,6 +670,136 @@ def handle_delete_reaction():
     delete_reaction(reaction_id)
     return '', 204
 
+@app.route('/tags', methods=['PUT'])
+@with_session
+def handle_create_tags(session):
+    """Flask route for creating many tags at once"""
+    # pylint: disable=unused-argument
+    if request.json is None or 'tag_names' not in request.json:
+        return 'Bad request', 400
+    tag_ids = create_tags(request.json['tag_names'])
+    return jsonify({ 'tagIds': tag_ids }), 201
+
+def read_tag_ids(tag_options, uow):
+    """Return the tag_ids of a request, creating any tags named in its tag_names"""
+    tag_ids = [int(tag_id) for tag_id in tag_options.get('tag_ids', [])]
+    if len(tag_options.get('tag_names', [])) > 0:
+        tag_ids += create_tags(tag_options['tag_names'], uow=uow)
+    return tag_ids
+
+@app.route('/photo/<photo_id>/tags', methods=['PUT'])
+@with_session
+def handle_attach_photo_tags(session, photo_id):
+    """Flask route for tagging a photo with many tags, by id or by name"""
+    if request.json is None:
+        return 'Bad request', 400
+    try:
+        with UnitOfWork() as uow:
+            account = select_account(account_email=session['account_email'], uow=uow)
+            photo = select_photo(photo_id=int(photo_id), uow=uow)
+            if account is None or photo is None or photo.account_id != account.account_id:
+                return 'Photo not found', 404
+            tag_ids = read_tag_ids(request.json, uow)
+            attach_photo_tags(photo.photo_id, tag_ids, uow=uow)
+    except (TypeError, ValueError) as err:
+        return f'Bad request ({str(err)})', 400
+    except IntegrityError:
+        return 'Tag not found', 404
+    return jsonify({ 'tagIds': tag_ids }), 200
+
+@app.route('/edit/<edit_id>/tags', methods=['PUT'])
+@with_session
+def handle_attach_edit_tags(session, edit_id):
+    """Flask route for tagging an edit with many tags, by id or by name"""
+    if request.json is None:
+        return 'Bad request', 400
+    try:
+        with UnitOfWork() as uow:
+            account = select_account(account_email=session['account_email'], uow=uow)
+            edit = select_edit(edit_id=int(edit_id), uow=uow)
+            if account is None or edit is None or edit.account_id != account.account_id:
+                return 'Edit not found', 404
+            tag_ids = read_tag_ids(request.json, uow)
+            attach_edit_tags(edit.edit_id, tag_ids, uow=uow)
+    except (TypeError, ValueError) as err:
+        return f'Bad request ({str(err)})', 400
+    except IntegrityError:
+        return 'Tag not found', 404
+    return jsonify({ 'tagIds': tag_ids }), 200
+
+@app.route('/photo/<photo_id>/reactions', methods=['PUT'])
+@with_session
+def handle_attach_photo_reactions(session, photo_id):
+    """Flask route for reacting to a photo in many ways at once"""
+    if request.json is None or 'reaction_ids' not in request.json:
+        return 'Bad request', 400
+    try:
+        with UnitOfWork() as uow:
+            account = select_account(account_email=session['account_email'], uow=uow)
+            if account is None:
+                return 'Account not found', 404
+            photo = select_photo(photo_id=int(photo_id), uow=uow)
+            if photo is None:
+                return 'Photo not found', 404
+            attach_photo_reactions(account.account_id, photo.photo_id,
+                                   [int(reaction_id)
+                                    for reaction_id in request.json['reaction_ids']],
+                                   uow=uow)
+    except (TypeError, ValueError) as err:
+        return f'Bad request ({str(err)})', 400
+    except IntegrityError:
+        return 'Reaction not found', 404
+    return '', 200
+
+@app.route('/reactions', methods=['PUT'])
+@with_session
+def handle_create_reactions(session):
+    """Flask route for admins to create many reactions at once"""
+    account = select_account(account_email=session['account_email'])
+    if account is None or account.account_role != 'admin':
+        return 'Forbidden', 403
+    if request.json is None or 'reactions' not in request.json:
+        return 'Bad request', 400
+    reaction_ids = create_reactions(request.json['reactions'])
+    return jsonify({ 'reactionIds': reaction_ids }), 201
+
+@app.route('/equipment', methods=['PUT'])
+@with_session
+def handle_create_equipment(session):
+    """
+    Flask route for admins to seed the equipment catalog
+
+    Takes lists of manufacturer names, cameras and lenses. Cameras and lenses name their
+    manufacturer with manufacturer_id or manufacturer_name.
+    """
+    account = select_account(account_email=session['account_email'])
+    if account is None or account.account_role != 'admin':
+        return 'Forbidden', 403
+    equipment = request.json
+    if equipment is None:
+        return 'Bad request', 400
+    cameras = [dict(camera) for camera in equipment.get('cameras', [])]
+    lenses = [dict(lens) for lens in equipment.get('lenses', [])]
+    manufacturer_names = list(equipment.get('manufacturers', []))
+    manufacturer_names += [item['manufacturer_name'] for item in cameras + lenses
+                           if 'manufacturer_id' not in item]
+    try:
+        with UnitOfWork() as uow:
+            manufacturer_ids = dict(zip(manufacturer_names,
+                                        create_manufacturers(manufacturer_names, uow=uow)))
+            for item in cameras + lenses:
+                if 'manufacturer_id' not in item:
+                    item['manufacturer_id'] = manufacturer_ids[item.pop('manufacturer_name')]
+            camera_ids = create_cameras(cameras, uow=uow)
+            lens_ids = create_lenses(lenses, uow=uow)
+    except (KeyError, ValueError) as err:
+        return f'Bad request ({str(err)})', 400
+    return jsonify({
+        'manufacturerIds': [manufacturer_ids[name] for name in equipment.get('manufacturers', [])],
+        'cameraIds': camera_ids,
+        'lensIds': lens_ids,
+    }), 201
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     """Disconnect database session on shutdown"""
@@ -0,0 +1,128 @@
+"""
+Benchmark notification fan-out for creators with many followers
+
+Creates a creator with each number of followers, posts an event and times
+the fan-out worker writing its notifications, against one INSERT per
+follower like the plan handle_create_photo used to describe:
+
+    python benchmarks/fanout.py --followers 10 10000 1000000
+
+Runs against the database configured for the API, or --url. Everything it
+creates is deleted afterwards, but use a scratch database all the same.
+"""
+
+import argparse
+import os
+import secrets
+import sys
+import time
+from sqlalchemy import create_engine, delete, insert
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-position
+from db import create_event, db_session, engine
+from fanout import FANOUT_DEFAULTS, fan_out
+from model import Account, AccountFollow, Base, Event, FanoutJob, Notification
+
+def create_accounts(count, prefix, chunk_size):
+    """Insert count accounts in chunks and return their ids"""
+    session = db_session()
+    for start in range(0, count, chunk_size):
+        session.execute(insert(Account.__table__), [
+            {'account_name': f'{prefix}{i}', 'account_handle': f'{prefix}{i}',
+             'account_email': f'{prefix}{i}@example.com'}
+            for i in range(start, min(count, start + chunk_size))
+        ])
+    session.commit()
+    return [account_id for (account_id,) in session.query(Account.account_id)
+                                                   .filter(Account.account_handle
+                                                                  .startswith(prefix))]
+
+def create_creator(followers, chunk_size):
+    """Create a creator followed by the given number of new accounts"""
+    prefix = f'fb{secrets.token_hex(3)}-'
+    creator_id, = create_accounts(1, f'{prefix}c', chunk_size)
+    follower_ids = create_accounts(followers, f'{prefix}f', chunk_size)
+    session = db_session()
+    for start in range(0, len(follower_ids), chunk_size):
+        session.execute(insert(AccountFollow), [
+            {'follower_id': follower_id, 'following_id': creator_id}
+            for follower_id in follower_ids[start:start + chunk_size]
+        ])
+    session.commit()
+    return prefix, creator_id
+
+def run_row_by_row(creator_id):
+    """Write one notification per follower with a statement each, in the request"""
+    session = db_session()
+    start = time.perf_counter()
+    event = create_event('submit_photo', creator_id)
+    follower_ids = session.query(AccountFollow.c.follower_id) \
+                          .filter(AccountFollow.c.following_id == creator_id) \
+                          .all()
+    for (follower_id,) in follower_ids:
+        session.execute(insert(Notification.__table__).values(account_id=follower_id,
+                                                              event_id=event.event_id))
+    session.query(FanoutJob).filter(FanoutJob.event_id == event.event_id) \
+                            .update({'status': 'done'})
+    session.commit()
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+def run_fanout(creator_id, options):
+    """Post an event, then run the fan-out worker until its job is done"""
+    start = time.perf_counter()
+    create_event('submit_photo', creator_id)
+    posted = time.perf_counter() - start
+    while fan_out(options) is not None:
+        db_session.remove()
+    return posted, time.perf_counter() - start
+
+def clean_up(prefix):
+    """Delete the accounts of a run and everything that references them"""
+    session = db_session()
+    account_ids = session.query(Account.account_id).filter(Account.account_handle
+                                                                  .startswith(prefix))
+    event_ids = session.query(Event.event_id).filter(Event.account_id.in_(account_ids))
+    session.execute(delete(Notification.__table__).where(Notification.event_id.in_(event_ids)))
+    session.execute(delete(FanoutJob.__table__).where(FanoutJob.event_id.in_(event_ids)))
+    session.execute(delete(Event.__table__).where(Event.event_id.in_(event_ids)))
+    session.execute(delete(AccountFollow).where(AccountFollow.c.following_id.in_(account_ids)))
+    session.execute(delete(Account.__table__).where(Account.account_id.in_(account_ids)))
+    session.commit()
+
+def report(name, followers, posted, elapsed):
+    rate = followers / elapsed if elapsed > 0 else float('inf')
+    print(f'{name:>10} {followers:>9} followers: post {posted * 1000:9.2f} ms  '
+          f'done {elapsed:8.2f} s  {rate:10.0f} notifications/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--followers', type=int, nargs='+', default=[10, 10000, 1000000])
+    parser.add_argument('--chunk-size', type=int, default=FANOUT_DEFAULTS['chunk_size'])
+    parser.add_argument('--slice-size', type=int, default=FANOUT_DEFAULTS['slice_size'])
+    parser.add_argument('--row-by-row-max', type=int, default=10000,
+                        help='largest follower count to also time one INSERT per follower')
+    parser.add_argument('--url', help='database URL, instead of the API\'s')
+    args = parser.parse_args()
+
+    bind = create_engine(args.url) if args.url else engine
+    db_session.configure(bind=bind)
+    Base.metadata.create_all(bind)
+    # Time writing every notification, however many followers the creator has
+    options = {**FANOUT_DEFAULTS, 'chunk_size': args.chunk_size, 'slice_size': args.slice_size,
+               'on_read_threshold': float('inf')}
+    for followers in args.followers:
+        prefix, creator_id = create_creator(followers, args.chunk_size)
+        try:
+            if followers <= args.row_by_row_max:
+                report('row by row', followers, *run_row_by_row(creator_id))
+            report('fan-out', followers, *run_fanout(creator_id, options))
+        finally:
+            db_session.remove()
+            clean_up(prefix)
+            db_session.remove()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark preview rendering in the request thread against the image pool
+
+Compares how long an upload request spends on its preview before and after
+moving Pillow work into imaging.ImagePool, and how many previews per second
+per core each approach sustains:
+
+    python benchmarks/preview_pool.py --images 24 --width 9504 --height 6336
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from imaging import ImagePool, render_preview # pylint: disable=wrong-import-position
+
+def create_sources(directory, count, width, height):
+    """Write count noisy JPEGs of the given size, like camera uploads"""
+    paths = []
+    base = Image.effect_noise((width, height), 64).convert('RGB')
+    for i in range(count):
+        path = os.path.join(directory, f'source-{i}.jpg')
+        base.save(path, quality=92)
+        paths.append(path)
+    return paths
+
+def copy_sources(paths):
+    """The pool removes sources when done, so give every run its own copies"""
+    copies = []
+    for path in paths:
+        copy = f'{path}.{time.monotonic_ns()}.jpg'
+        os.link(path, copy)
+        copies.append(copy)
+    return copies
+
+def run_inline(paths, directory, size):
+    """Render every preview in the calling thread, like the old upload handler"""
+    latencies = []
+    start = time.perf_counter()
+    for i, path in enumerate(paths):
+        request_start = time.perf_counter()
+        render_preview(path, os.path.join(directory, f'inline-{i}.jpg'), size)
+        latencies.append(time.perf_counter() - request_start)
+    return latencies, time.perf_counter() - start
+
+def run_pool(paths, directory, size, workers):
+    """Submit every preview to the pool and wait for all of them to finish"""
+    pool = ImagePool(workers)
+    pool.get_executor().submit(int).result() # start the worker processes up front
+    finished = threading.Semaphore(0)
+    latencies = []
+    start = time.perf_counter()
+    for i, path in enumerate(copy_sources(paths)):
+        request_start = time.perf_counter()
+        pool.submit_preview(i, path, os.path.join(directory, f'pool-{i}.jpg'), size,
+                            lambda file_id, result: finished.release())
+        latencies.append(time.perf_counter() - request_start)
+    for _ in paths:
+        finished.acquire()
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return latencies, elapsed
+
+def report(name, latencies, elapsed, cores):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    rate = len(latencies) / elapsed
+    print(f'{name:>8}: request p50 {p50:9.2f} ms  p99 {p99:9.2f} ms  '
+          f'{rate:6.2f} images/s  {rate / cores:6.2f} images/s/core')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=12)
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--size', type=int, nargs=2, default=[3000, 2000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = create_sources(directory, args.images, args.width, args.height)
+        report('inline', *run_inline(paths, directory, args.size), 1)
+        report('pool', *run_pool(paths, directory, args.size, args.workers), args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Process-local cache of the equipment catalog
+
+Manufacturers, cameras and lenses are few and rarely change, but almost
+every upload names some. The catalog keeps their ids in dicts keyed by
+normalized names so resolving equipment is usually a dict lookup. Misses
+go through INSERT ... ON CONFLICT DO NOTHING RETURNING, falling back to a
+SELECT when another request inserted the row first, so concurrent uploads
+of the same equipment never fail on the unique constraints.
+
+The whole catalog is reloaded on first use, after any write through db.py
+and every refresh_interval seconds, so rows changed by other processes are
+picked up.
+
+Lookups may run inside a db.UnitOfWork, in which case the upsert happens in
+a savepoint of its transaction and the new id is only cached once it commits.
+Inserts purge the cached GraphQL responses that listed equipment.
+"""
+
+import threading
+import time
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from model import Camera, Lens, Manufacturer
+from response_cache import response_cache, table_tags
+
+def normalize(name):
+    """Normalize a name for lookups, ignoring case and repeated whitespace"""
+    return ' '.join(str(name).split()).casefold()
+
+class Catalog:
+    """Cache of manufacturer, camera and lens ids"""
+    def __init__(self, engine, refresh_interval=300):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.manufacturers = {}
+        self.cameras = {}
+        self.lenses = {}
+        self.warmed_at = None
+        self.lock = threading.Lock()
+
+    def warm(self):
+        """Load every manufacturer, camera and lens"""
+        with self.engine.connect() as conn:
+            manufacturers = {
+                normalize(name): manufacturer_id for manufacturer_id, name in conn.execute(
+                    select(Manufacturer.manufacturer_id, Manufacturer.manufacturer_name)
+                    .order_by(Manufacturer.manufacturer_id.desc()))
+            }
+            cameras = {
+                (manufacturer_id, normalize(model)): camera_id
+                for camera_id, manufacturer_id, model in conn.execute(
+                    select(Camera.camera_id, Camera.manufacturer_id, Camera.camera_model)
+                    .order_by(Camera.camera_id.desc()))
+            }
+            lenses = {
+                (manufacturer_id, normalize(model)): lens_id
+                for lens_id, manufacturer_id, model in conn.execute(
+                    select(Lens.lens_id, Lens.manufacturer_id, Lens.lens_model)
+                    .order_by(Lens.lens_id.desc()))
+            }
+        # rows are read newest first so the oldest of any case variants wins
+        with self.lock:
+            self.manufacturers, self.cameras, self.lenses = manufacturers, cameras, lenses
+            self.warmed_at = time.monotonic()
+
+    def invalidate(self):
+        """Drop the cache, it is reloaded on next use"""
+        self.warmed_at = None
+
+    def refresh(self):
+        """Reload the catalog if it was invalidated or is older than refresh_interval"""
+        if self.warmed_at is None or time.monotonic() - self.warmed_at > self.refresh_interval:
+            self.warm()
+
+    def upsert(self, table, values, conflict_columns, id_column, uow=None):
+        """
+        Insert a row unless it exists, returning its id either way
+
+        These statements bypass the session events in db.py, so a new row's
+        response cache tags are purged here, once its transaction commits.
+        """
+        if uow is None:
+            with self.engine.begin() as conn:
+                row_id, inserted = self.execute_upsert(conn, table, values, conflict_columns,
+                                                       id_column)
+            if inserted:
+                response_cache.purge(table_tags(table, True))
+            return row_id
+        with uow.savepoint():
+            row_id, inserted = self.execute_upsert(uow.session.connection(), table, values,
+                                                   conflict_columns, id_column)
+        if inserted:
+            uow.session.info.setdefault('cache_tags', set()).update(table_tags(table, True))
+        return row_id
+
+    @staticmethod
+    def execute_upsert(conn, table, values, conflict_columns, id_column):
+        """
+        Run INSERT ... ON CONFLICT DO NOTHING RETURNING, then SELECT if nothing was
+        returned, and return the id and whether the row was inserted
+        """
+        row = conn.execute(
+            insert(table).values(**values)
+                         .on_conflict_do_nothing(index_elements=conflict_columns)
+                         .returning(id_column)
+        ).first()
+        if row is not None:
+            return row[0], True
+        row = conn.execute(select(id_column).where(
+            *(table.c[column] == values[column] for column in conflict_columns)
+        )).first()
+        return row[0], False
+
+    @staticmethod
+    def remember(cache, key, value, uow=None):
+        """Cache an id now, or once the unit of work commits"""
+        if uow is None:
+            cache[key] = value
+        else:
+            uow.on_commit(cache.__setitem__, key, value)
+        return value
+
+    def manufacturer_id(self, manufacturer_name, uow=None):
+        """Return the id of a manufacturer, creating it if needed"""
+        self.refresh()
+        key = normalize(manufacturer_name)
+        if key in self.manufacturers:
+            return self.manufacturers[key]
+        return self.remember(self.manufacturers, key, self.upsert(
+            Manufacturer.__table__, {'manufacturer_name': manufacturer_name.strip()},
+            ['manufacturer_name'], Manufacturer.manufacturer_id, uow), uow)
+
+    def camera_id(self, manufacturer_id, camera_model, uow=None):
+        """Return the id of a camera, creating it if needed"""
+        self.refresh()
+        key = (int(manufacturer_id), normalize(camera_model))
+        if key in self.cameras:
+            return self.cameras[key]
+        return self.remember(self.cameras, key, self.upsert(
+            Camera.__table__,
+            {'manufacturer_id': int(manufacturer_id), 'camera_model': camera_model.strip()},
+            ['camera_model', 'manufacturer_id'], Camera.camera_id, uow), uow)
+
+    def lens_id(self, manufacturer_id, lens_model, uow=None, **lens_options):
+        """Return the id of a lens, creating it with lens_options if needed"""
+        self.refresh()
+        key = (int(manufacturer_id), normalize(lens_model))
+        if key in self.lenses:
+            return self.lenses[key]
+        return self.remember(self.lenses, key, self.upsert(
+            Lens.__table__,
+            {**lens_options, 'manufacturer_id': int(manufacturer_id),
+             'lens_model': lens_model.strip()},
+            ['lens_model', 'manufacturer_id'], Lens.lens_id, uow), uow)
@@ -1,32 +1,328 @@
 """Database interface"""
 
+import heapq
 import os
-from sqlalchemy.orm import Session
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from sqlalchemy.orm import joinedload, scoped_session, sessionmaker
 from sqlalchemy.sql.functions import now
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from model import (
     Account,
+    AccountBan,
+    AccountFollow,
+    Ban,
     Camera,
     Edit,
+    EditTag,
     Editor,
+    Event,
+    FanoutJob,
     File,
+    FileRendition,
     Lens,
     Manufacturer,
+    Notification,
     Photo,
+    PhotoReaction,
+    PhotoTag,
     Reply,
     Tag,
     Reaction
 )
-from utils import load_config
-
-# Open a connection to the Postgres database
-engine = create_engine("postgresql+psycopg2://"
-                      f"{os.environ.get('POSTGRES_USER')}:{os.environ.get('POSTGRES_PASSWORD')}"
-                      f"@db:5432/{os.environ.get('POSTGRES_DB')}")
+from utils import load_config, worker_processes
+from catalog import Catalog
+from response_cache import changed_row_tags, response_cache, table_tags
+
+def database_url():
+    """Return the Postgres URL, using a unix socket when POSTGRES_SOCKET_DIR is set"""
+    credentials = f"{os.environ.get('POSTGRES_USER')}:{os.environ.get('POSTGRES_PASSWORD')}"
+    database = os.environ.get('POSTGRES_DB')
+    socket_dir = os.environ.get('POSTGRES_SOCKET_DIR')
+    if socket_dir:
+        return f"postgresql+psycopg2://{credentials}@/{database}?host={socket_dir}"
+    return f"postgresql+psycopg2://{credentials}@db:5432/{database}"
+
+def pool_options():
+    """
+    Return the engine options in database_pool, with each API worker's pool capped
+    to its share of max_connections
+    """
+    options = dict(load_config().get('database_pool', {}))
+    max_connections = options.pop('max_connections', None)
+    if max_connections is not None:
+        share = max(1, max_connections // worker_processes())
+        options['pool_size'] = min(options.get('pool_size', 5), share)
+        options['max_overflow'] = min(options.get('max_overflow', 10),
+                                      share - options['pool_size'])
+    return options
+
+# Open a pool of connections to the Postgres database, sized by database_pool in config.json
+engine = create_engine(database_url(), **pool_options())
+
+# Session shared by every helper below for the length of a request (or thread),
+# removed by the app when the request ends
+db_session = scoped_session(
+    sessionmaker(
+        autocommit=False,
+        autoflush=False,
+        expire_on_commit=False,
+        bind=engine
+    )
+)
 
-def select_account(account_id=None, account_email=None, account_handle=None):
+# Connection checkouts, queries and time spent in queries for the current request
+query_stats = threading.local()
+
+def reset_query_stats():
+    """Zero the query counters of the current request"""
+    query_stats.checkouts = 0
+    query_stats.queries = 0
+    query_stats.duration = 0.0
+
+def get_query_stats():
+    """Return the query counters of the current request"""
+    return {
+        'checkouts': getattr(query_stats, 'checkouts', 0),
+        'queries': getattr(query_stats, 'queries', 0),
+        'duration': getattr(query_stats, 'duration', 0.0),
+    }
+
+@event.listens_for(engine, 'checkout')
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    # pylint: disable=unused-argument
+    query_stats.checkouts = getattr(query_stats, 'checkouts', 0) + 1
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    started_at = conn.info['query_started_at'].pop()
+    query_stats.queries = getattr(query_stats, 'queries', 0) + 1
+    query_stats.duration = getattr(query_stats, 'duration', 0.0) \
+                           + time.perf_counter() - started_at
+
+@event.listens_for(db_session, 'after_flush')
+def collect_changed_rows(session, flush_context):
+    """Remember the response cache tags of flushed rows until the transaction commits"""
+    # pylint: disable=unused-argument
+    tags = session.info.setdefault('cache_tags', set())
+    for change, instances in (('new', session.new), ('dirty', session.dirty),
+                              ('deleted', session.deleted)):
+        for instance in instances:
+            tags.update(changed_row_tags(instance, change))
+
+@event.listens_for(db_session, 'do_orm_execute')
+def collect_changed_tables(orm_execute_state):
+    """Remember the response cache tags of tables written with bulk statements"""
+    if orm_execute_state.is_insert or orm_execute_state.is_update \
+       or orm_execute_state.is_delete:
+        tags = orm_execute_state.session.info.setdefault('cache_tags', set())
+        tags.update(table_tags(orm_execute_state.statement.table,
+                               orm_execute_state.is_insert))
+
+@event.listens_for(db_session, 'after_commit')
+def purge_cached_responses(session):
+    """Invalidate cached GraphQL responses that read rows the transaction wrote"""
+    response_cache.purge(session.info.pop('cache_tags', set()))
+
+@event.listens_for(db_session, 'after_soft_rollback')
+def forget_changed_rows(session, previous_transaction):
+    """Drop the tags of a rolled back transaction, but not of a rolled back savepoint"""
+    if previous_transaction.parent is None:
+        session.info.pop('cache_tags', None)
+
+@event.listens_for(Event, 'before_insert')
+def record_event_transaction(mapper, connection, target):
+    """Stamp events with the id of the transaction inserting them, for the feed builder"""
+    # pylint: disable=unused-argument
+    if connection.dialect.name == 'postgresql':
+        target.created_xid = func.txid_current()
+
+# Cache of manufacturer, camera and lens ids, invalidated by the writes below
+catalog = Catalog(engine, load_config().get('catalog_refresh_interval', 300))
+
+class UnitOfWork:
+    """
+    One transaction of the request's session shared by several helpers
+
+    Helpers called inside a unit of work flush instead of committing, and
+    savepoint() lets optional steps fail without aborting the rest. Callbacks
+    added with on_commit and on_rollback run after the transaction ends so
+    files and background jobs follow the fate of the rows that reference them.
+    A unit of work opened inside another transaction flushes the same way and
+    leaves its callbacks to the outer one.
+    """
+    def __init__(self):
+        self.session = db_session()
+        self.commit_hooks = []
+        self.rollback_hooks = []
+        self.depth = 0
+
+    def on_commit(self, fn, *args, **kwargs):
+        """Call fn once the transaction commits"""
+        self.commit_hooks.append((fn, args, kwargs))
+
+    def on_rollback(self, fn, *args, **kwargs):
+        """Call fn if the transaction rolls back"""
+        self.rollback_hooks.append((fn, args, kwargs))
+
+    def savepoint(self):
+        """Begin a nested transaction, rolled back alone if its block raises"""
+        return self.session.begin_nested()
+
+    def __enter__(self):
+        self.depth = self.session.info.get('transaction_depth', 0)
+        self.session.info['transaction_depth'] = self.depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.session.info['transaction_depth'] = self.depth
+        if self.depth > 0:
+            # Inside another transaction, which commits or rolls back for both of us
+            pending = self.session.info.setdefault('transaction_hooks', ([], []))
+            pending[0].extend(self.commit_hooks)
+            pending[1].extend(self.rollback_hooks)
+            if exc_type is None:
+                self.session.flush()
+            return False
+        committed = False
+        try:
+            if exc_type is None:
+                self.session.commit()
+                committed = True
+        finally:
+            if not committed:
+                self.session.rollback()
+            run_hooks(self.session, committed, self.commit_hooks, self.rollback_hooks)
+        return False
+
+def run_hooks(session, committed, commit_hooks=(), rollback_hooks=()):
+    """Call the hooks of a transaction that just ended, and those nested units of work left"""
+    pending_commit, pending_rollback = session.info.pop('transaction_hooks', ([], []))
+    hooks = [*pending_commit, *commit_hooks] if committed \
+            else [*pending_rollback, *rollback_hooks]
+    for fn, args, kwargs in hooks:
+        try:
+            fn(*args, **kwargs)
+        except Exception as err:
+            print('Transaction hook failed:', str(err))
+
+@contextmanager
+def transaction(uow=None):
+    """Yield the request's session, committing on exit unless already in a transaction"""
+    session = uow.session if uow is not None else db_session()
+    depth = session.info.get('transaction_depth', 0)
+    session.info['transaction_depth'] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+            run_hooks(session, True)
+        else:
+            session.flush()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+            run_hooks(session, False)
+        raise
+    finally:
+        session.info['transaction_depth'] = depth
+
+def insert_rows(session, table, rows, key_columns, id_column):
+    """
+    Insert rows that don't exist yet in a single INSERT ... ON CONFLICT DO NOTHING
+    RETURNING, then SELECT the ids of rows that already existed in one more query
+
+    Returns the id of every row in the order given.
+    """
+    rows = [dict(row) for row in rows]
+    if len(rows) == 0:
+        return []
+    keys = [table.c[column] for column in key_columns]
+    row_key = lambda row: tuple(row[column] for column in key_columns)
+    unique_rows = list({row_key(row): row for row in rows}.values())
+    ids = {tuple(found[1:]): found[0] for found in session.execute(
+        insert(table).values(unique_rows)
+                     .on_conflict_do_nothing(index_elements=key_columns)
+                     .returning(id_column, *keys)
+    )}
+    missing = [row_key(row) for row in unique_rows if row_key(row) not in ids]
+    if missing:
+        ids.update({tuple(found[1:]): found[0] for found in session.execute(
+            select(id_column, *keys).where(tuple_(*keys).in_(missing))
+        )})
+    return [ids[row_key(row)] for row in rows]
+
+def link_rows(session, table, rows):
+    """Insert many-to-many rows in one statement, skipping those that already exist"""
+    rows = [dict(row) for row in rows]
+    if len(rows) > 0:
+        session.execute(insert(table).values(rows).on_conflict_do_nothing())
+
+def create_event(event_type, account_id, photo=None, edit=None, reply=None, uow=None):
+    """
+    Add new content to the event feed, unless its creator has an active ban, and queue
+    notifications for the creator's followers
+    """
+    # pylint: disable=too-many-arguments
+    with transaction(uow) as session:
+        ban = session.query(AccountBan.c.ban_id) \
+                     .join(Ban, Ban.ban_id == AccountBan.c.ban_id) \
+                     .filter(AccountBan.c.account_id == account_id) \
+                     .filter(or_(Ban.expires_at.is_(None), Ban.expires_at > now())) \
+                     .first()
+        if ban is not None:
+            return None
+        event = Event(event_type=event_type, account_id=account_id,
+                      photo=photo, edit=edit, reply=reply)
+        session.add(event)
+        session.add(FanoutJob(event=event, account_id=account_id))
+        session.flush()
+        return event
+
+def select_notifications(account_id, before=datetime.max, limit=10, uow=None):
+    """
+    Select an account's newest notifications, merging the rows written for it with
+    events of followed accounts that are fanned out on read
+    """
+    with transaction(uow) as session:
+        written = session.query(Notification) \
+                         .options(joinedload(Notification.event)) \
+                         .filter(Notification.account_id == account_id) \
+                         .filter(Notification.created_at < before) \
+                         .order_by(Notification.created_at.desc(),
+                                   Notification.notification_id.desc()) \
+                         .limit(limit) \
+                         .all()
+        on_read = session.query(Event) \
+                         .join(FanoutJob, FanoutJob.event_id == Event.event_id) \
+                         .join(AccountFollow,
+                               AccountFollow.c.following_id == FanoutJob.account_id) \
+                         .filter(AccountFollow.c.follower_id == account_id) \
+                         .filter(FanoutJob.status == 'on_read') \
+                         .filter(FanoutJob.created_at < before) \
+                         .order_by(FanoutJob.created_at.desc()) \
+                         .limit(limit) \
+                         .all()
+        # Unsaved rows, so reading a popular account's events writes nothing
+        read = [Notification(account_id=account_id, event_id=event.event_id, event=event,
+                             created_at=event.created_at) for event in on_read]
+        merged = heapq.merge(written, read, key=lambda notification: notification.created_at,
+                             reverse=True)
+        return list(islice(merged, limit))
+
+def select_account(account_id=None, account_email=None, account_handle=None, uow=None):
     """Select an account by ID"""
-    with Session(engine) as session:
+    with transaction(uow) as session:
         account = None
         if account_id is not None:
             account = session.query(Account).filter_by(account_id=account_id).first()
@@ -62,7 +358,7 @@ def create_account(account_email, account_name, account_handle):
             or char == '_'):
             raise ValueError('Invalid character found in account handle')
 
-    with Session(engine) as session:
+    with transaction() as session:
         if select_account(account_email=account_email, account_handle=account_handle) is not None:
             raise AssertionError('Account already exists')
         account = Account(
@@ -71,7 +367,7 @@ def create_account(account_email, account_name, account_handle):
             account_email=account_email,
         )
         session.add(account)
-        session.commit()
+        session.flush()
         session.refresh(account)
         return account
 
@@ -82,7 +378,7 @@ def update_account(
 ):
     """Update an account"""
     # pylint: disable=too-many-arguments
-    with Session(engine) as session:
+    with transaction() as session:
         account_updates = {}
         if account_name is not None:
             account = session.query(Account).filter_by(account_name=account_name).first()
@@ -97,21 +393,20 @@ def update_account(
             account_updates['account_email'] = account_email
 
         session.query(Account).filter_by(account_id=account_id).update(account_updates)
-        session.commit()
 
 def delete_account(account_id):
     """Delete an account"""
-    with Session(engine) as session:
+    with transaction() as session:
         account = select_account(account_id=account_id)
         if account is not None:
             session.delete(account)
-            session.commit()
         else:
             raise Exception('Account not found')
 
-def select_photo(photo_id=None, account_id=None, photo_title=None, preview_file_id=None):
+def select_photo(photo_id=None, account_id=None, photo_title=None, preview_file_id=None,
+                 uow=None):
     """Select a photo"""
-    with Session(engine) as session:
+    with transaction(uow) as session:
         if photo_id is not None:
             return session.query(Photo).filter_by(photo_id=photo_id).first()
         if account_id is not None and photo_title is not None:
@@ -127,13 +422,16 @@ def select_photo(photo_id=None, account_id=None, photo_title=None, preview_file_
 def create_photo(account_id, raw_file_id=None, preview_file_id=None,
                  camera_id=None, lens_id=None, photo_title='', photo_text='', aperture=None,
                  flash=None, focal_length=None, iso=None, lens_filter='',
-                 shutter_speed_denominator=None, shutter_speed_numerator=None):
+                 shutter_speed_denominator=None, shutter_speed_numerator=None, uow=None):
     """Create a photo"""
     # pylint: disable=too-many-arguments,too-many-locals
-    with Session(engine) as session:
-        photo = select_photo(account_id=account_id, photo_title=photo_title)
+    with transaction(uow) as session:
+        photo = select_photo(account_id=account_id, photo_title=photo_title, uow=uow)
         if photo is not None:
             raise Exception(f'Photo title in use by account ({photo_title}, {account_id})')
+        if isinstance(flash, str):
+            # form values are strings
+            flash = flash.lower() == 'true'
         photo = Photo(account_id=account_id, camera_id=camera_id, lens_id=lens_id,
                       preview_file_id=preview_file_id, raw_file_id=raw_file_id, flash=flash,
                       photo_title=photo_title, photo_text=photo_text, aperture=aperture,
@@ -141,8 +439,9 @@ def create_photo(account_id, raw_file_id=None, preview_file_id=None,
                       shutter_speed_denominator=shutter_speed_denominator,
                       shutter_speed_numerator=shutter_speed_numerator)
         session.add(photo)
-        session.commit()
+        session.flush()
         session.refresh(photo)
+        create_event('submit_photo', account_id, photo=photo, uow=uow)
         return photo
 
 def update_photo(
@@ -156,22 +455,20 @@ def update_photo(
         'shutter_speed_denominator', 'shutter_speed_numerator'
     ]
     photo_updates = {k: v for k, v in property_overrides.items() if k in photo_property_list}
-    with Session(engine) as session:
+    with transaction() as session:
         session.query(Photo).filter_by(photo_id=photo_id).update(photo_updates)
-        session.commit()
 
 def delete_photo(photo_id):
     """Delete a photo"""
-    with Session(engine) as session:
+    with transaction() as session:
         photo = select_photo(photo_id=photo_id)
         if photo is None:
             raise Exception('Photo not found')
         session.delete(photo)
-        session.commit()
 
-def select_edit(edit_id=None, photo_id=None, account_id=None, edit_title=None):
+def select_edit(edit_id=None, photo_id=None, account_id=None, edit_title=None, uow=None):
     """Select an edit"""
-    with Session(engine) as session:
+    with transaction(uow) as session:
         if edit_id is not None:
             return session.query(Edit).filter_by(edit_id=edit_id).first()
         if photo_id is not None and \
@@ -199,9 +496,8 @@ def create_edit(
 ):
     """Create an edit"""
     # pylint: disable=too-many-arguments
-    with Session(engine) as session:
+    with transaction() as session:
         edit = select_edit(
-            engine,
             photo_id=photo_id,
             account_id=account_id,
             edit_title=edit_title
@@ -224,8 +520,9 @@ def create_edit(
             edit_height=edit_height
         )
         session.add(edit)
-        session.commit()
+        session.flush()
         session.refresh(edit)
+        create_event('submit_edit', account_id, edit=edit)
         return edit
 
 def update_edit(
@@ -247,22 +544,20 @@ def update_edit(
         'edit_height'
     ]
     edit_updates = {k: v for k, v in property_overrides if k in edit_property_list}
-    with Session(engine) as session:
+    with transaction() as session:
         session.query(Edit).filter_by(edit_id=edit_id).update(edit_updates)
-        session.commit()
 
 def delete_edit(edit_id):
     """Delete an edit"""
-    with Session(engine) as session:
+    with transaction() as session:
         edit = select_edit(edit_id=edit_id)
         if edit is None:
             raise Exception(f'Edit not found ({edit_id})')
         session.delete(edit)
-        session.commit()
 
 def select_reply(reply_id):
     """Select a reply"""
-    with Session(engine) as session:
+    with transaction() as session:
         if reply_id is not None:
             return session.query(Reply).filter_by(reply_id=reply_id).first()
         return None
@@ -274,38 +569,37 @@ def create_reply(
     edit_id=None
 ):
     """Create a reply"""
-    with Session(engine) as session:
+    with transaction() as session:
         reply = Reply(
             account_id=account_id,
             reply_text=reply_text,
-            photo_id=photo_id,
-            edit_id=edit_id
+            photo=select_photo(photo_id=photo_id),
+            edit=select_edit(edit_id=edit_id)
         )
         session.add(reply)
-        session.commit()
+        session.flush()
         session.refresh(reply)
+        create_event('submit_reply', account_id, reply=reply)
         return reply
 
 def update_reply(reply_id, **property_overrides):
     """Update a reply"""
-    with Session(engine) as session:
+    with transaction() as session:
         reply_property_list = ['reply_text']
         reply_updates = {k: v for k, v in property_overrides if k in reply_property_list}
         session.query(Reply).filter_by(reply_id=reply_id).update(reply_updates)
-        session.commit()
 
 def delete_reply(reply_id):
     """Delete a reply"""
-    with Session(engine) as session:
+    with transaction() as session:
         reply = select_reply(reply_id=reply_id)
         if reply is None:
             raise Exception(f'Reply not found ({reply_id})')
         session.delete(reply)
-        session.commit()
 
 def select_reaction(reaction_id):
     """Select an reaction"""
-    with Session(engine) as session:
+    with transaction() as session:
         if reaction_id is not None:
             return session.query(Reaction).filter_by(reaction_id=reaction_id).first()
         return None
@@ -317,7 +611,7 @@ def create_reaction(
     reaction_reply_id=None
 ):
     """Create an reaction"""
-    with Session(engine) as session:
+    with transaction() as session:
         reaction = Reaction(
             account_id=account_id,
             reaction_photo_id=reaction_photo_id,
@@ -325,95 +619,148 @@ def create_reaction(
             reaction_reply_id=reaction_reply_id
         )
         session.add(reaction)
-        session.commit()
+        session.flush()
         session.refresh(reaction)
         return reaction
 
 def delete_reaction(reaction_id):
     """Delete an reaction"""
-    with Session(engine) as session:
+    with transaction() as session:
         reaction = select_reaction(reaction_id=reaction_id)
         if reaction is None:
             raise Exception(f'Reaction not found ({reaction_id})')
         session.delete(reaction)
-        session.commit()
+
+def create_reactions(reactions, uow=None):
+    """Create any reactions that don't exist yet, returning the ids of all of them"""
+    with transaction(uow) as session:
+        return insert_rows(session, Reaction.__table__,
+                           [{'reaction_name': reaction['reaction_name'],
+                             'reaction_emoji': reaction.get('reaction_emoji')}
+                            for reaction in reactions],
+                           ['reaction_name'], Reaction.reaction_id)
+
+def attach_photo_reactions(account_id, photo_id, reaction_ids, uow=None):
+    """React to a photo in many ways from one account"""
+    with transaction(uow) as session:
+        link_rows(session, PhotoReaction, [
+            {'account_id': account_id, 'photo_id': photo_id, 'reaction_id': reaction_id}
+            for reaction_id in reaction_ids
+        ])
 
 def select_file(file_id):
     """Select a file"""
-    with Session(engine) as session:
+    with transaction() as session:
         if file_id is not None:
             return session.query(File).filter_by(file_id=file_id).first()
         return None
 
 def create_file(file_path=None, file_name=None,
                 file_extension=None, file_size=0,
-                image_width=None, image_height=None):
+                image_width=None, image_height=None, file_status='ready', uow=None):
     """Create a file"""
-    with Session(engine) as session:
+    # pylint: disable=too-many-arguments
+    with transaction(uow) as session:
         file = File(file_path=file_path, file_name=file_name, file_extension=file_extension,
-                    file_size=file_size, image_width=image_width, image_height=image_height)
+                    file_size=file_size, image_width=image_width, image_height=image_height,
+                    file_status=file_status)
         session.add(file)
-        session.commit()
+        session.flush()
         session.refresh(file)
         return file
 
+def update_file(file_id, uow=None, **property_overrides):
+    """Update a file"""
+    with transaction(uow) as session:
+        file_property_list = [
+            'file_path',
+            'file_size',
+            'file_status',
+            'image_width',
+            'image_height'
+        ]
+        file_updates = {k: v for k, v in property_overrides.items() if k in file_property_list}
+        session.query(File).filter_by(file_id=file_id).update(file_updates)
+
+def create_file_renditions(file_id, renditions, uow=None):
+    """Create the renditions of a file"""
+    with transaction(uow) as session:
+        session.add_all([FileRendition(file_id=file_id, **rendition) for rendition in renditions])
+
 def delete_file(file_id):
     """Delete a file"""
-    with Session(engine) as session:
+    with transaction() as session:
         file = select_file(file_id)
         if file is None:
             raise Exception(f'File not found ({file_id})')
         session.delete(file)
-        session.commit()
 
 def select_tag(tag_id):
     """Select a tag"""
-    with Session(engine) as session:
+    with transaction() as session:
         if tag_id is not None:
             return session.query(Tag).filter_by(tag_id=tag_id).first()
         return None
 
 def create_tag(tag_name):
     """Create a tag"""
-    with Session(engine) as session:
+    with transaction() as session:
         tag = Tag(tag_name=tag_name)
         session.add(tag)
-        session.commit()
+        session.flush()
         session.refresh(tag)
         return tag
 
 def delete_tag(tag_id):
     """Delete a tag"""
-    with Session(engine) as session:
+    with transaction() as session:
         tag = select_tag(tag_id=tag_id)
         if tag is None:
             raise Exception(f'Tag not found ({tag_id})')
         session.delete(tag)
-        session.commit()
+
+def create_tags(tag_names, uow=None):
+    """Create any tags that don't exist yet, returning the ids of all of them"""
+    with transaction(uow) as session:
+        return insert_rows(session, Tag.__table__,
+                           [{'tag_name': tag_name} for tag_name in tag_names],
+                           ['tag_name'], Tag.tag_id)
+
+def attach_photo_tags(photo_id, tag_ids, uow=None):
+    """Tag a photo with many tags"""
+    with transaction(uow) as session:
+        link_rows(session, PhotoTag, [{'photo_id': photo_id, 'tag_id': tag_id}
+                                      for tag_id in tag_ids])
+
+def attach_edit_tags(edit_id, tag_ids, uow=None):
+    """Tag an edit with many tags"""
+    with transaction(uow) as session:
+        link_rows(session, EditTag, [{'edit_id': edit_id, 'tag_id': tag_id}
+                                     for tag_id in tag_ids])
 
 def select_editor(editor_id):
     """Select an editor"""
-    with Session(engine) as session:
+    with transaction() as session:
         if editor_id is not None:
             return session.query(Editor).filter_by(editor_id=editor_id).first()
         return None
 
 def create_editor(editor_name, editor_version=None, editor_platform=None):
     """Create an editor"""
-    with Session(engine) as session:
+    with transaction() as session:
         editor = Editor(
             editor_name=editor_name,
             editor_version=editor_version,
             editor_platform=editor_platform
         )
         session.add(editor)
-        session.commit()
+        session.flush()
         session.refresh(editor)
         return editor
 
 def update_editor(editor_id, **property_overrides):
     """Update an editor"""
-    with Session(engine) as session:
+    with transaction() as session:
         editor_property_list = [
             'editor_name',
             'editor_version',
@@ -421,56 +768,65 @@ def update_editor(editor_id, **property_overrides):
         ]
         editor_updates = {k: v for k, v in property_overrides if k in editor_property_list}
         session.query(Editor).filter_by(editor_id=editor_id).update(editor_updates)
-        session.commit()
 
 def delete_editor(editor_id):
     """Delete an editor"""
-    with Session(engine) as session:
+    with transaction() as session:
         editor = select_editor(editor_id=editor_id)
         if editor is None:
             raise Exception(f'Editor not found ({editor_id})')
         session.delete(editor)
-        session.commit()
 
 def select_camera(camera_id):
     """Select a camera"""
-    with Session(engine) as session:
+    with transaction() as session:
         if camera_id is not None:
             return session.query(Camera).filter_by(camera_id=camera_id).first()
         return None
 
 def create_camera(manufacturer_id, camera_model):
     """Create a camera"""
-    with Session(engine) as session:
+    with transaction() as session:
         camera = Camera(
             manufacturer_id=manufacturer_id,
             camera_model=camera_model
         )
         session.add(camera)
-        session.commit()
+        session.flush()
         session.refresh(camera)
         return camera
 
 def update_camera(camera_id, **property_overrides):
     """Update a camera"""
-    with Session(engine) as session:
+    with transaction() as session:
         camera_property_list = ['manufacturer_id', 'camera_model']
         camera_updates = {k: v for k, v in property_overrides if k in camera_property_list}
         session.query(Camera).filter_by(camera_id=camera_id).update(camera_updates)
-        session.commit()
+    catalog.invalidate()
 
 def delete_camera(camera_id):
     """Delete a camera"""
-    with Session(engine) as session:
+    with transaction() as session:
         camera = select_camera(camera_id=camera_id)
         if camera is None:
             raise Exception(f'Camera not found ({camera_id})')
         session.delete(camera)
-        session.commit()
+    catalog.invalidate()
+
+def create_cameras(cameras, uow=None):
+    """Create any cameras that don't exist yet, returning the ids of all of them"""
+    with transaction(uow) as session:
+        camera_ids = insert_rows(session, Camera.__table__,
+                                 [{'manufacturer_id': int(camera['manufacturer_id']),
+                                   'camera_model': camera['camera_model']}
+                                  for camera in cameras],
+                                 ['camera_model', 'manufacturer_id'], Camera.camera_id)
+    catalog.invalidate()
+    return camera_ids
 
 def select_lens(lens_id):
     """Select a lens"""
-    with Session(engine) as session:
+    with transaction() as session:
         if lens_id is not None:
             return session.query(Lens).filter_by(lens_id=lens_id).first()
         return None
@@ -485,7 +841,7 @@ def create_lens(
 ):
     """Create a lens"""
     # pylint: disable=too-many-arguments
-    with Session(engine) as session:
+    with transaction() as session:
         lens = Lens(
             manufacturer_id=manufacturer_id,
             lens_model=lens_model,
@@ -495,13 +851,13 @@ def create_lens(
             focal_length_max=focal_length_max
         )
         session.add(lens)
-        session.commit()
+        session.flush()
         session.refresh(lens)
         return lens
 
 def update_lens(lens_id, **property_overrides):
     """Update a lens"""
-    with Session(engine) as session:
+    with transaction() as session:
         lens_property_list = [
             'manufacturer_id',
             'lens_model',
@@ -512,20 +868,33 @@ def update_lens(lens_id, **property_overrides):
         ]
         lens_updates = {k: v for k, v in property_overrides if k in lens_property_list}
         session.query(Lens).filter_by(lens_id=lens_id).update(lens_updates)
-        session.commit()
+    catalog.invalidate()
 
 def delete_lens(lens_id):
     """Delete a lens"""
-    with Session(engine) as session:
+    with transaction() as session:
         lens = select_lens(lens_id=lens_id)
         if lens is None:
             raise Exception(f'Lens not found ({lens_id})')
         session.delete(lens)
-        session.commit()
+    catalog.invalidate()
+
+def create_lenses(lenses, uow=None):
+    """Create any lenses that don't exist yet, returning the ids of all of them"""
+    lens_property_list = ['aperture_min', 'aperture_max', 'focal_length_min', 'focal_length_max']
+    with transaction(uow) as session:
+        lens_ids = insert_rows(session, Lens.__table__,
+                               [{'manufacturer_id': int(lens['manufacturer_id']),
+                                 'lens_model': lens['lens_model'],
+                                 **{k: lens.get(k) for k in lens_property_list}}
+                                for lens in lenses],
+                               ['lens_model', 'manufacturer_id'], Lens.lens_id)
+    catalog.invalidate()
+    return lens_ids
 
 def select_manufacturer(manufacturer_id=None, manufacturer_name=None):
     """Select a manufacturer"""
-    with Session(engine) as session:
+    with transaction() as session:
         if manufacturer_id is not None:
             return session.query(Manufacturer) \
                           .filter_by(manufacturer_id=manufacturer_id) \
@@ -538,16 +907,16 @@ def select_manufacturer(manufacturer_id=None, manufacturer_name=None):
 
 def create_manufacturer(manufacturer_name):
     """Create a manufacturer"""
-    with Session(engine) as session:
+    with transaction() as session:
         manufacturer = Manufacturer(manufacturer_name=manufacturer_name)
         session.add(manufacturer)
-        session.commit()
+        session.flush()
         session.refresh(manufacturer)
         return manufacturer
 
 def update_manufacturer(manufacturer_id, **property_overrides):
     """Update a manufacturer"""
-    with Session(engine) as session:
+    with transaction() as session:
         manufacturer_property_list = ['manufacturer_name']
         manufacturer_updates = {
             k: v for k, v in property_overrides if k in manufacturer_property_list
@@ -555,13 +924,23 @@ def update_manufacturer(manufacturer_id, **property_overrides):
         session.query(Manufacturer) \
                .filter_by(manufacturer_id=manufacturer_id) \
                .update(manufacturer_updates)
-        session.commit()
+    catalog.invalidate()
 
 def delete_manufacturer(manufacturer_id):
     """Delete a manufacturer"""
-    with Session(engine) as session:
-        manufacturer = select_manufacturer(engine, manufacturer_id=manufacturer_id)
+    with transaction() as session:
+        manufacturer = select_manufacturer(manufacturer_id=manufacturer_id)
         if manufacturer is None:
             raise Exception(f'Manufacturer not found ({manufacturer_id})')
         session.delete(manufacturer)
-        session.commit()
+    catalog.invalidate()
+
+def create_manufacturers(manufacturer_names, uow=None):
+    """Create any manufacturers that don't exist yet, returning the ids of all of them"""
+    with transaction(uow) as session:
+        manufacturer_ids = insert_rows(session, Manufacturer.__table__,
+                                       [{'manufacturer_name': manufacturer_name}
+                                        for manufacturer_name in manufacturer_names],
+                                       ['manufacturer_name'], Manufacturer.manufacturer_id)
+    catalog.invalidate()
+    return manufacturer_ids
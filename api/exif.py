@@ -0,0 +1,166 @@
+"""
+EXIF metadata extraction from raw files and JPEG previews
+
+Only the EXIF headers are parsed, through an mmap, so reading metadata from a
+multi-hundred megabyte raw file touches a few kilobytes of it. Values are
+returned under the same names as the photo form fields that clients send,
+as strings like form values except for flash, which is a bool.
+"""
+
+import mmap
+import struct
+from rawpreview import RAF_MAGIC
+from tiff import TiffError, TiffReader
+
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_EXPOSURE_TIME = 0x829A
+TAG_F_NUMBER = 0x829D
+TAG_ISO = 0x8827
+TAG_FLASH = 0x9209
+TAG_FOCAL_LENGTH = 0x920A
+TAG_LENS_SPECIFICATION = 0xA432
+TAG_LENS_MAKE = 0xA433
+TAG_LENS_MODEL = 0xA434
+
+# MakerNote style suffixes that shouldn't end up in manufacturer names
+MAKE_SUFFIXES = (' CORPORATION', ' CORP.', ' IMAGING CORP.', ' COMPANY, LTD.', ' CO., LTD.')
+
+def find_jpeg_exif(buffer, offset=0):
+    """Return the offset of the TIFF header in a JPEG's APP1 Exif segment, or None"""
+    if buffer[offset:offset + 2] != b'\xff\xd8':
+        return None
+    position = offset + 2
+    while position + 4 <= len(buffer):
+        if buffer[position] != 0xFF:
+            return None
+        marker = buffer[position + 1]
+        if marker in (0xD9, 0xDA): # end of image or start of scan, no more headers
+            return None
+        segment_length, = struct.unpack('>H', buffer[position + 2:position + 4])
+        if marker == 0xE1 and buffer[position + 4:position + 10] == b'Exif\0\0':
+            return position + 10
+        position += 2 + segment_length
+    return None
+
+def find_tiff_header(buffer):
+    """Return the offset of the TIFF structure holding a file's EXIF tags, or None"""
+    if buffer[:2] in (b'II', b'MM'):
+        return 0
+    if buffer[:len(RAF_MAGIC)] == RAF_MAGIC and len(buffer) >= 92:
+        # RAF files keep their EXIF in the embedded JPEG
+        jpeg_offset, = struct.unpack('>L', buffer[84:88])
+        return find_jpeg_exif(buffer, jpeg_offset)
+    return find_jpeg_exif(buffer)
+
+def clean_make(make):
+    """Trim a camera or lens maker's name as written by the camera"""
+    upper = make.upper()
+    for suffix in MAKE_SUFFIXES:
+        if upper.endswith(suffix):
+            make = make[:-len(suffix)]
+            break
+    return make.strip()
+
+def read_tags(buffer):
+    """Return a dict of tag -> Entry, taking each tag from the first IFD that has it"""
+    base = find_tiff_header(buffer)
+    if base is None:
+        return {}
+    tags = {}
+    for entries in TiffReader(buffer, base).walk():
+        for tag, entry in entries.items():
+            tags.setdefault(tag, entry)
+    return tags
+
+def format_number(number):
+    """Format floats without a trailing .0, like form values"""
+    return str(int(number)) if float(number).is_integer() else str(round(number, 2))
+
+def tag_text(tags, tag):
+    """Return a tag's text, or None if it is missing or empty"""
+    value = tags[tag].value() if tag in tags else None
+    return value if isinstance(value, str) and value else None
+
+def read_equipment(tags, metadata):
+    """Read the camera and lens names"""
+    if tag_text(tags, TAG_MAKE):
+        metadata['camera_manufacturer_name'] = clean_make(tag_text(tags, TAG_MAKE))
+    if tag_text(tags, TAG_MODEL):
+        metadata['camera_model'] = tag_text(tags, TAG_MODEL)
+    if tag_text(tags, TAG_LENS_MAKE):
+        metadata['lens_manufacturer_name'] = clean_make(tag_text(tags, TAG_LENS_MAKE))
+    if tag_text(tags, TAG_LENS_MODEL):
+        metadata['lens_model'] = tag_text(tags, TAG_LENS_MODEL)
+        if 'lens_manufacturer_name' not in metadata and 'camera_manufacturer_name' in metadata:
+            metadata['lens_manufacturer_name'] = metadata['camera_manufacturer_name']
+
+def read_lens_specification(tags, metadata):
+    """Read the lens' focal length and aperture ranges"""
+    if TAG_LENS_SPECIFICATION in tags and tags[TAG_LENS_SPECIFICATION].count == 4:
+        focal_min, focal_max, aperture_wide, aperture_tele = \
+            tags[TAG_LENS_SPECIFICATION].values()
+        if focal_min:
+            metadata['lens_focal_length_min'] = format_number(focal_min)
+        if focal_max:
+            metadata['lens_focal_length_max'] = format_number(focal_max)
+        apertures = [a for a in (aperture_wide, aperture_tele) if a]
+        if apertures:
+            metadata['lens_aperture_min'] = format_number(min(apertures))
+            metadata['lens_aperture_max'] = format_number(max(apertures))
+
+def read_shutter_speed(tags, metadata):
+    """Read the exposure time as a fraction"""
+    if TAG_EXPOSURE_TIME in tags and tags[TAG_EXPOSURE_TIME].count > 0:
+        numerator, denominator = tags[TAG_EXPOSURE_TIME].rationals()[0]
+        if numerator and denominator:
+            metadata['shutter_speed_numerator'] = str(numerator)
+            metadata['shutter_speed_denominator'] = str(denominator)
+
+def read_number(tag, prop):
+    """Return a reader of a numeric tag into a metadata field"""
+    def read(tags, metadata):
+        if tag in tags and tags[tag].value():
+            metadata[prop] = format_number(tags[tag].value())
+    read.__name__ = f'read_{prop}'
+    return read
+
+def read_flash(tags, metadata):
+    """Read whether the flash fired, from bit 0 of the Flash tag"""
+    if TAG_FLASH in tags and tags[TAG_FLASH].count > 0:
+        metadata['flash'] = bool(tags[TAG_FLASH].value() & 1)
+
+# Each reader fills in a few fields, and is skipped alone if its tags are malformed
+FIELD_READERS = (read_equipment, read_lens_specification, read_shutter_speed,
+                 read_number(TAG_F_NUMBER, 'aperture'), read_number(TAG_ISO, 'iso'),
+                 read_number(TAG_FOCAL_LENGTH, 'focal_length'), read_flash)
+FIELD_ERRORS = (TiffError, struct.error, TypeError, IndexError, ValueError)
+
+def read_metadata_from_buffer(buffer):
+    """Read photo metadata from the EXIF tags in a buffer"""
+    metadata = {}
+    tags = read_tags(buffer)
+    for read in FIELD_READERS:
+        try:
+            read(tags, metadata)
+        except FIELD_ERRORS as err:
+            print(f'Could not read {read.__name__}:', str(err))
+    return metadata
+
+def read_metadata(file_path):
+    """Read photo metadata from a raw file or image, returning {} if it has none"""
+    with open(file_path, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return {}
+        try:
+            return read_metadata_from_buffer(buffer)
+        except FIELD_ERRORS as err:
+            print(f'Could not read metadata ({file_path}):', str(err))
+            return {}
+        finally:
+            try:
+                buffer.close()
+            except BufferError:
+                pass # an Entry still holds a view, the map is freed with it
@@ -0,0 +1,55 @@
+"""
+Local stand-in for SendGrid's mail send endpoint, for testing the outbox offline
+
+Run it and point the API at it:
+    python fake_sendgrid.py 8025
+    SENDGRID_API_URL=http://localhost:8025 python app.py
+
+Set FAKE_SENDGRID_FAILURE_RATE (0-1) to answer a share of requests with 503
+and FAKE_SENDGRID_LATENCY (seconds) to slow responses down.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAILURE_RATE = float(os.environ.get('FAKE_SENDGRID_FAILURE_RATE', 0))
+LATENCY = float(os.environ.get('FAKE_SENDGRID_LATENCY', 0))
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive like the real API
+    requests = 0
+    messages = 0
+
+    def do_POST(self):
+        # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if LATENCY:
+            time.sleep(LATENCY)
+        if self.path != '/v3/mail/send':
+            self.reply(404)
+            return
+        if random.random() < FAILURE_RATE:
+            self.reply(503)
+            return
+        message = json.loads(body)
+        FakeSendGridHandler.requests += 1
+        FakeSendGridHandler.messages += len(message['personalizations'])
+        self.reply(202)
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        print(f'{self.requests} requests, {self.messages} messages |', format % args)
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+    print(f'Fake SendGrid listening on http://localhost:{port}')
+    ThreadingHTTPServer(('0.0.0.0', port), FakeSendGridHandler).serve_forever()
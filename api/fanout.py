@@ -0,0 +1,176 @@
+"""
+Follower notification fan-out
+
+create_event queues a fanout_job row in the same transaction as the event,
+so posting costs one extra insert however many followers the creator has.
+A background thread in each worker process then claims queued jobs and
+writes one notification per follower:
+- follower ids are streamed with a server-side cursor, in follower_id order
+  along the (following_id, follower_id) index;
+- notifications are written chunk_size at a time with one multi-row
+  INSERT ... ON CONFLICT DO NOTHING on (account_id, event_id), so a job that
+  is retried never notifies anyone twice;
+- each transaction covers at most slice_size followers and records the last
+  one in the job, so big jobs commit as they go and resume after a crash.
+
+Jobs are claimed with FOR UPDATE SKIP LOCKED, so every worker can run the
+fan-out without two of them writing the same job. A job that raises, for
+example when a follower is deleted mid-slice, is rolled back to a savepoint
+and retried later with exponential backoff, so it can't block the queue.
+
+Creators with at least on_read_threshold followers are fanned out on read
+instead: their jobs are marked 'on_read' and select_notifications in db.py
+merges their events into each follower's notifications.
+
+Options, set with the "fanout" object in config.json:
+- on_read_threshold: followers above which a creator is fanned out on read
+- chunk_size:        notifications per INSERT statement
+- slice_size:        followers per transaction
+- poll_interval:     seconds between checks for new jobs when the queue is empty
+- max_attempts:      attempts before a job that keeps raising is marked 'failed'
+- retry_base_delay:  seconds before a failed job is retried, doubled on each attempt
+- retry_max_delay:   upper bound for the retry delay
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from db import db_session, transaction
+from model import TEXT_LONG, AccountFollow, Event, FanoutJob, Notification
+from utils import load_config
+
+FANOUT_DEFAULTS = {
+    'on_read_threshold': 10000,
+    'chunk_size': 1000,
+    'slice_size': 50000,
+    'poll_interval': 1,
+    'max_attempts': 10,
+    'retry_base_delay': 5,
+    'retry_max_delay': 3600,
+}
+
+def claim_job(session):
+    """Lock the oldest due job that no other worker holds, or return None"""
+    return session.query(FanoutJob) \
+                  .filter(FanoutJob.status == 'queued') \
+                  .filter(FanoutJob.next_attempt_at <= datetime.now()) \
+                  .order_by(FanoutJob.fanout_job_id) \
+                  .with_for_update(skip_locked=True) \
+                  .first()
+
+def count_followers(session, account_id):
+    """Count the followers of an account"""
+    return session.query(func.count()) \
+                  .select_from(AccountFollow) \
+                  .filter(AccountFollow.c.following_id == account_id) \
+                  .scalar()
+
+def stream_followers(session, job, limit, chunk_size):
+    """Yield chunks of the next follower ids of a job's creator from a server-side cursor"""
+    result = session.connection() \
+                    .execution_options(stream_results=True, max_row_buffer=chunk_size) \
+                    .execute(select(AccountFollow.c.follower_id)
+                             .where(AccountFollow.c.following_id == job.account_id)
+                             .where(AccountFollow.c.follower_id > job.after_follower_id)
+                             .order_by(AccountFollow.c.follower_id)
+                             .limit(limit))
+    for rows in result.partitions(chunk_size):
+        yield [follower_id for (follower_id,) in rows]
+
+def notify_followers(session, job, follower_ids, created_at):
+    """Write one notification of a job's event per follower, skipping existing ones"""
+    session.execute(
+        insert(Notification.__table__)
+            .values([{'account_id': follower_id, 'event_id': job.event_id,
+                      'created_at': created_at} for follower_id in follower_ids])
+            .on_conflict_do_nothing(index_elements=['account_id', 'event_id'])
+    )
+
+def advance_job(session, job, options):
+    """Notify the next slice of a job's followers, returning how many were notified"""
+    if job.follower_count is None:
+        job.follower_count = count_followers(session, job.account_id)
+        if job.follower_count >= options['on_read_threshold']:
+            job.status = 'on_read'
+            return 0
+    created_at = session.query(Event.created_at) \
+                        .filter(Event.event_id == job.event_id) \
+                        .scalar()
+    notified = 0
+    for follower_ids in stream_followers(session, job, options['slice_size'],
+                                         options['chunk_size']):
+        notify_followers(session, job, follower_ids, created_at)
+        job.after_follower_id = follower_ids[-1]
+        notified += len(follower_ids)
+    if notified < options['slice_size']:
+        job.status = 'done'
+    return notified
+
+def record_failure(job, err, options):
+    """Put a job that raised back in the queue after a delay, or give up on it"""
+    job.attempts += 1
+    job.last_error = str(err)[:TEXT_LONG]
+    if job.attempts >= options['max_attempts']:
+        job.status = 'failed'
+        return
+    delay = min(options['retry_max_delay'], options['retry_base_delay'] * 2 ** (job.attempts - 1))
+    job.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+
+def fan_out(options=None):
+    """
+    Advance the oldest due job by one slice of followers, returning how many
+    followers were notified, or None when there was no job to run
+
+    The slice runs in a savepoint, so a job that raises is rescheduled in the
+    same transaction and can't hold up the jobs queued after it.
+    """
+    options = {**FANOUT_DEFAULTS, **(options or load_config().get('fanout', {}))}
+    with transaction() as session:
+        job = claim_job(session)
+        if job is None:
+            return None
+        try:
+            with session.begin_nested():
+                return advance_job(session, job, options)
+        except Exception as err:
+            print(f'Fan-out job {job.fanout_job_id} failed:\n', err)
+            record_failure(job, err, options)
+            return 0
+
+class FanoutWorker:
+    """Background thread that runs queued fan-out jobs in one worker process"""
+    def __init__(self):
+        self.worker = None
+        self.worker_pid = None
+        self.wakeup = threading.Event()
+        self.counters = {'slices': 0, 'notified': 0, 'errors': 0}
+
+    def run(self):
+        """Worker loop, runs jobs until the process exits"""
+        while True:
+            options = {**FANOUT_DEFAULTS, **load_config().get('fanout', {})}
+            try:
+                notified = fan_out(options)
+                if notified is not None:
+                    self.counters['slices'] += 1
+                    self.counters['notified'] += notified
+                    continue
+            except Exception as err:
+                self.counters['errors'] += 1
+                print('Fan-out worker error:\n', err)
+            finally:
+                db_session.remove()
+            self.wakeup.wait(options['poll_interval'])
+            self.wakeup.clear()
+
+    def start(self):
+        """Start the worker thread for this process, if it isn't running already"""
+        if self.worker is not None and self.worker_pid == os.getpid() and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self.run, name='fanout', daemon=True)
+        self.worker_pid = os.getpid()
+        self.worker.start()
+
+fanout_worker = FanoutWorker()
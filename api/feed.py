@@ -0,0 +1,196 @@
+"""
+Global feed builder
+
+Applies the selection rules in the Event model's docstring to new events
+and appends the ones it accepts to the feed_item table, which the feed
+GraphQL field pages through by id. The rules look back over the last few
+accepted items, which would be an unbounded scan per request, so they are
+applied once here instead:
+- an event is skipped if its creator has an item in the last account_window items;
+- otherwise photos are always accepted;
+- edits are accepted if their photo has no item in the last edit_photo_window items;
+- replies are accepted if their photo has no item in the last reply_photo_window items.
+
+The windows are a ring buffer of the newest accepted items plus maps of
+the position each creator and photo was last seen at, trimmed as items
+fall out of the ring. They are restored from the tail of feed_item at the
+start of every run, so any worker can pick up where another left off. A
+background thread in each worker runs the builder every build_interval
+seconds, and a transaction-scoped advisory lock keeps runs from
+overlapping.
+
+Events are read in the order of the transactions that inserted them, by
+(created_xid, event_id), and only from transactions older than the oldest
+one still running on Postgres. Event ids are taken when a row is inserted
+but only become visible at commit, so a transaction that commits after an
+event with a higher id would be skipped for good by a cursor on event_id;
+no transaction older than the snapshot's xmin can still commit, and every
+newer one gets a higher transaction id, so the cursor never passes an
+event that can still appear.
+"""
+
+import os
+import threading
+from collections import deque
+from sqlalchemy import func, text, tuple_
+from sqlalchemy.orm import aliased
+from db import db_session, transaction
+from model import (Edit, EditEvent, EditReply, Event, FeedCursor, FeedItem, PhotoEvent,
+                   PhotoReply, ReplyEvent)
+from utils import load_config
+
+FEED_DEFAULTS = {
+    'account_window': 5,
+    'edit_photo_window': 10,
+    'reply_photo_window': 20,
+    'batch_size': 500,
+    'build_interval': 5,
+}
+FEED_LOCK_KEY = 0x66656564 # advisory lock held while building, 'feed' in ASCII
+
+class FeedWindows:
+    """Who and which photos appeared in the newest accepted feed items"""
+    def __init__(self, account_window, edit_photo_window, reply_photo_window):
+        self.account_window = account_window
+        self.edit_photo_window = edit_photo_window
+        self.reply_photo_window = reply_photo_window
+        self.ring = deque(maxlen=max(account_window, edit_photo_window, reply_photo_window))
+        self.account_seen_at = {}
+        self.photo_seen_at = {}
+        self.position = 0
+
+    def seen(self, seen_at, key, window):
+        """Check whether a key was seen in the last window items"""
+        return key in seen_at and self.position - seen_at[key] < window
+
+    def accepts(self, event_type, account_id, photo_id):
+        """Apply the selection rules to an event"""
+        if self.seen(self.account_seen_at, account_id, self.account_window):
+            return False
+        if event_type == 'submit_photo':
+            return True
+        if event_type == 'submit_edit':
+            return not self.seen(self.photo_seen_at, photo_id, self.edit_photo_window)
+        if event_type == 'submit_reply':
+            return not self.seen(self.photo_seen_at, photo_id, self.reply_photo_window)
+        return False
+
+    def append(self, account_id, photo_id):
+        """Record an accepted item, forgetting the one that falls out of the ring"""
+        if len(self.ring) == self.ring.maxlen:
+            position, old_account_id, old_photo_id = self.ring[0]
+            if self.account_seen_at.get(old_account_id) == position:
+                del self.account_seen_at[old_account_id]
+            if self.photo_seen_at.get(old_photo_id) == position:
+                del self.photo_seen_at[old_photo_id]
+        self.position += 1
+        self.ring.append((self.position, account_id, photo_id))
+        self.account_seen_at[account_id] = self.position
+        if photo_id is not None:
+            self.photo_seen_at[photo_id] = self.position
+
+def load_windows(session, options):
+    """Restore the windows from the newest feed items"""
+    windows = FeedWindows(options['account_window'], options['edit_photo_window'],
+                          options['reply_photo_window'])
+    newest = session.query(FeedItem.account_id, FeedItem.photo_id) \
+                    .order_by(FeedItem.feed_item_id.desc()) \
+                    .limit(windows.ring.maxlen) \
+                    .all()
+    for account_id, photo_id in reversed(newest):
+        windows.append(account_id, photo_id)
+    return windows
+
+def new_events(session, after, before_xid, limit):
+    """
+    Select the next events after a (created_xid, event_id) cursor with the photo each
+    one is about, from transactions older than before_xid if there is one
+    """
+    reply_edit = aliased(Edit)
+    photo_id = func.coalesce(PhotoEvent.c.photo_id, Edit.photo_id, PhotoReply.c.photo_id,
+                             reply_edit.photo_id)
+    query = session.query(Event.created_xid, Event.event_id, Event.event_type,
+                          Event.account_id, photo_id) \
+                   .outerjoin(PhotoEvent, PhotoEvent.c.event_id == Event.event_id) \
+                   .outerjoin(EditEvent, EditEvent.c.event_id == Event.event_id) \
+                   .outerjoin(Edit, Edit.edit_id == EditEvent.c.edit_id) \
+                   .outerjoin(ReplyEvent, ReplyEvent.c.event_id == Event.event_id) \
+                   .outerjoin(PhotoReply, PhotoReply.c.reply_id == ReplyEvent.c.reply_id) \
+                   .outerjoin(EditReply, EditReply.c.reply_id == ReplyEvent.c.reply_id) \
+                   .outerjoin(reply_edit, reply_edit.edit_id == EditReply.c.edit_id) \
+                   .filter(tuple_(Event.created_xid, Event.event_id) > tuple_(*after))
+    if before_xid is not None:
+        query = query.filter(Event.created_xid < before_xid)
+    return query.order_by(Event.created_xid, Event.event_id) \
+                .limit(limit) \
+                .all()
+
+def snapshot_xmin(session):
+    """Return the oldest transaction still running on Postgres, or None elsewhere"""
+    if session.get_bind().dialect.name != 'postgresql':
+        return None
+    return session.execute(text('SELECT txid_snapshot_xmin(txid_current_snapshot())')).scalar()
+
+def try_lock(session):
+    """Take the feed builder's lock until the transaction ends, if no one else has it"""
+    if session.get_bind().dialect.name != 'postgresql':
+        return True
+    return session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'),
+                           {'key': FEED_LOCK_KEY}).scalar()
+
+def build_feed(options=None):
+    """Consider one batch of new events, returning how many were considered"""
+    options = {**FEED_DEFAULTS, **(options or load_config().get('feed', {}))}
+    with transaction() as session:
+        if not try_lock(session):
+            return 0
+        cursor = session.query(FeedCursor).get(1)
+        if cursor is None:
+            cursor = FeedCursor(feed_cursor_id=1, created_xid=0, event_id=0)
+            session.add(cursor)
+        windows = load_windows(session, options)
+        events = new_events(session, (cursor.created_xid, cursor.event_id),
+                            snapshot_xmin(session), options['batch_size'])
+        for _, event_id, event_type, account_id, photo_id in events:
+            if windows.accepts(event_type, account_id, photo_id):
+                windows.append(account_id, photo_id)
+                session.add(FeedItem(event_id=event_id, account_id=account_id,
+                                     photo_id=photo_id))
+        if events:
+            cursor.created_xid, cursor.event_id = events[-1][:2]
+        return len(events)
+
+class FeedBuilder:
+    """Background thread that keeps the feed up to date in one worker process"""
+    def __init__(self):
+        self.worker = None
+        self.worker_pid = None
+        self.wakeup = threading.Event()
+        self.counters = {'runs': 0, 'events': 0}
+
+    def run(self):
+        """Worker loop, builds until the process exits"""
+        while True:
+            options = {**FEED_DEFAULTS, **load_config().get('feed', {})}
+            try:
+                considered = build_feed(options)
+                self.counters['runs'] += 1
+                self.counters['events'] += considered
+                if considered == options['batch_size']:
+                    continue
+            except Exception as err:
+                print('Feed builder error:\n', err)
+            finally:
+                db_session.remove()
+            self.wakeup.wait(options['build_interval'])
+            self.wakeup.clear()
+
+    def start(self):
+        """Start the worker thread for this process, if it isn't running already"""
+        if self.worker is not None and self.worker_pid == os.getpid() and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self.run, name='feed', daemon=True)
+        self.worker_pid = os.getpid()
+        self.worker.start()
+
+feed_builder = FeedBuilder()
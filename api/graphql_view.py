@@ -0,0 +1,199 @@
+"""GraphQL endpoint"""
+
+import hashlib
+import json
+from urllib.parse import unquote
+from flask import Response, g, request
+from flask_graphql import GraphQLView
+from graphene import relay
+from graphql import GraphQLError
+from graphql.type import GraphQLList, get_named_type, get_nullable_type
+from graphql_server import HttpQueryError, default_format_error, get_graphql_params
+from promise import is_thenable
+from sqlalchemy import inspect
+from db import db_session, select_account
+from loaders import Loaders
+from persisted_queries import PersistedQueryError, document_hash, persisted_queries
+from planner import field_nodes
+from query_limits import LimitedBackend, clamp_page_size, document_fragments, operation_for
+from response_cache import entity_tags, response_cache
+from session import get_session
+from singleflight import SingleFlight
+from utils import load_config
+
+# Root fields whose results depend on who is asking, not only on their role
+VIEWER_FIELDS = frozenset(['timeline'])
+
+# Identical queries running at the same time in this worker share one execution
+single_flight = SingleFlight(load_config().get('graphql_coalesce_max_wait', 2))
+
+def result_table(return_type):
+    """
+    Return the table behind a field's GraphQL type, or None if it isn't a model,
+    and whether the field resolves to a list of its rows
+    """
+    graphene_type = getattr(get_named_type(return_type), 'graphene_type', None)
+    if isinstance(graphene_type, type) and issubclass(graphene_type, relay.Connection):
+        return inspect(graphene_type._meta.node._meta.model).local_table.name, True
+    model = getattr(getattr(graphene_type, '_meta', None), 'model', None)
+    if model is None:
+        return None, False
+    return inspect(model).local_table.name, isinstance(get_nullable_type(return_type), GraphQLList)
+
+def collect_cache_tags(next_resolver, root, info, **args):
+    """Graphene middleware that tags the request's response with the rows it read"""
+    result = next_resolver(root, info, **args)
+    tags = info.context.get('cache_tags') if isinstance(info.context, dict) else None
+    if tags is None:
+        return result
+    table, is_list = result_table(info.return_type)
+    if table is None:
+        return result
+    def tag(value):
+        if is_list or value is None:
+            tags.add(table)
+        else:
+            tags.update(entity_tags(value))
+        return value
+    if is_thenable(result):
+        return result.then(tag)
+    return tag(result)
+
+def request_token():
+    """Read the session token of the request, if it has one"""
+    if 'token' in request.cookies:
+        return unquote(request.cookies.get('token'))
+    if 'Authorization' in request.headers:
+        return request.headers.get('authorization').replace('Basic ', '')
+    return None
+
+def viewer_account():
+    """Return the account of the request's session, or None, looking it up once per request"""
+    if 'graphql_viewer' not in g:
+        token = request_token()
+        session = get_session(token) if token is not None else None
+        g.graphql_viewer = select_account(account_email=session['account_email']) \
+                           if session is not None else None
+    return g.graphql_viewer
+
+def viewer_role():
+    """Return the account role of the request's session, or 'anonymous'"""
+    account = viewer_account()
+    return account.account_role if account is not None else 'anonymous'
+
+class FocalGraphQLView(GraphQLView):
+    """
+    GraphQLView with a fresh context for every request, limits on what queries
+    can cost, a response cache and request coalescing
+    """
+    backend = LimitedBackend(load_config().get('graphql_document_cache_size', 256))
+    middleware = [clamp_page_size, collect_cache_tags]
+
+    def get_context(self):
+        """Give each request its database session, DataLoaders and viewer lookup"""
+        session = db_session()
+        g.graphql_context = {
+            'request': request,
+            'session': session,
+            'loaders': Loaders(session),
+            'cache_tags': set(),
+            'viewer': viewer_account,
+        }
+        return g.graphql_context
+
+    @staticmethod
+    def format_error(error):
+        """Format an error, remembering that the response shouldn't be cached"""
+        g.graphql_errors = True
+        return default_format_error(error)
+
+    def dispatch_request(self):
+        """
+        Serve repeated queries from the response cache, and run identical concurrent
+        queries only once
+        """
+        plan = self.cache_plan()
+        if plan is None:
+            return super().dispatch_request()
+        key, ttl = plan
+        if ttl > 0:
+            body = response_cache.get(key)
+            if body is not None:
+                return Response(body, status=200, content_type='application/json',
+                                headers={'X-Cache': 'HIT'})
+        (body, status), coalesced = single_flight.do(key, lambda: self.run_query(key, ttl))
+        return Response(body, status=status, content_type='application/json',
+                        headers={'X-Cache': 'COALESCED' if coalesced else 'MISS'})
+
+    def run_query(self, key, ttl):
+        """Run a query, caching its response if it succeeds, and return its body and status"""
+        purge_count = response_cache.purge_count() if ttl > 0 else None
+        response = super().dispatch_request()
+        body = response.get_data(as_text=True)
+        if ttl > 0 and response.status_code == 200 and not g.get('graphql_errors'):
+            response_cache.put(key, body, g.graphql_context['cache_tags'], ttl, purge_count)
+        return body, response.status_code
+
+    def cache_plan(self):
+        """
+        Return the key and response cache TTL of a query request, or None for other
+        requests, where a TTL of 0 means the response isn't cached
+        """
+        if request.method not in ('GET', 'POST') \
+           or (request.method == 'GET' and self.should_display_graphiql()):
+            return None
+        try:
+            data = self.parse_body()
+            if not isinstance(data, dict):
+                return None
+            params = get_graphql_params(data, request.args)
+            if not params.query:
+                return None
+            document = self.get_backend().document_from_string(self.schema, params.query)
+        except (HttpQueryError, GraphQLError):
+            return None
+        operation = operation_for(document.document_ast, params.operation_name)
+        if operation is None or operation.operation != 'query':
+            return None
+        options = load_config('response_cache')
+        fragments = document_fragments(document.document_ast)
+        names = {field.name.value
+                 for field in field_nodes(operation.selection_set.selections, fragments)}
+        ttl = min(options['ttls'].get(name, options['default_ttl']) for name in names)
+        viewer = viewer_account() if names & VIEWER_FIELDS else None
+        key = hashlib.sha256(json.dumps([
+            document_hash(params.query),
+            params.variables,
+            params.operation_name,
+            viewer_role(),
+            viewer.account_id if viewer is not None else None,
+            bool(self.pretty or request.args.get('pretty')),
+        ], sort_keys=True, default=str).encode()).hexdigest()
+        return key, ttl
+
+    def parse_body(self):
+        """Read the request body once per request"""
+        if 'graphql_body' not in g:
+            g.graphql_body = self.read_body()
+        return g.graphql_body
+
+    def read_body(self):
+        """Fill in the query of requests that only send a persisted query's hash"""
+        data = super().parse_body()
+        if not isinstance(data, dict) and hasattr(data, 'to_dict'):
+            data = data.to_dict()
+        if not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions') or request.args.get('extensions')
+        if not extensions:
+            return data
+        try:
+            if isinstance(extensions, str):
+                extensions = json.loads(extensions)
+            query = persisted_queries.resolve(extensions,
+                                              data.get('query') or request.args.get('query'))
+        except (ValueError, AttributeError) as err:
+            raise HttpQueryError(400, 'Extensions are invalid JSON.') from err
+        except PersistedQueryError as err:
+            raise HttpQueryError(400, str(err)) from err
+        return dict(data, query=query)
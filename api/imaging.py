@@ -0,0 +1,151 @@
+"""
+Image processing worker pool
+
+Pillow work is CPU bound and can take seconds for large uploads, so it runs
+in a pool of worker processes instead of the request thread. The upload
+endpoint records a File row with file_status 'pending' and returns; when a
+job finishes the row is updated with the image's dimensions and size and
+marked 'ready' (or 'failed').
+
+Each preview also gets a ladder of smaller renditions (preview_rendition_widths)
+in every format in preview_rendition_formats, for srcset. Renditions are
+named by the hash of their contents.
+
+Every API worker process has its own pool, so the machine runs image_workers
+processes per API worker. When image_workers is null each pool gets the
+cores divided by the number of uWSGI workers, at least one.
+"""
+
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from utils import create_digest, load_config, worker_processes
+
+def image_format(extension):
+    """Return Pillow's format name for a file extension"""
+    return Image.registered_extensions()[f'.{extension.lower()}']
+
+def write_atomic(file_path, data):
+    """Write data to a temporary file first, so a partially written image is never served"""
+    partial_path = f'{file_path}.part'
+    with open(partial_path, 'wb') as f:
+        f.write(data)
+    os.replace(partial_path, file_path)
+
+def encode(image, extension):
+    """Encode an image in the format for a file extension"""
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format(extension))
+    return buffer.getvalue()
+
+def render_renditions(image, directory, widths, formats):
+    """
+    Write a rendition of image for every width and format
+
+    Widths bound the longest edge and widths beyond the image's own size are
+    skipped. Each rendition is resized from the previous, larger one, which
+    is much cheaper than resizing the full image every time.
+    """
+    renditions = []
+    for width in sorted(widths, reverse=True):
+        if width >= max(image.size) and renditions:
+            continue
+        image = image.copy()
+        image.thumbnail((width, width))
+        for extension in formats:
+            data = encode(image, extension)
+            digest = create_digest()
+            digest.update(data)
+            file_path = os.path.join(directory, f'{digest.hexdigest()}.{extension}')
+            if not os.path.exists(file_path):
+                write_atomic(file_path, data)
+            renditions.append({
+                'file_path': file_path,
+                'file_extension': extension,
+                'file_size': len(data),
+                'image_width': image.size[0],
+                'image_height': image.size[1],
+            })
+    return renditions
+
+def render_preview(source_path, file_path, size, widths=(), formats=()):
+    """
+    Write a preview of source_path to file_path no larger than size, plus its renditions
+
+    Runs in a worker process.
+    """
+    with Image.open(source_path) as image:
+        image.thumbnail(size)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        write_atomic(file_path, encode(image, os.path.splitext(file_path)[1][1:]))
+        return {
+            'image_width': image.size[0],
+            'image_height': image.size[1],
+            'file_size': os.stat(file_path).st_size,
+            'renditions': render_renditions(image, os.path.dirname(file_path), widths, formats),
+        }
+
+class ImagePool:
+    """Process pool owning all Pillow work for one API worker"""
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        """Return this process's executor, starting a new one after a fork"""
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                self.pid = os.getpid()
+            return self.executor
+
+    def submit_preview(self, file_id, source_path, file_path, size, on_done,
+                       widths=(), formats=()):
+        """
+        Queue a preview job, including its renditions
+
+        on_done(file_id, result) is called from a background thread with the
+        render_preview result, or with None if the job failed. The source
+        file is removed either way.
+        """
+        # pylint: disable=too-many-arguments
+        future = self.get_executor().submit(render_preview, source_path, file_path, size,
+                                            widths, formats)
+        def done(future):
+            result = None
+            try:
+                result = future.result()
+            except Exception as err: # pylint: disable=broad-except
+                print(f'Could not render preview ({file_path}):', str(err))
+            finally:
+                if os.path.exists(source_path):
+                    os.remove(source_path)
+            on_done(file_id, result)
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the pool, waiting for queued jobs by default"""
+        if self.executor is not None and self.pid == os.getpid():
+            self.executor.shutdown(wait=wait)
+        self.executor = None
+
+def default_workers():
+    """Split the cores between the API worker processes, since each one has a pool"""
+    return max(1, (os.cpu_count() or 1) // worker_processes())
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_image_pool():
+    """Return the image pool sized by the image_workers config value"""
+    global _pool # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None:
+            _pool = ImagePool(load_config().get('image_workers') or default_workers())
+        return _pool
@@ -0,0 +1,81 @@
+"""
+Single pass ingestion of uploaded files
+
+Werkzeug asks the request for a stream to write each uploaded file part
+into while it parses the multipart body. IngestRequest hands it a
+HashingSpool, which writes the part to a temporary file on the storage
+volume and updates the file's digest as the bytes go by. Once the form has
+been parsed the upload's content address is already known and storing it
+is a rename on the same filesystem, so the body is only read once and never
+held in memory.
+"""
+
+import os
+import tempfile
+from flask import Request
+from utils import create_digest, load_config
+
+class HashingSpool:
+    """Writable and readable temporary file that digests everything written to it"""
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = create_digest()
+        self.size = 0
+        self.stored_path = None
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        """Return the hex digest of everything written so far"""
+        return self.digest.hexdigest()
+
+    def store(self, file_path):
+        """
+        Give the spooled file its permanent path without copying it
+
+        Raises FileExistsError instead of replacing a file already stored at
+        that path, since content addressed files only exist once.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        os.link(self.path, file_path)
+        os.remove(self.path)
+        self.path = self.stored_path = file_path
+        return file_path
+
+    def close(self):
+        """Close the file, deleting it unless it was stored"""
+        if not self.file.closed:
+            self.file.close()
+        if self.stored_path is None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # read, readline, seek, tell, etc. come from the underlying file
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception: # pylint: disable=broad-except
+            pass
+
+class IngestRequest(Request):
+    """Flask request that spools uploaded files through HashingSpool"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return HashingSpool(load_config('file_storage_path'))
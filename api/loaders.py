@@ -0,0 +1,115 @@
+"""
+Per-request DataLoaders for GraphQL relationship fields
+
+Left alone, graphene-sqlalchemy resolves a relationship with a lazy load
+for every parent row, so a page of 50 photos that selects each photo's
+account and preview costs 100 extra queries. BatchedObjectType gives every
+relationship of a model a resolver that goes through a DataLoader instead.
+Keys requested while a level of the result is resolved are collected and
+loaded with one IN (...) query per relationship.
+
+Loaders live in the GraphQL context, which graphql_view.py creates for
+every request, so results are never shared between requests or accounts.
+"""
+
+from collections import defaultdict
+from graphene_sqlalchemy import SQLAlchemyObjectType
+from promise import Promise
+from promise.dataloader import DataLoader
+from sqlalchemy import inspect
+from sqlalchemy.orm.interfaces import MANYTOMANY
+from db import db_session
+from planner import column_keys, local_column, only_columns, selection_names
+
+class RelationshipLoader(DataLoader):
+    """Load one relationship for many parent keys at once, optionally only some columns"""
+    def __init__(self, relationship, session, columns=None):
+        super().__init__()
+        self.relationship = relationship
+        self.session = session
+        self.columns = columns
+
+    def batch_load_fn(self, keys): # pylint: disable=method-hidden
+        relationship = self.relationship
+        target = relationship.mapper.class_
+        if relationship.direction == MANYTOMANY:
+            ((_, parent_column),) = relationship.synchronize_pairs
+            ((target_column, secondary_column),) = relationship.secondary_synchronize_pairs
+            query = self.session.query(target, parent_column) \
+                                .join(relationship.secondary, target_column == secondary_column) \
+                                .filter(parent_column.in_(keys))
+        else:
+            ((_, remote_column),) = relationship.local_remote_pairs
+            query = self.session.query(target, remote_column).filter(remote_column.in_(keys))
+        if self.columns is not None:
+            query = query.options(only_columns(target, self.columns))
+        if relationship.order_by:
+            query = query.order_by(*relationship.order_by)
+        found = defaultdict(list)
+        for row, key in query:
+            found[key].append(row)
+        if relationship.uselist:
+            return Promise.resolve([found[key] for key in keys])
+        return Promise.resolve([found[key][0] if found[key] else None for key in keys])
+
+class Loaders:
+    """The RelationshipLoaders of one request"""
+    def __init__(self, session=None):
+        self.session = session or db_session()
+        self.loaders = {}
+
+    def load(self, relationship, parent, columns=None):
+        """
+        Return a promise of a parent's related row, or list of rows, loading only
+        the given column keys of the related rows if any are given
+        """
+        key = parent_key(relationship, parent)
+        if key is None:
+            return Promise.resolve([] if relationship.uselist else None)
+        # rows selected with different columns on different paths get their own loader
+        loader_key = (relationship, columns)
+        if loader_key not in self.loaders:
+            self.loaders[loader_key] = RelationshipLoader(relationship, self.session, columns)
+        return self.loaders[loader_key].load(key)
+
+def parent_key(relationship, parent):
+    """Return the value a relationship joins on from its parent row"""
+    prop = inspect(parent).mapper.get_property_by_column(local_column(relationship))
+    return getattr(parent, prop.key)
+
+def get_loaders(context):
+    """Return the Loaders of a GraphQL context, or None outside of one"""
+    if isinstance(context, dict):
+        return context.get('loaders')
+    return None
+
+def batched_resolver(relationship):
+    """Create a resolver that loads a relationship through the request's DataLoader"""
+    def resolve(root, info, **kwargs):
+        # pylint: disable=unused-argument
+        loaders = get_loaders(info.context)
+        if loaders is None:
+            return getattr(root, relationship.key)
+        columns = column_keys(relationship.mapper.class_, selection_names(info))
+        return loaders.load(relationship, root, columns)
+    return resolve
+
+def is_batchable(relationship):
+    """Check a relationship joins on a single column, which is all the loaders handle"""
+    if relationship.direction == MANYTOMANY:
+        return len(relationship.synchronize_pairs) == 1 \
+               and len(relationship.secondary_synchronize_pairs) == 1
+    return len(relationship.local_remote_pairs) == 1
+
+class BatchedObjectType(SQLAlchemyObjectType):
+    """SQLAlchemyObjectType whose relationship fields are resolved through DataLoaders"""
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def __init_subclass_with_meta__(cls, model=None, **options):
+        for relationship in inspect(model).relationships:
+            resolver_name = f'resolve_{relationship.key}'
+            if not hasattr(cls, resolver_name) and is_batchable(relationship):
+                setattr(cls, resolver_name, staticmethod(batched_resolver(relationship)))
+        super().__init_subclass_with_meta__(model=model, **options)
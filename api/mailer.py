@@ -1,26 +1,95 @@
+import http.client
+import json
 import os
+import threading
 import urllib
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-
-# TODO: limit sends per day to 100 (SendGrid's limited free plan)
-# TODO: do not retry sending to failed emails more than X times
+from urllib.parse import urlsplit
 
 ORIGIN = 'http://local.pics:8080' if os.environ.get('FLASK_ENV') == 'development' \
          else 'https://focal.pics'
 
+SENDGRID_API_URL = os.environ.get('SENDGRID_API_URL', 'https://api.sendgrid.com')
+FROM_EMAIL = {'email': 'mailer@focal.pics', 'name': 'Focal.pics'}
+
+class SendGridError(Exception):
+    """A message was refused by SendGrid"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self):
+        """Rate limiting, server errors and connection failures are worth retrying"""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+class SendGridClient:
+    """
+    Client for SendGrid's v3 mail send endpoint
+
+    Each thread keeps one keep-alive connection open instead of connecting
+    for every message. Set SENDGRID_API_URL to send to a local fake endpoint.
+    """
+    def __init__(self, api_key=None, api_url=SENDGRID_API_URL, timeout=10):
+        self.api_key = api_key or os.environ.get('SENDGRID_API_KEY')
+        self.url = urlsplit(api_url)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        """Return this thread's connection, opening it if needed"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self.url.scheme == 'https' \
+                         else http.client.HTTPConnection
+            conn = conn_class(self.url.hostname, self.url.port, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self.local.conn = None
+
+    def send(self, template_id, personalizations):
+        """
+        Send a template to a batch of recipients in one request
+
+        Each personalization is a pair of (to_email, dynamic_template_data).
+        """
+        body = json.dumps({
+            'from': FROM_EMAIL,
+            'template_id': template_id,
+            'personalizations': [
+                {'to': [{'email': to_email}], 'dynamic_template_data': data}
+                for to_email, data in personalizations
+            ],
+        })
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive',
+        }
+        try:
+            conn = self.connection()
+            conn.request('POST', '/v3/mail/send', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError) as err:
+            self.close()
+            raise SendGridError(f'Could not reach SendGrid ({err})') from err
+        if response.will_close:
+            self.close()
+        if not 200 <= response.status <= 299:
+            raise SendGridError(f'Message was refused (status: {response.status})',
+                                response.status)
+
 def sendMessageWithTemplate(to_emails, template_id, data={}):
-    message = Mail(
-        from_email=('mailer@focal.pics', 'Focal.pics'),
-        to_emails=to_emails,
-    )
-    message.template_id = template_id
-    message.dynamic_template_data = data
-    sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-    response = sg.send(message)
-    if not (200 <= response.status_code <= 299):
-        raise ValueError(f'Message was refused for emails "{to_emails}" '
-                         f'(status: {response.status_code})')
+    """Queue a template message, it is sent by the outbox worker"""
+    # pylint: disable=dangerous-default-value,import-outside-toplevel
+    from outbox import get_outbox
+    return get_outbox().enqueue(to_emails, template_id, data)
 
 def sendSignInMagicLink(email, token):
     if not 1 < email.index('@') < len(email) - 1:
@@ -41,4 +110,3 @@ def sendDeleteAccountMagicLink(email, token):
         template_id=os.environ.get('DELETE_ACCOUNT_SENDGRID_TEMPLATE_ID'),
         data={ 'magic_link': f'{ORIGIN}/magic?delete=true&token={urllib.parse.quote(token)}' }
     )
-
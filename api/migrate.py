@@ -0,0 +1,173 @@
+"""
+Schema upgrades and query plan checks for an existing database
+
+Base.metadata.create_all creates missing tables with their indexes, but
+never alters tables that already exist. Run this after deploying a change
+to model.py to add new columns and build new indexes without locking
+writes:
+
+    python migrate.py          # upgrade the schema
+    python migrate.py check    # EXPLAIN every GraphQL list and connection query
+
+Indexes are built with CREATE INDEX CONCURRENTLY, which can't run inside a
+transaction, so every statement here runs in autocommit mode. A concurrent
+build that fails leaves an invalid index behind; those are dropped and
+rebuilt on the next run.
+"""
+
+import json
+import re
+import sys
+from sqlalchemy import Enum, event, inspect, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from graphene import List
+from db import engine, db_session
+from model import Account, Base
+from schema import Query
+
+# Catalog tables that stay small enough for sequential scans to be cheap
+SMALL_TABLES = frozenset(['reaction', 'tag', 'manufacturer', 'camera', 'lens', 'editor',
+                          'flag', 'ban'])
+
+def add_missing_columns(conn):
+    """Add columns declared in model.py that existing tables don't have yet"""
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if isinstance(column.type, Enum):
+                column.type.create(conn, checkfirst=True)
+            column_spec = str(CreateColumn(column).compile(dialect=conn.dialect))
+            if not column.nullable and column.default is not None \
+               and column.server_default is None:
+                # existing rows need a value before NOT NULL can hold
+                if column.default.is_scalar:
+                    column_spec += f" DEFAULT '{column.default.arg}'"
+                elif column.default.is_clause_element:
+                    column_spec += f' DEFAULT {column.default.arg.compile(dialect=conn.dialect)}'
+            print(f'Adding column {table.name}.{column.name}')
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column_spec}'))
+
+def drop_invalid_indexes(conn, index_names):
+    """Drop indexes left invalid by a failed concurrent build"""
+    invalid_indexes = conn.execute(text(
+        'SELECT class.relname FROM pg_index JOIN pg_class class ON class.oid = indexrelid '
+        'WHERE NOT indisvalid AND class.relname = ANY(:names)'
+    ), {'names': list(index_names)}).scalars().all()
+    for index_name in invalid_indexes:
+        print(f'Dropping invalid index {index_name}')
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}'))
+
+def create_indexes(conn):
+    """Build every index declared in model.py that doesn't exist yet"""
+    indexes = [index for table in Base.metadata.sorted_tables for index in table.indexes]
+    drop_invalid_indexes(conn, [index.name for index in indexes])
+    for index in indexes:
+        statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+        statement = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', statement)
+        print(f'Creating index {index.name}')
+        conn.execute(text(statement))
+
+def upgrade():
+    """Bring an existing database up to date with model.py"""
+    Base.metadata.create_all(engine)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        add_missing_columns(conn)
+        create_indexes(conn)
+
+class PlanInfo:
+    """
+    Just enough of a GraphQL ResolveInfo to call the list resolvers, selecting no
+    fields, as the first account for fields that need a viewer
+    """
+    def __init__(self, session):
+        viewer = session.query(Account).order_by(Account.account_id).first()
+        self.context = {'session': session,
+                        'viewer': lambda: viewer or Account(account_id=0)}
+        self.field_asts = []
+        self.fragments = {}
+
+def seq_scans(plan):
+    """List the relations a query plan reads with sequential scans"""
+    relations = []
+    if plan.get('Node Type') == 'Seq Scan':
+        relations.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        relations += seq_scans(child)
+    return relations
+
+def capture_statements(conn, fn):
+    """Call fn and return the SQL statements and parameters it executed on conn"""
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        statements.append((statement, parameters))
+    event.listen(conn, 'before_cursor_execute', capture)
+    try:
+        fn()
+    finally:
+        event.remove(conn, 'before_cursor_execute', capture)
+    return statements
+
+def list_statements(session):
+    """
+    Yield the name of every GraphQL list and connection field with the statements
+    its resolver runs, including the seek of a connection's second page if there is one
+    """
+    info = PlanInfo(session)
+    conn = session.connection()
+    for name, field in Query._meta.fields.items():
+        resolver = getattr(Query, f'resolve_{name}')
+        if isinstance(field.type, List):
+            yield name, capture_statements(conn, lambda: list(resolver(None, info)))
+        elif name.endswith('_connection'):
+            pages = []
+            statements = capture_statements(conn, lambda: pages.append(resolver(None, info)))
+            end_cursor = pages[0].page_info.end_cursor
+            if end_cursor is not None:
+                statements += capture_statements(conn, lambda: resolver(None, info,
+                                                                        after=end_cursor))
+            yield name, statements
+
+def check_plans():
+    """
+    EXPLAIN the queries of every GraphQL list and connection field and report
+    sequential scans of tables outside SMALL_TABLES, returning the number of
+    failing fields
+
+    Sequential scans are disabled while planning so that a small test database
+    still shows whether an index can serve each query.
+    """
+    failures = 0
+    session = db_session()
+    try:
+        session.execute(text('SET LOCAL enable_seqscan = off'))
+        conn = session.connection()
+        for name, statements in list_statements(session):
+            tables = set()
+            for statement, parameters in statements:
+                plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement,
+                                            parameters).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                tables.update(table for table in seq_scans(plan[0]['Plan'])
+                              if table not in SMALL_TABLES)
+            if tables:
+                failures += 1
+                print(f'FAIL {name}: sequential scan of {", ".join(sorted(tables))}')
+            else:
+                print(f'ok   {name}')
+    finally:
+        session.rollback()
+        db_session.remove()
+    return failures
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        sys.exit(1 if check_plans() > 0 else 0)
+    upgrade()
@@ -1,11 +1,11 @@
 """Database schema"""
 # pylint: disable=too-few-public-methods
 
-from sqlalchemy import (Boolean, CheckConstraint, Column, DateTime, Enum, Float, ForeignKey,
-    Identity, Integer, String, Table, UniqueConstraint)
+from sqlalchemy import (BigInteger, Boolean, CheckConstraint, Column, DateTime, Enum, Float,
+    ForeignKey, Identity, Index, Integer, String, Table, UniqueConstraint)
 from sqlalchemy.sql.functions import now
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import backref, relationship
 
 Base = declarative_base()
 
@@ -14,6 +14,8 @@ ContentType = Enum('photo', 'edit', 'reply', name='content_type')
 EventType   = Enum('submit_photo', 'submit_edit', 'submit_reply', 'submit_reaction', 'follow',
                    name='event_type')
 Platform    = Enum('Android', 'iOS', 'Linux', 'macOS', 'Windows', name='platform')
+FileStatus  = Enum('pending', 'ready', 'failed', name='file_status')
+FanoutStatus = Enum('queued', 'done', 'on_read', 'failed', name='fanout_status')
 
 AccountIdentity      = Identity('Account',      start= 100, cycle=True)
 PhotoIdentity        = Identity('Photo',        start= 200, cycle=True)
@@ -31,6 +33,9 @@ EventIdentity        = Identity('Event',        start=1300, cycle=True)
 NotificationIdentity = Identity('Notification', start=1400, cycle=True)
 FlagIdentity         = Identity('Flag',         start=1500, cycle=True)
 BanIdentity          = Identity('Ban',          start=1600, cycle=True)
+RenditionIdentity    = Identity('Rendition',    start=1700, cycle=True)
+FeedItemIdentity     = Identity('FeedItem',     start=1800, cycle=True)
+FanoutJobIdentity    = Identity('FanoutJob',    start=1900, cycle=True)
 
 TEXT_SHORT     =   32
 TEXT_MEDIUM    =  100
@@ -47,7 +52,8 @@ AccountFollow = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('following_id', ForeignKey('account.account_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_account_follow_following_id_follower_id', 'following_id', 'follower_id'))
 
 """Which accounts are blocking which other accounts"""
 AccountBlock = Table(
@@ -57,7 +63,8 @@ AccountBlock = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('blocked_id', ForeignKey('account.account_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_account_block_blocked_id', 'blocked_id'))
 
 """Which accounts have which bans applied to them"""
 AccountBan = Table(
@@ -67,7 +74,8 @@ AccountBan = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('ban_id', ForeignKey('ban.ban_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_account_ban_ban_id', 'ban_id'))
 
 """Which tags have been applied to which photos"""
 PhotoTag = Table(
@@ -76,7 +84,8 @@ PhotoTag = Table(
     Column('photo_id', ForeignKey('photo.photo_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('tag_id', ForeignKey('tag.tag_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_photo_tag_tag_id', 'tag_id'))
 
 """Which tags have been applied to which edits"""
 EditTag = Table(
@@ -85,7 +94,8 @@ EditTag = Table(
     Column('edit_id', ForeignKey('edit.edit_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('tag_id', ForeignKey('tag.tag_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_edit_tag_tag_id', 'tag_id'))
 
 """Which replies are to which photos"""
 PhotoReply = Table(
@@ -94,7 +104,8 @@ PhotoReply = Table(
     Column('photo_id', Integer, ForeignKey('photo.photo_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('reply_id', Integer, ForeignKey('reply.reply_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_photo_reply_reply_id', 'reply_id'))
 
 """Which replies are to which edits"""
 EditReply = Table(
@@ -103,7 +114,8 @@ EditReply = Table(
     Column('edit_id', Integer, ForeignKey('edit.edit_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('reply_id', Integer, ForeignKey('reply.reply_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_edit_reply_reply_id', 'reply_id'))
 
 """Which accounts have reacted in which way to which photos"""
 PhotoReaction = Table(
@@ -115,7 +127,8 @@ PhotoReaction = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('photo_id', Integer, ForeignKey('photo.photo_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_photo_reaction_photo_id', 'photo_id'))
 
 """Which accounts have reacted in which way to which edits"""
 EditReaction = Table(
@@ -127,7 +140,8 @@ EditReaction = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('edit_id', Integer, ForeignKey('edit.edit_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_edit_reaction_edit_id', 'edit_id'))
 
 """Which accounts have reacted in which way to which replies"""
 ReplyReaction = Table(
@@ -139,7 +153,8 @@ ReplyReaction = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('reply_id', Integer, ForeignKey('reply.reply_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_reply_reaction_reply_id', 'reply_id'))
 
 """Which photos are related to which events"""
 PhotoEvent = Table(
@@ -148,7 +163,8 @@ PhotoEvent = Table(
     Column('photo_id', Integer, ForeignKey('photo.photo_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('event_id', Integer, ForeignKey('event.event_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_photo_event_event_id', 'event_id'))
 
 """Which edits are related to which events"""
 EditEvent = Table(
@@ -157,7 +173,8 @@ EditEvent = Table(
     Column('edit_id', Integer, ForeignKey('edit.edit_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('event_id', Integer, ForeignKey('event.event_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_edit_event_event_id', 'event_id'))
 
 """Which replies are related to which events"""
 ReplyEvent = Table(
@@ -166,7 +183,8 @@ ReplyEvent = Table(
     Column('reply_id', Integer, ForeignKey('reply.reply_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
     Column('event_id', Integer, ForeignKey('event.event_id', onupdate='CASCADE',
-           ondelete='CASCADE'), primary_key=True))
+           ondelete='CASCADE'), primary_key=True),
+    Index('ix_reply_event_event_id', 'event_id'))
 
 """Who flagged which accounts"""
 AccountFlag = Table(
@@ -178,7 +196,8 @@ AccountFlag = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('flag_id', ForeignKey('flag.flag_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_account_flag_flagged_account_id', 'flagged_account_id'))
 
 """Who flagged which photos"""
 PhotoFlag = Table(
@@ -190,7 +209,8 @@ PhotoFlag = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('flag_id', ForeignKey('flag.flag_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_photo_flag_photo_id', 'photo_id'))
 
 """Who flagged which edits"""
 EditFlag = Table(
@@ -202,7 +222,8 @@ EditFlag = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('flag_id', ForeignKey('flag.flag_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_edit_flag_edit_id', 'edit_id'))
 
 """Who flagged which replies"""
 ReplyFlag = Table(
@@ -214,7 +235,8 @@ ReplyFlag = Table(
            ondelete='CASCADE'), primary_key=True),
     Column('flag_id', ForeignKey('flag.flag_id', onupdate='CASCADE',
            ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, nullable=False, default=now()))
+    Column('created_at', DateTime, nullable=False, default=now()),
+    Index('ix_reply_flag_reply_id', 'reply_id'))
 
 
 
@@ -234,10 +256,13 @@ class Account(Base):
     created_at = Column(DateTime, nullable=False, default=now())
     edited_at = Column(DateTime, nullable=False, onupdate=now(), default=now())
     CheckConstraint(edited_at >= created_at)
+    Index('ix_account_edited_at', edited_at.desc(), created_at.desc())
+    Index('ix_account_edited_at_id', edited_at.desc(), account_id.desc())
+    Index('ix_account_preview_file_id', preview_file_id)
     preview_file = relationship('File', uselist=False, cascade='all,delete')
     following = relationship('Account', secondary=AccountFollow, backref='followers',
-        primaryjoin=account_id == AccountFollow.c.following_id,
-        secondaryjoin=account_id == AccountFollow.c.follower_id)
+        primaryjoin=account_id == AccountFollow.c.follower_id,
+        secondaryjoin=account_id == AccountFollow.c.following_id)
     blocked = relationship('Account', secondary=AccountBlock, backref='blocked_by',
         primaryjoin=account_id == AccountBlock.c.blocked_id,
         secondaryjoin=account_id == AccountBlock.c.blocker_id)
@@ -279,6 +304,13 @@ class Photo(Base):
     CheckConstraint(shutter_speed_denominator >= 0)
     CheckConstraint(shutter_speed_numerator >= 0)
     CheckConstraint(edited_at >= created_at)
+    Index('ix_photo_edited_at', edited_at.desc(), created_at.desc())
+    Index('ix_photo_edited_at_id', edited_at.desc(), photo_id.desc())
+    Index('ix_photo_account_id', account_id, photo_title)
+    Index('ix_photo_raw_file_id', raw_file_id)
+    Index('ix_photo_preview_file_id', preview_file_id)
+    Index('ix_photo_camera_id', camera_id)
+    Index('ix_photo_lens_id', lens_id)
     account = relationship('Account', backref='photos', uselist=False)
     raw_file = relationship('File', primaryjoin='Photo.raw_file_id == File.file_id',
                             uselist=False, cascade='all,delete')
@@ -311,6 +343,13 @@ class Edit(Base):
     CheckConstraint(sidecar_file_id is not None or preview_id is not None)
     CheckConstraint(edit_title != '' or edit_text != '')
     CheckConstraint(edited_at >= created_at)
+    Index('ix_edit_edited_at', edited_at.desc(), created_at.desc())
+    Index('ix_edit_edited_at_id', edited_at.desc(), edit_id.desc())
+    Index('ix_edit_account_id', account_id)
+    Index('ix_edit_photo_id', photo_id, account_id, edit_title)
+    Index('ix_edit_sidecar_file_id', sidecar_file_id)
+    Index('ix_edit_preview_file_id', preview_file_id)
+    Index('ix_edit_editor_id', editor_id)
     account = relationship('Account', backref='edits', uselist=False)
     sidecar_file = relationship('File', primaryjoin='Edit.sidecar_file_id == File.file_id',
                                 uselist=False, cascade='all,delete')
@@ -333,6 +372,9 @@ class Reply(Base):
     created_at = Column(DateTime, nullable=False, default=now())
     edited_at = Column(DateTime, nullable=False, onupdate=now(), default=now())
     CheckConstraint(edited_at >= created_at)
+    Index('ix_reply_edited_at', edited_at.desc(), created_at.desc())
+    Index('ix_reply_edited_at_id', edited_at.desc(), reply_id.desc())
+    Index('ix_reply_account_id', account_id)
     account = relationship('Account', backref='replies', uselist=False)
     photo = relationship('Photo', secondary=PhotoReply, backref='replies', uselist=False)
     edit = relationship('Edit', secondary=EditReply, backref='replies', uselist=False)
@@ -355,18 +397,48 @@ class Reaction(Base):
     reaction_emoji = Column(String(TEXT_SHORT))
 
 class File(Base):
-    """File table used to track user uploads"""
+    """
+    File table used to track user uploads
+
+    Previews are generated in the background, their rows are 'pending' until
+    the image has been written and its size and dimensions are known
+    """
     __tablename__ = 'file'
     file_id = Column(Integer, FileIdentity, primary_key=True)
     file_path = Column(String, nullable=False, unique=True)
     file_name = Column(String(TEXT_MEDIUM), nullable=False)
     file_extension = Column(String(TEXT_SHORT), nullable=False)
     file_size = Column(Integer, nullable=False)
+    file_status = Column(FileStatus, nullable=False, default='ready')
     created_at = Column(String, nullable=False, default=now())
     image_width = Column(Integer)
     image_height = Column(Integer)
     CheckConstraint(image_width > 0)
     CheckConstraint(image_height > 0)
+    Index('ix_file_created_at_id', created_at.desc(), file_id.desc())
+
+class FileRendition(Base):
+    """
+    Resized copies of a preview image in each configured width and format
+
+    Renditions are named by a hash of their contents so their URLs never
+    change meaning and can be cached forever
+    """
+    __tablename__ = 'file_rendition'
+    rendition_id = Column(Integer, RenditionIdentity, primary_key=True)
+    file_id = Column(Integer, ForeignKey('file.file_id', onupdate='CASCADE',
+                     ondelete='CASCADE'), nullable=False)
+    file_path = Column(String, nullable=False, unique=True)
+    file_extension = Column(String(TEXT_SHORT), nullable=False)
+    file_size = Column(Integer, nullable=False)
+    image_width = Column(Integer, nullable=False)
+    image_height = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=now())
+    CheckConstraint(image_width > 0)
+    CheckConstraint(image_height > 0)
+    Index('ix_file_rendition_file_id', file_id)
+    file = relationship('File', backref=backref('renditions', cascade='all,delete',
+                        order_by='FileRendition.image_width'))
 
 class Tag(Base):
     """Tag table"""
@@ -388,6 +460,7 @@ class Camera(Base):
         onupdate='CASCADE', ondelete='RESTRICT'), nullable=False)
     camera_model = Column(String(TEXT_MEDIUM), nullable=False)
     UniqueConstraint(camera_model, manufacturer_id)
+    Index('ix_camera_manufacturer_id', manufacturer_id)
     manufacturer = relationship('Manufacturer', backref='cameras')
 
 class Lens(Base):
@@ -406,6 +479,7 @@ class Lens(Base):
     CheckConstraint(focal_length_min >= 0)
     CheckConstraint(focal_length_min <= focal_length_max)
     UniqueConstraint(lens_model, manufacturer_id)
+    Index('ix_lens_manufacturer_id', manufacturer_id)
     manufacturer = relationship('Manufacturer', backref='lenses')
 
 class Editor(Base):
@@ -437,12 +511,19 @@ class Event(Base):
               in the last Y events; or,
             * if content is a reply and its photo hasn't appeared in the feed
               in the last Z events
+
+    created_xid is the id of the transaction that inserted the event on
+    Postgres, and 0 elsewhere, see feed.py.
     """
     __tablename__ = 'event'
     event_id = Column(Integer, EventIdentity, primary_key=True)
     event_type = Column(EventType, nullable=False)
     account_id = Column(Integer, ForeignKey('account.account_id'), nullable=False)
     created_at = Column(DateTime, nullable=False, default=now())
+    created_xid = Column(BigInteger, nullable=False, default=0)
+    Index('ix_event_created_at_id', created_at.desc(), event_id.desc())
+    Index('ix_event_created_xid_id', created_xid, event_id)
+    Index('ix_event_account_id', account_id, created_at.desc())
     account = relationship('Account', backref='events', uselist=False)
     photo = relationship('Photo', secondary=PhotoEvent, backref='events', uselist=False,
                          cascade='all,delete', passive_deletes=True)
@@ -451,11 +532,69 @@ class Event(Base):
     reply = relationship('Reply', secondary=ReplyEvent, backref='events', uselist=False,
                          cascade='all,delete', passive_deletes=True)
 
+class FeedItem(Base):
+    """
+    Events accepted into the global feed by the feed builder, in the order it
+    accepted them, see feed.py
+
+    The creator and photo of each event are copied here so the builder can
+    restore its windows from the newest items without joining back to content.
+    """
+    __tablename__ = 'feed_item'
+    feed_item_id = Column(Integer, FeedItemIdentity, primary_key=True)
+    event_id = Column(Integer, ForeignKey('event.event_id', onupdate='CASCADE',
+                      ondelete='CASCADE'), nullable=False, unique=True)
+    account_id = Column(Integer, ForeignKey('account.account_id', onupdate='CASCADE',
+                        ondelete='CASCADE'), nullable=False)
+    photo_id = Column(Integer, ForeignKey('photo.photo_id', onupdate='CASCADE',
+                      ondelete='CASCADE'))
+    created_at = Column(DateTime, nullable=False, default=now())
+    event = relationship('Event', uselist=False)
+
+class FeedCursor(Base):
+    """The last event the feed builder has considered, in a single row"""
+    __tablename__ = 'feed_cursor'
+    feed_cursor_id = Column(Integer, primary_key=True)
+    created_xid = Column(BigInteger, nullable=False, default=0)
+    event_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, onupdate=now(), default=now())
+
+class FanoutJob(Base):
+    """
+    An event whose creator's followers still need notifications, see fanout.py
+
+    after_follower_id is the last follower notified so far, so a job that is
+    interrupted resumes where it left off. Jobs of creators with more
+    followers than the fan-out threshold are marked 'on_read' instead, and
+    their followers read the event when they list their notifications.
+    Jobs that raise are retried from next_attempt_at, and marked 'failed'
+    after max_attempts.
+    """
+    __tablename__ = 'fanout_job'
+    fanout_job_id = Column(Integer, FanoutJobIdentity, primary_key=True)
+    event_id = Column(Integer, ForeignKey('event.event_id', onupdate='CASCADE',
+                      ondelete='CASCADE'), nullable=False, unique=True)
+    account_id = Column(Integer, ForeignKey('account.account_id', onupdate='CASCADE',
+                        ondelete='CASCADE'), nullable=False)
+    status = Column(FanoutStatus, nullable=False, default='queued')
+    follower_count = Column(Integer)
+    after_follower_id = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=now())
+    last_error = Column(String(TEXT_LONG))
+    created_at = Column(DateTime, nullable=False, default=now())
+    updated_at = Column(DateTime, nullable=False, onupdate=now(), default=now())
+    Index('ix_fanout_job_queued', fanout_job_id, postgresql_where=status == 'queued')
+    Index('ix_fanout_job_on_read', account_id, created_at.desc(),
+          postgresql_where=status == 'on_read')
+    event = relationship('Event', uselist=False)
+
 class Notification(Base):
     """
     Who should be notified about which events, and when they viewed them
 
-    Rows are only inserted for the creator's followers at the time of posting
+    Rows are only inserted for the creator's followers at the time of posting,
+    by the fan-out worker, unless the creator has too many followers
     """
     __tablename__ = 'notification'
     notification_id = Column(Integer, NotificationIdentity, primary_key=True)
@@ -466,6 +605,10 @@ class Notification(Base):
     created_at = Column(DateTime, nullable=False, default=now())
     viewed_at = Column(DateTime)
     UniqueConstraint(account_id, event_id)
+    Index('ix_notification_created_at_id', created_at.desc(), notification_id.desc())
+    Index('ix_notification_event_id', event_id)
+    Index('ix_notification_unread', account_id, created_at.desc(),
+          postgresql_where=viewed_at.is_(None))
     account = relationship('Account', backref='notifications', uselist=False,
                            cascade='all,delete', passive_deletes=True)
     event = relationship('Event', uselist=False, cascade='all,delete', passive_deletes=True)
@@ -480,6 +623,7 @@ class Flag(Base):
     flag_name = Column(String(TEXT_SHORT), nullable=False)
     flag_text = Column(String(TEXT_LONG), nullable=False)
     created_at = Column(DateTime, nullable=False, default=now())
+    Index('ix_flag_created_at_id', created_at.desc(), flag_id.desc())
 
 class Ban(Base):
     """
@@ -492,3 +636,4 @@ class Ban(Base):
     expires_at = Column(DateTime)
     ban_name = Column(String(TEXT_SHORT))
     ban_text = Column(String(TEXT_LONG), nullable=False)
+    Index('ix_ban_created_at_id', created_at.desc(), ban_id.desc())
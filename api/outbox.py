@@ -0,0 +1,278 @@
+"""
+Durable outbox for outgoing email
+
+Requests only insert a row into a local SQLite queue and return. A
+background thread in each worker process claims batches of due messages,
+sends each batch in one request over a keep-alive connection, and
+reschedules failures with exponential backoff.
+
+Limits, set with the "mail_outbox" object in config.json:
+- daily_limit:       messages sent per UTC day (SendGrid's free plan allows 100)
+- max_failures:      refusals of an address before its messages are dropped
+- max_attempts:      attempts per message through outages and rate limiting
+- retry_base_delay:  seconds before the first retry, doubled on each attempt
+- retry_max_delay:   upper bound for the retry delay
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from mailer import SendGridClient, SendGridError
+from utils import load_config
+
+OUTBOX_DEFAULTS = {
+    'path': '/tmp/focal/outbox.sqlite3',
+    'daily_limit': 100,
+    'max_failures': 5,
+    'max_attempts': 12,
+    'retry_base_delay': 30,
+    'retry_max_delay': 3600,
+    'batch_size': 50,
+    'poll_interval': 2,
+    'claim_timeout': 120,
+}
+
+def start_of_day(now):
+    """Return the timestamp of the start of the UTC day containing now"""
+    day = datetime.fromtimestamp(now, timezone.utc).replace(hour=0, minute=0, second=0,
+                                                            microsecond=0)
+    return day.timestamp()
+
+class Outbox:
+    """Queue of outgoing messages stored in SQLite and drained by a worker thread"""
+    def __init__(self, path, client=None, **options):
+        self.path = path
+        self.options = {**OUTBOX_DEFAULTS, **options, 'path': path}
+        self.client = client or SendGridClient()
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.worker_pid = None
+        self.counters = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                     'message_id INTEGER PRIMARY KEY, '
+                     'to_email TEXT NOT NULL, '
+                     'template_id TEXT, '
+                     'data TEXT NOT NULL, '
+                     "status TEXT NOT NULL DEFAULT 'queued', "
+                     'attempts INTEGER NOT NULL DEFAULT 0, '
+                     'next_attempt_at REAL NOT NULL, '
+                     'claimed_until REAL, '
+                     'created_at REAL NOT NULL, '
+                     'sent_at REAL, '
+                     'last_error TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS outbox_sent_at ON outbox (sent_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS outbox_address ('
+                     'email TEXT PRIMARY KEY, '
+                     'failures INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID')
+
+    def connect(self):
+        """Return this thread's connection, opening a new one after a fork"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, to_email, template_id, data):
+        """Queue a message to be sent as soon as the worker can"""
+        now = time.time()
+        self.connect().execute('INSERT INTO outbox (to_email, template_id, data, '
+                               'next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                               (to_email.lower(), template_id, json.dumps(data), now, now))
+        self.counters['queued'] += 1
+        self.wakeup.set()
+
+    def claim(self, now=None):
+        """
+        Claim a batch of due messages within the remaining daily budget
+
+        Claimed messages are marked 'sending' until claim_timeout passes, so
+        messages held by a worker that died are picked up again.
+        """
+        now = now or time.time()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            sent_today, = conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE sent_at >= ? OR "
+                "(status = 'sending' AND claimed_until > ?)",
+                (start_of_day(now), now)).fetchone()
+            budget = min(self.options['batch_size'], self.options['daily_limit'] - sent_today)
+            rows = []
+            if budget > 0:
+                rows = conn.execute(
+                    'SELECT message_id, to_email, template_id, data, attempts FROM outbox '
+                    "WHERE (status = 'queued' AND next_attempt_at <= ?) "
+                    "OR (status = 'sending' AND claimed_until <= ?) "
+                    'ORDER BY next_attempt_at LIMIT ?', (now, now, budget)).fetchall()
+                conn.executemany("UPDATE outbox SET status = 'sending', claimed_until = ? "
+                                 'WHERE message_id = ?',
+                                 [(now + self.options['claim_timeout'], row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def drain(self, now=None):
+        """
+        Send one claimed batch, grouped by template, and return how many were sent
+
+        A batch SendGrid refuses outright is sent again one message at a time, so
+        one bad address can't fail every message in it.
+        """
+        rows = self.claim(now)
+        rows = self.drop_bad_addresses(rows)
+        batches = {}
+        for row in rows:
+            batches.setdefault(row[2], []).append(row)
+        sent = 0
+        for template_id, batch in batches.items():
+            try:
+                self.send(template_id, batch)
+                sent += len(batch)
+            except SendGridError as err:
+                if err.retryable or len(batch) == 1:
+                    continue
+                for row in batch:
+                    try:
+                        self.send(template_id, [row])
+                        sent += 1
+                    except Exception: # pylint: disable=broad-except
+                        pass
+            except Exception: # pylint: disable=broad-except
+                continue # rescheduled by send()
+        return sent
+
+    def send(self, template_id, batch):
+        """Send a batch in one request, recording whether it succeeded"""
+        try:
+            self.client.send(template_id, [(row[1], json.loads(row[3])) for row in batch])
+        except SendGridError as err:
+            print('Could not send email:', str(err))
+            if err.retryable:
+                self.retry(batch, err)
+            elif len(batch) == 1:
+                self.fail(batch[0], err)
+            raise
+        except Exception as err:
+            # timeouts and messages that can't be encoded aren't about an address either,
+            # so they back off until max_attempts instead of staying claimed
+            print('Could not send email:', str(err))
+            self.retry(batch, err)
+            raise
+        self.succeed(batch)
+
+    def drop_bad_addresses(self, rows):
+        """Fail claimed messages to addresses that were refused max_failures times"""
+        conn = self.connect()
+        remaining = []
+        for row in rows:
+            found = conn.execute('SELECT failures FROM outbox_address WHERE email = ?',
+                                 (row[1],)).fetchone()
+            if found is not None and found[0] >= self.options['max_failures']:
+                conn.execute("UPDATE outbox SET status = 'failed', claimed_until = NULL, "
+                             "last_error = 'Address was refused too many times' "
+                             'WHERE message_id = ?', (row[0],))
+                self.counters['failed'] += 1
+            else:
+                remaining.append(row)
+        return remaining
+
+    def succeed(self, batch):
+        now = time.time()
+        conn = self.connect()
+        conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1, "
+                         'claimed_until = NULL WHERE message_id = ?',
+                         [(now, row[0]) for row in batch])
+        conn.executemany('DELETE FROM outbox_address WHERE email = ?',
+                         [(row[1],) for row in batch])
+        self.counters['sent'] += len(batch)
+
+    def fail(self, row, err):
+        """Drop a message SendGrid refused, counting the refusal against its address"""
+        message_id, to_email, _, _, attempts = row
+        conn = self.connect()
+        conn.execute('INSERT INTO outbox_address (email, failures) VALUES (?, 1) '
+                     'ON CONFLICT (email) DO UPDATE SET failures = failures + 1',
+                     (to_email,))
+        conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, "
+                     'claimed_until = NULL, last_error = ? WHERE message_id = ?',
+                     (attempts + 1, str(err), message_id))
+        self.counters['failed'] += 1
+
+    def retry(self, batch, err):
+        """
+        Reschedule a batch after an outage or rate limiting, with exponential backoff,
+        dropping messages that have been tried max_attempts times
+
+        These errors aren't about any one address, so they don't count against them.
+        """
+        now = time.time()
+        conn = self.connect()
+        for message_id, _, _, _, attempts in batch:
+            if attempts + 1 >= self.options['max_attempts']:
+                conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, "
+                             'claimed_until = NULL, last_error = ? WHERE message_id = ?',
+                             (attempts + 1, str(err), message_id))
+                self.counters['failed'] += 1
+                continue
+            delay = min(self.options['retry_max_delay'],
+                        self.options['retry_base_delay'] * 2 ** attempts)
+            conn.execute("UPDATE outbox SET status = 'queued', attempts = ?, "
+                         'next_attempt_at = ?, claimed_until = NULL, last_error = ? '
+                         'WHERE message_id = ?',
+                         (attempts + 1, now + delay * random.uniform(0.5, 1), str(err),
+                          message_id))
+            self.counters['retried'] += 1
+
+    def run(self):
+        """Worker loop, drains the queue until the process exits"""
+        while True:
+            try:
+                if self.drain():
+                    continue
+            except Exception as err:
+                print('Outbox worker error:\n', err)
+            self.wakeup.wait(self.options['poll_interval'])
+            self.wakeup.clear()
+
+    def start(self):
+        """Start the worker thread for this process, if it isn't running already"""
+        if self.worker is not None and self.worker_pid == os.getpid() and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.worker_pid = os.getpid()
+        self.worker.start()
+
+    def stats(self):
+        """Return queue depth by status plus this process's counters"""
+        rows = self.connect().execute('SELECT status, COUNT(*) FROM outbox GROUP BY status')
+        return {'status': dict(rows.fetchall()), **self.counters}
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    """Return the outbox configured in config.json and make sure its worker is running"""
+    global _outbox # pylint: disable=global-statement
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                options = {**OUTBOX_DEFAULTS, **load_config().get('mail_outbox', {})}
+                _outbox = Outbox(**options)
+    _outbox.start()
+    return _outbox
@@ -0,0 +1,65 @@
+"""
+Keyset pagination for GraphQL connection fields
+
+Each page is read with a seek on the sort key, e.g.
+WHERE (edited_at, photo_id) < (:edited_at, :photo_id), instead of an
+OFFSET, so every page costs the same and rows inserted between requests
+can't shift items across page boundaries. Cursors are the sort key of a
+row encoded as URL-safe base64 JSON, and are opaque to clients.
+"""
+
+import base64
+import json
+from datetime import datetime
+from graphene import relay
+from sqlalchemy import DateTime, tuple_
+from sqlalchemy.orm import undefer
+
+def encode_cursor(values):
+    """Encode the sort key of a row as an opaque cursor"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor into the sort key values of its columns"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(columns):
+            raise ValueError
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for column, value in zip(columns, values)]
+    except (TypeError, ValueError) as err:
+        raise ValueError(f'Invalid cursor ({cursor})') from err
+
+def keyset_connection(connection_type, query, columns, first=10, after=None, descending=True):
+    """
+    Read one page of query ordered by columns, the last of which must be unique,
+    as an instance of a graphene relay Connection
+    """
+    # pylint: disable=too-many-arguments
+    if first < 0:
+        raise ValueError('first must not be negative')
+    if after is not None:
+        key = tuple_(*columns)
+        seek = tuple_(*decode_cursor(after, columns))
+        query = query.filter(key < seek if descending else key > seek)
+    order = [column.desc() if descending else column.asc() for column in columns]
+    # cursors are read from the sort key, even if the selection doesn't include it
+    query = query.options(*(undefer(column) for column in columns))
+    rows = query.order_by(None).order_by(*order).limit(first + 1).all()
+    edges = [
+        connection_type.Edge(
+            node=row,
+            cursor=encode_cursor([getattr(row, column.key) for column in columns])
+        )
+        for row in rows[:first]
+    ]
+    return connection_type(
+        edges=edges,
+        page_info=relay.PageInfo(
+            has_next_page=len(rows) > first,
+            has_previous_page=after is not None,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None
+        )
+    )
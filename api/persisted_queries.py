@@ -0,0 +1,83 @@
+"""
+Persisted GraphQL queries
+
+Clients send the SHA-256 hash of a query instead of its text, following
+Apollo's automatic persisted queries protocol:
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<hex>"}}}
+
+Hashes are looked up in a manifest loaded at startup, then in queries
+registered by earlier requests. An unknown hash gets a PersistedQueryNotFound
+error, and the client retries with both the hash and the query, which
+registers it for every later request to this worker.
+
+A manifest is a JSON object of hashes to query documents. Hashes are
+recomputed when it's loaded, so a stale manifest can't map a hash to the
+wrong document.
+"""
+
+import hashlib
+import json
+from utils import LRUCache, load_config
+
+class PersistedQueryError(Exception):
+    """A persisted query that can't be used, with the message Apollo clients expect"""
+
+def document_hash(document):
+    """Return the hex SHA-256 hash of a query document"""
+    return hashlib.sha256(document.encode()).hexdigest()
+
+class PersistedQueries:
+    """Query documents by hash, from a manifest and from automatic registration"""
+    def __init__(self, max_registered=1000):
+        self.manifest = {}
+        self.registered = LRUCache(max_registered)
+
+    def load_manifest(self, path):
+        """Add every query of a manifest file"""
+        with open(path, 'r') as f:
+            documents = json.load(f)
+        for query_hash, document in documents.items():
+            if document_hash(document) != query_hash:
+                print(f'Persisted query {query_hash} does not match its document, '
+                      'registering it by the document\'s hash')
+            self.manifest[document_hash(document)] = document
+        print(f'Loaded {len(self.manifest)} persisted queries from {path}')
+
+    def lookup(self, query_hash):
+        """Return the document registered under a hash, or None"""
+        document = self.manifest.get(query_hash)
+        if document is None:
+            document = self.registered.get(query_hash)
+        return document
+
+    def register(self, query_hash, document):
+        """Remember a document sent by a client under the hash it was sent with"""
+        if document_hash(document) != query_hash:
+            raise PersistedQueryError('provided sha does not match query')
+        if query_hash not in self.manifest:
+            self.registered.put(query_hash, document)
+
+    def resolve(self, extensions, document=None):
+        """
+        Return the query document of a request's persistedQuery extension, registering
+        the document if the request included it
+        """
+        persisted_query = extensions.get('persistedQuery')
+        if not isinstance(persisted_query, dict):
+            return document
+        if persisted_query.get('version') != 1:
+            raise PersistedQueryError('Unsupported persisted query version')
+        query_hash = persisted_query.get('sha256Hash')
+        if not isinstance(query_hash, str):
+            raise PersistedQueryError('Persisted query is missing sha256Hash')
+        if document is not None:
+            self.register(query_hash, document)
+            return document
+        document = self.lookup(query_hash)
+        if document is None:
+            raise PersistedQueryError('PersistedQueryNotFound')
+        return document
+
+persisted_queries = PersistedQueries(load_config().get('persisted_queries', {})
+                                                 .get('max_registered', 1000))
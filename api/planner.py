@@ -0,0 +1,75 @@
+"""
+Selection-set-aware query planning for GraphQL resolvers
+
+Rows are loaded with load_only() for the columns a query actually selects,
+so list views asking for ids and titles don't pull photo_text, edit_text
+and every other column along with them. Primary keys and the columns that
+selected relationships join on are always loaded, since the DataLoaders in
+loaders.py resolve relationships from them.
+"""
+
+from graphene.utils.str_converters import to_snake_case
+from graphql.language.ast import Field, FragmentSpread, InlineFragment
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+def field_nodes(selections, fragments):
+    """Flatten fragments out of a list of selections, yielding the fields"""
+    for selection in selections:
+        if isinstance(selection, Field):
+            yield selection
+        elif isinstance(selection, FragmentSpread):
+            fragment = fragments[selection.name.value]
+            yield from field_nodes(fragment.selection_set.selections, fragments)
+        elif isinstance(selection, InlineFragment):
+            yield from field_nodes(selection.selection_set.selections, fragments)
+
+def selection_names(info, path=()):
+    """
+    Return the snake_case names of the fields selected under the field being
+    resolved, after descending through the fields named in path
+    """
+    fields = list(info.field_asts)
+    for name in path:
+        fields = [
+            child
+            for field in fields if field.selection_set is not None
+            for child in field_nodes(field.selection_set.selections, info.fragments)
+            if to_snake_case(child.name.value) == name
+        ]
+    return {
+        to_snake_case(child.name.value)
+        for field in fields if field.selection_set is not None
+        for child in field_nodes(field.selection_set.selections, info.fragments)
+    }
+
+def local_column(relationship):
+    """Return the column of the parent table a relationship joins on"""
+    if relationship.secondary is not None:
+        ((column, _),) = relationship.synchronize_pairs
+    else:
+        ((column, _),) = relationship.local_remote_pairs
+    return column
+
+def column_keys(model, names):
+    """Return the keys of the column attributes needed to resolve the named fields"""
+    mapper = inspect(model)
+    keys = {mapper.get_property_by_column(column).key for column in mapper.primary_key}
+    for name in names:
+        if name in mapper.column_attrs:
+            keys.add(name)
+        elif name in mapper.relationships:
+            relationship = mapper.relationships[name]
+            if len(relationship.local_remote_pairs) == 1 or relationship.secondary is not None:
+                keys.add(mapper.get_property_by_column(local_column(relationship)).key)
+    return frozenset(keys)
+
+def only_columns(model, keys):
+    """Create a load_only() option for the given column keys of a model"""
+    return load_only(*(getattr(model, key) for key in sorted(keys)))
+
+def planned_query(object_type, info, path=()):
+    """Query an object type's model, loading only the columns its selection needs"""
+    model = object_type._meta.model
+    keys = column_keys(model, selection_names(info, path))
+    return object_type.get_query(info).options(only_columns(model, keys))
@@ -0,0 +1,202 @@
+"""
+Cost analysis, depth limits and timeouts for GraphQL queries
+
+Back-references like Account.photos and Photo.edits let a query nest lists
+inside lists, so a few lines of GraphQL can ask for millions of rows. Before
+a query runs, its cost is estimated from the shape of the document: every
+object field costs its weight, scalars cost nothing, and everything under a
+list is multiplied by the number of items the list can return, taken from
+its limit or first argument or default_list_size if it has neither.
+
+Queries deeper than max_depth or costlier than max_cost are rejected, limit
+and first arguments are clamped to max_page_size, and statement_timeout
+bounds every SQL statement a query runs. The estimate is returned in the
+response extensions so the weights in config.json can be tuned.
+
+Parsed and validated documents are kept in an LRU cache keyed by the hash
+of their text, so the queries the web app sends over and over skip lexing,
+parsing and validation, which are slow in pure Python.
+"""
+
+from collections import OrderedDict
+from functools import partial
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.backend.base import GraphQLDocument
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.execution.values import get_argument_values, get_variable_values
+from graphql.language import ast
+from graphql.language.printer import print_ast
+from graphql.language.parser import parse
+from graphql.type import GraphQLList, GraphQLObjectType, get_named_type, get_nullable_type
+from graphql.validation import validate
+from sqlalchemy import text
+from persisted_queries import document_hash
+from planner import field_nodes
+from utils import LRUCache, load_config
+
+PAGE_ARGUMENTS = ('limit', 'first')
+
+class QueryCost:
+    """The estimated cost and depth of a query, and the field that made it deepest"""
+    def __init__(self, cost=0, depth=0, deepest=None):
+        self.cost = cost
+        self.depth = depth
+        self.deepest = deepest
+
+def page_size(args, limits):
+    """Return the clamped limit or first argument of a field, or None without one"""
+    for name in PAGE_ARGUMENTS:
+        if args.get(name) is not None:
+            return min(args[name], limits['max_page_size'])
+    return None
+
+def selection_cost(parent_type, selection_set, fragments, variables, limits, pending_size=None):
+    """
+    Estimate the cost of resolving a selection set once for a parent of parent_type,
+    where pending_size is the page size a connection passes down to its edges
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    total = QueryCost()
+    if selection_set is None or not isinstance(parent_type, GraphQLObjectType):
+        return total
+    for node in field_nodes(selection_set.selections, fragments):
+        name = node.name.value
+        if name.startswith('__') or name not in parent_type.fields:
+            continue
+        field = parent_type.fields[name]
+        field_type = get_nullable_type(field.type)
+        named_type = get_named_type(field_type)
+        args = get_argument_values(field.args, node.arguments, variables)
+        size = page_size(args, limits)
+        children = selection_cost(named_type, node.selection_set, fragments, variables, limits,
+                                  pending_size=size if not isinstance(field_type, GraphQLList)
+                                  else None)
+        cost = children.cost
+        if isinstance(field_type, GraphQLList):
+            cost *= size or pending_size or limits['default_list_size']
+        if isinstance(named_type, GraphQLObjectType):
+            cost += limits['field_weights'].get(f'{parent_type.name}.{name}', 1)
+        else:
+            cost += limits['field_weights'].get(f'{parent_type.name}.{name}', 0)
+        total.cost += cost
+        if children.depth + 1 > total.depth:
+            total.depth = children.depth + 1
+            total.deepest = children.deepest or node
+    return total
+
+def operation_for(document_ast, operation_name):
+    """Find the operation of a document that a request runs"""
+    operations = [definition for definition in document_ast.definitions
+                  if isinstance(definition, ast.OperationDefinition)]
+    for operation in operations:
+        if operation_name is None or \
+           (operation.name is not None and operation.name.value == operation_name):
+            return operation
+    return None
+
+def document_fragments(document_ast):
+    """Map the names of a document's fragments to their definitions"""
+    return {
+        definition.name.value: definition
+        for definition in document_ast.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    }
+
+def query_cost(schema, document_ast, operation_name=None, variable_values=None, limits=None):
+    """Estimate the cost and depth of the operation a request runs"""
+    limits = limits or load_config('graphql_limits')
+    operation = operation_for(document_ast, operation_name)
+    if operation is None:
+        return QueryCost()
+    fragments = document_fragments(document_ast)
+    variables = get_variable_values(schema, operation.variable_definitions or [],
+                                    variable_values)
+    if operation.operation == 'mutation':
+        root_type = schema.get_mutation_type()
+    else:
+        root_type = schema.get_query_type()
+    return selection_cost(root_type, operation.selection_set, fragments, variables, limits)
+
+def clamp_page_size(next_resolver, root, info, **args):
+    """Graphene middleware that caps the limit and first arguments of every field"""
+    limits = load_config('graphql_limits')
+    for name in PAGE_ARGUMENTS:
+        if args.get(name) is not None and args[name] > limits['max_page_size']:
+            args[name] = limits['max_page_size']
+    return next_resolver(root, info, **args)
+
+def set_statement_timeout(context, timeout):
+    """Bound every statement of the request's transaction to timeout milliseconds"""
+    session = context.get('session') if isinstance(context, dict) else None
+    if session is not None and session.get_bind().dialect.name == 'postgresql':
+        session.execute(text(f'SET LOCAL statement_timeout = {int(timeout)}'))
+
+class ExtendedExecutionResult(ExecutionResult):
+    """ExecutionResult that includes its extensions in the response"""
+    def to_dict(self, format_error=None, dict_class=OrderedDict):
+        response = super().to_dict(format_error=format_error, dict_class=dict_class)
+        if self.extensions:
+            response['extensions'] = self.extensions
+        return response
+
+def execute_within_limits(schema, document_ast, validation_errors, operation_name=None,
+                          variable_values=None, **options):
+    """Check a validated query's cost and depth against the limits, then run it"""
+    # pylint: disable=too-many-arguments
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+    limits = load_config('graphql_limits')
+    try:
+        estimate = query_cost(schema, document_ast, operation_name, variable_values, limits)
+    except GraphQLError as err:
+        return ExecutionResult(errors=[err], invalid=True)
+    extensions = {
+        'cost': {
+            'estimated': estimate.cost,
+            'depth': estimate.depth,
+            'max_cost': limits['max_cost'],
+            'max_depth': limits['max_depth'],
+        }
+    }
+    errors = []
+    if estimate.depth > limits['max_depth']:
+        errors.append(GraphQLError(
+            f'Query is nested {estimate.depth} fields deep, more than {limits["max_depth"]}',
+            [estimate.deepest]
+        ))
+    if estimate.cost > limits['max_cost']:
+        errors.append(GraphQLError(
+            f'Query costs an estimated {estimate.cost}, more than {limits["max_cost"]}'
+        ))
+    if errors:
+        return ExtendedExecutionResult(errors=errors, invalid=True, extensions=extensions)
+    context = options.get('context_value', options.get('context'))
+    set_statement_timeout(context, limits['statement_timeout'])
+    result = execute(schema, document_ast, operation_name=operation_name,
+                     variable_values=variable_values, **options)
+    return ExtendedExecutionResult(result.data, result.errors, result.invalid,
+                                   dict(result.extensions, **extensions))
+
+class LimitedBackend(GraphQLCoreBackend):
+    """GraphQL backend that caches validated documents and runs them within the limits"""
+    def __init__(self, cache_size=256):
+        super().__init__()
+        self.documents = LRUCache(cache_size)
+
+    def document_from_string(self, schema, document_string):
+        if isinstance(document_string, ast.Document):
+            document_string = print_ast(document_string)
+        key = document_hash(document_string)
+        document = self.documents.get(key)
+        if document is None or document.schema is not schema:
+            document_ast = parse(document_string)
+            document = GraphQLDocument(
+                schema=schema,
+                document_string=document_string,
+                document_ast=document_ast,
+                execute=partial(execute_within_limits, schema, document_ast,
+                                validate(schema, document_ast))
+            )
+            self.documents.put(key, document)
+        return document
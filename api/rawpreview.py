@@ -0,0 +1,132 @@
+"""
+Embedded JPEG extraction from camera raw files
+
+Nearly every raw format stores one or more JPEG previews next to the sensor
+data so that cameras can display it quickly. Finding the largest one only
+means walking the file's IFDs (and some MakerNotes) through an mmap and
+slicing out the JPEG bytes, which takes milliseconds, whereas decoding the
+raw data would take seconds.
+
+Supported layouts:
+- JPEGInterchangeFormat / JPEGInterchangeFormatLength in any IFD
+- single strip JPEG images in any IFD (CR2, DNG previews)
+- Panasonic JpgFromRaw (RW2)
+- Nikon PreviewIFD in the MakerNote (NEF)
+- the Fujifilm RAF header's JPEG pointer
+"""
+
+import mmap
+import struct
+from tiff import TiffError, TiffReader
+
+TAG_NEW_SUBFILE_TYPE = 0x00FE
+TAG_COMPRESSION = 0x0103
+TAG_STRIP_OFFSETS = 0x0111
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+TAG_PANASONIC_JPG_FROM_RAW = 0x002E
+TAG_MAKER_NOTE = 0x927C
+TAG_NIKON_PREVIEW_IFD = 0x0011
+
+JPEG_COMPRESSIONS = (6, 7)
+RAF_MAGIC = b'FUJIFILMCCD-RAW'
+
+def is_displayable_jpeg(buffer, offset, length):
+    """
+    Whether the bytes at offset are a JPEG that Pillow can decode
+
+    Raw sensor data is often stored as lossless JPEG (SOF3), which starts
+    with the same marker as a preview, so the frame header is checked too.
+    """
+    end = offset + length
+    if length < 4 or end > len(buffer) or buffer[offset:offset + 2] != b'\xff\xd8':
+        return False
+    position = offset + 2
+    while position + 4 <= end:
+        if buffer[position] != 0xFF:
+            return False
+        marker = buffer[position + 1]
+        if marker == 0xFF: # fill byte
+            position += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return marker in (0xC0, 0xC1, 0xC2) # baseline, extended or progressive
+        segment_length, = struct.unpack('>H', buffer[position + 2:position + 4])
+        position += 2 + segment_length
+    return False
+
+def jpeg_candidates(reader):
+    """Yield (offset, length) of each JPEG referenced from a TIFF structure"""
+    for entries in reader.walk():
+        try:
+            if TAG_JPEG_OFFSET in entries and TAG_JPEG_LENGTH in entries:
+                yield (reader.base + entries[TAG_JPEG_OFFSET].value(),
+                       entries[TAG_JPEG_LENGTH].value())
+            if entries.get(TAG_COMPRESSION) and \
+               entries[TAG_COMPRESSION].value() in JPEG_COMPRESSIONS and \
+               TAG_STRIP_OFFSETS in entries and entries[TAG_STRIP_OFFSETS].count == 1:
+                yield (reader.base + entries[TAG_STRIP_OFFSETS].value(),
+                       entries[TAG_STRIP_BYTE_COUNTS].value())
+            if TAG_PANASONIC_JPG_FROM_RAW in entries:
+                entry = entries[TAG_PANASONIC_JPG_FROM_RAW]
+                yield reader.base + entry.value_offset, entry.size
+            if TAG_MAKER_NOTE in entries:
+                yield from maker_note_candidates(reader, entries[TAG_MAKER_NOTE])
+        except (TiffError, struct.error, KeyError, TypeError):
+            continue
+
+def maker_note_candidates(reader, entry):
+    """Yield JPEGs referenced from a MakerNote with a TIFF structure of its own"""
+    note_offset = reader.base + entry.value_offset
+    header = bytes(reader.buffer[note_offset:note_offset + 10])
+    if header.startswith(b'Nikon\0\x02'):
+        # Nikon type 3 MakerNotes embed a complete TIFF structure after a 10 byte header
+        note = TiffReader(reader.buffer, note_offset + 10)
+        entries, _ = note.read_ifd(note.first_ifd)
+        if TAG_NIKON_PREVIEW_IFD in entries:
+            preview_entries, _ = note.read_ifd(entries[TAG_NIKON_PREVIEW_IFD].value())
+            if TAG_JPEG_OFFSET in preview_entries and TAG_JPEG_LENGTH in preview_entries:
+                yield (note.base + preview_entries[TAG_JPEG_OFFSET].value(),
+                       preview_entries[TAG_JPEG_LENGTH].value())
+
+def raf_candidates(buffer):
+    """Yield the JPEG referenced from a Fujifilm RAF header"""
+    if len(buffer) >= 92:
+        offset, length = struct.unpack('>LL', buffer[84:92])
+        yield offset, length
+
+def find_embedded_jpeg(buffer):
+    """Return (offset, length) of the largest displayable JPEG in a raw file, or None"""
+    if buffer[:len(RAF_MAGIC)] == RAF_MAGIC:
+        candidates = raf_candidates(buffer)
+    else:
+        try:
+            candidates = jpeg_candidates(TiffReader(buffer))
+        except TiffError:
+            return None
+    best = None
+    for offset, length in candidates:
+        if (best is None or length > best[1]) and is_displayable_jpeg(buffer, offset, length):
+            best = (offset, length)
+    return best
+
+def extract_embedded_jpeg(source_path, file_path):
+    """
+    Write the largest JPEG embedded in a raw file to file_path
+
+    Returns True if a JPEG was written and False if the file has none.
+    """
+    with open(source_path, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return False
+        with buffer:
+            found = find_embedded_jpeg(buffer)
+            if found is None:
+                return False
+            offset, length = found
+            with open(file_path, 'wb') as out, memoryview(buffer) as view:
+                out.write(view[offset:offset + length])
+    return True
@@ -0,0 +1,269 @@
+"""
+Response cache for /graphql
+
+Responses are cached under a hash of the query, its variables and the
+viewer's role, for the shortest TTL of the query's root fields. Every entry
+is tagged with what it read:
+- "photo"    a list of photos, whose membership or order any photo write changes
+- "photo:5"  photo 5 itself
+- "photo:*"  any photo, which bulk UPDATEs and DELETEs of the table change
+
+Writes purge tags instead of entries (see the session events in db.py),
+by giving each purged tag a new random generation. Entries remember the
+generations of their tags when they were stored and are only served while
+all of them still match, so a purge invalidates every entry that read what
+was written without having to find them. A tag without a generation, never
+stored or evicted, invalidates its entries too.
+
+Entries are kept in a process-local LRU and, if "shared" is set in the
+"response_cache" config object, in a Redis protocol server shared by all
+workers. With a shared tier, generations live in the shared server as
+well, so a write in one worker invalidates the other workers' local
+entries. Without one, other workers keep serving their entries until they
+expire, so when uWSGI runs more than one worker every TTL is capped to
+"unshared_max_ttl" seconds.
+"""
+
+import json
+import secrets
+import threading
+import time
+from sqlalchemy import inspect
+from session_store import RespClient, RespError
+from utils import LRUCache, load_config, worker_processes
+
+GENERATION_CAPACITY = 100000 # tag generations kept by a process without a shared tier
+UNKNOWN = object() # purge count when the shared tier can't be reached
+
+def entity_tags(instance):
+    """Return the tags of a mapped row that was read"""
+    state = inspect(instance)
+    table = state.mapper.local_table.name
+    if state.identity is None:
+        return {table}
+    return {f'{table}:{",".join(map(str, state.identity))}', f'{table}:*'}
+
+def changed_row_tags(instance, change):
+    """
+    Return the tags a flushed row purges, where change is 'new', 'dirty' or 'deleted',
+    including the rows its foreign keys pointed to before and after the change
+    """
+    state = inspect(instance)
+    mapper = state.mapper
+    table = mapper.local_table
+    tags = {table.name}
+    if change != 'new' and state.identity is not None:
+        tags.add(f'{table.name}:{",".join(map(str, state.identity))}')
+    for foreign_key in table.foreign_keys:
+        prop = mapper.get_property_by_column(foreign_key.parent)
+        history = state.attrs[prop.key].history
+        for value in history.sum():
+            if value is not None:
+                tags.add(f'{foreign_key.column.table.name}:{value}')
+    return tags
+
+def table_tags(table, is_insert):
+    """Return the tags a bulk INSERT, UPDATE or DELETE of a table purges"""
+    tags = {table.name}
+    if not is_insert:
+        tags.add(f'{table.name}:*')
+    for foreign_key in table.foreign_keys:
+        tags.add(f'{foreign_key.column.table.name}:*')
+    return tags
+
+def new_generation():
+    """Create a generation that no tag has had before"""
+    return secrets.token_hex(8)
+
+class LocalGenerations:
+    """Tag generations of a single process"""
+    def __init__(self, capacity=GENERATION_CAPACITY):
+        self.generations = LRUCache(capacity)
+        self.purges = 0
+        self.lock = threading.Lock()
+
+    def current(self, tags):
+        return [self.generations.get(tag) for tag in tags]
+
+    def ensure(self, tags):
+        with self.lock:
+            for tag in tags:
+                if self.generations.get(tag) is None:
+                    self.generations.put(tag, new_generation())
+        return self.current(tags)
+
+    def purge(self, tags):
+        with self.lock:
+            self.purges += 1
+            for tag in tags:
+                self.generations.put(tag, new_generation())
+
+    def purge_count(self):
+        return self.purges
+
+class SharedGenerations:
+    """
+    Tag generations kept in a Redis protocol server
+
+    Generations expire twice as late as the longest lived entry that could
+    have read them, which is gone by then.
+    """
+    def __init__(self, client, prefix, max_ttl):
+        self.client = client
+        self.prefix = prefix
+        self.max_ttl = max_ttl
+
+    def key(self, tag):
+        return f'{self.prefix}:tag:{tag}'
+
+    def current(self, tags):
+        if len(tags) == 0:
+            return []
+        generations = self.client.execute('MGET', *(self.key(tag) for tag in tags))
+        return [generation.decode() if generation is not None else None
+                for generation in generations]
+
+    def ensure(self, tags):
+        generations = self.current(tags)
+        for tag, generation in zip(tags, generations):
+            if generation is None:
+                self.client.execute('SET', self.key(tag), new_generation(),
+                                    'NX', 'PX', self.max_ttl * 2000)
+        return self.current(tags)
+
+    def purge(self, tags):
+        self.client.execute('INCR', f'{self.prefix}:purges')
+        for tag in tags:
+            self.client.execute('SET', self.key(tag), new_generation(),
+                                'PX', self.max_ttl * 2000)
+
+    def purge_count(self):
+        return self.client.execute('GET', f'{self.prefix}:purges')
+
+class ResponseCache:
+    """
+    Tagged response bodies in a local LRU and an optional shared tier
+
+    Counters are kept per process:
+    - hits, misses, evictions: of the local tier
+    - shared_hits, shared_misses: of the shared tier, after local misses
+    - stale: entries found with a purged tag
+    - stores, purges: entries stored, and writes that purged tags
+    - skipped: stores dropped because a purge ran while their query did
+    - errors: failed calls to the shared tier
+    """
+    def __init__(self, capacity=1000, shared=None, prefix='graphql', max_ttl=300):
+        self.local = LRUCache(capacity)
+        self.client = RespClient(**shared) if shared else None
+        self.prefix = prefix
+        self.max_ttl = max_ttl
+        if self.client is not None:
+            self.generations = SharedGenerations(self.client, prefix, max_ttl)
+        else:
+            self.generations = LocalGenerations()
+        self.counters = {'shared_hits': 0, 'shared_misses': 0, 'stale': 0, 'stores': 0,
+                         'purges': 0, 'skipped': 0, 'errors': 0}
+
+    def entry_key(self, key):
+        return f'{self.prefix}:entry:{key}'
+
+    def is_fresh(self, entry):
+        tags = list(entry['tags'])
+        current = self.generations.current(tags)
+        fresh = all(generation is not None and generation == entry['tags'][tag]
+                    for tag, generation in zip(tags, current))
+        if not fresh:
+            self.counters['stale'] += 1
+        return fresh
+
+    def get(self, key, now=None):
+        """Return the cached body stored under a key, or None"""
+        now = now or time.time()
+        try:
+            entry = self.local.get(key)
+            if entry is not None and entry['expires_at'] > now and self.is_fresh(entry):
+                return entry['body']
+            if entry is not None:
+                self.local.pop(key)
+            if self.client is None:
+                return None
+            data = self.client.execute('GET', self.entry_key(key))
+            if data is None:
+                self.counters['shared_misses'] += 1
+                return None
+            entry = json.loads(data)
+            if not self.is_fresh(entry):
+                return None
+            self.counters['shared_hits'] += 1
+            self.local.put(key, entry)
+            return entry['body']
+        except (ConnectionError, OSError, RespError) as err:
+            self.counters['errors'] += 1
+            print('Could not read cached response:\n', err)
+            return None
+
+    def purge_count(self):
+        """Return a marker to pass to put(), for detecting purges while a query runs"""
+        try:
+            return self.generations.purge_count()
+        except (ConnectionError, OSError, RespError) as err:
+            self.counters['errors'] += 1
+            print('Could not read response cache purges:\n', err)
+            return UNKNOWN
+
+    def put(self, key, body, tags, ttl, purge_count, now=None):
+        """Store a body for ttl seconds, unless a purge ran since purge_count was read"""
+        # pylint: disable=too-many-arguments
+        now = now or time.time()
+        ttl = min(ttl, self.max_ttl)
+        tags = sorted(tags)
+        try:
+            generations = self.generations.ensure(tags)
+            if purge_count is UNKNOWN or self.generations.purge_count() != purge_count:
+                self.counters['skipped'] += 1
+                return
+            entry = {'body': body, 'tags': dict(zip(tags, generations)), 'expires_at': now + ttl}
+            self.local.put(key, entry)
+            if self.client is not None:
+                self.client.execute('SET', self.entry_key(key), json.dumps(entry),
+                                    'PX', int(ttl * 1000))
+            self.counters['stores'] += 1
+        except (ConnectionError, OSError, RespError) as err:
+            self.counters['errors'] += 1
+            print('Could not cache response:\n', err)
+
+    def purge(self, tags):
+        """Invalidate every entry tagged with any of tags"""
+        if len(tags) == 0:
+            return
+        try:
+            self.generations.purge(sorted(tags))
+            self.counters['purges'] += 1
+        except (ConnectionError, OSError, RespError) as err:
+            self.counters['errors'] += 1
+            print('Could not purge cached responses:\n', err)
+
+    def stats(self):
+        """Return the counters of both tiers"""
+        return dict(self.local.counters, size=len(self.local), **self.counters)
+
+def create_response_cache(options=None):
+    """Create the response cache described by the "response_cache" config object"""
+    options = options or {}
+    ttls = options.get('ttls', {})
+    max_ttl = max([options.get('default_ttl', 0), *ttls.values()])
+    if not options.get('shared') and worker_processes() > 1:
+        # purges only reach this worker's entries, so keep the others' short
+        unshared_max_ttl = options.get('unshared_max_ttl', 5)
+        if max_ttl > unshared_max_ttl:
+            print(f'Response cache has no shared tier for {worker_processes()} workers, '
+                  f'caching responses for at most {unshared_max_ttl} seconds')
+            max_ttl = unshared_max_ttl
+    return ResponseCache(
+        capacity=options.get('capacity', 1000),
+        shared=options.get('shared'),
+        prefix=options.get('prefix', 'graphql'),
+        max_ttl=max_ttl
+    )
+
+response_cache = create_response_cache(load_config().get('response_cache'))
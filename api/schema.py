@@ -1,9 +1,14 @@
 """Graphene schema for GraphQL support"""
 # pylint: disable=too-few-public-methods,too-many-arguments,no-self-use,missing-class-docstring
 
+import os
 from datetime import datetime
-from graphene import Argument, DateTime, Field, ID, Int, List, ObjectType, Schema, String
-from graphene_sqlalchemy import SQLAlchemyObjectType
+from graphene import Argument, DateTime, Field, ID, Int, List, ObjectType, Schema, String, relay
+from utils import load_config
+from loaders import BatchedObjectType, get_loaders
+from planner import planned_query
+from pagination import decode_cursor, encode_cursor, keyset_connection
+from timeline import read_timeline
 from model import (
     Account as AccountModel,
     Photo as PhotoModel,
@@ -11,77 +16,171 @@ from model import (
     Reply as ReplyModel,
     Reaction as ReactionModel,
     File as FileModel,
+    FileRendition as FileRenditionModel,
     Tag as TagModel,
     Manufacturer as ManufacturerModel,
     Camera as CameraModel,
     Lens as LensModel,
     Editor as EditorModel,
     Event as EventModel,
+    FeedItem as FeedItemModel,
     Notification as NotificationModel,
     Flag as FlagModel,
     Ban as BanModel
 )
 
-class Account(SQLAlchemyObjectType):
+class Account(BatchedObjectType):
     class Meta:
         model = AccountModel
 
-class Photo(SQLAlchemyObjectType):
+class Photo(BatchedObjectType):
     class Meta:
         model = PhotoModel
 
-class Edit(SQLAlchemyObjectType):
+class Edit(BatchedObjectType):
     class Meta:
         model = EditModel
 
-class Reply(SQLAlchemyObjectType):
+class Reply(BatchedObjectType):
     class Meta:
         model = ReplyModel
 
-class Reaction(SQLAlchemyObjectType):
+class Reaction(BatchedObjectType):
     class Meta:
         model = ReactionModel
 
-class File(SQLAlchemyObjectType):
+class File(BatchedObjectType):
     class Meta:
         model = FileModel
 
-class Tag(SQLAlchemyObjectType):
+    srcset = String(file_extension=Argument(type=String))
+    def resolve_srcset(self, info, file_extension='jpg'):
+        """List a preview's renditions in one format as a srcset attribute value"""
+        storage_path = load_config('file_storage_path')
+        def srcset(renditions):
+            return ', '.join(
+                f'/{os.path.relpath(rendition.file_path, storage_path)} {rendition.image_width}w'
+                for rendition in renditions
+                if rendition.file_extension == file_extension
+            )
+        loaders = get_loaders(info.context)
+        if loaders is None:
+            return srcset(self.renditions)
+        return loaders.load(FileModel.renditions.property, self).then(srcset)
+
+class FileRendition(BatchedObjectType):
+    class Meta:
+        model = FileRenditionModel
+
+class Tag(BatchedObjectType):
     class Meta:
         model = TagModel
 
-class Manufacturer(SQLAlchemyObjectType):
+class Manufacturer(BatchedObjectType):
     class Meta:
         model = ManufacturerModel
 
-class Camera(SQLAlchemyObjectType):
+class Camera(BatchedObjectType):
     class Meta:
         model = CameraModel
 
-class Lens(SQLAlchemyObjectType):
+class Lens(BatchedObjectType):
     class Meta:
         model = LensModel
 
-class Editor(SQLAlchemyObjectType):
+class Editor(BatchedObjectType):
     class Meta:
         model = EditorModel
 
-class Event(SQLAlchemyObjectType):
+class Event(BatchedObjectType):
     class Meta:
         model = EventModel
 
-class Notification(SQLAlchemyObjectType):
+class FeedItem(BatchedObjectType):
+    class Meta:
+        model = FeedItemModel
+
+    cursor = String()
+    def resolve_cursor(self, info):
+        """Opaque cursor for reading the feed after this item"""
+        return encode_cursor([self.feed_item_id])
+
+class TimelineItem(ObjectType):
+    cursor = String()
+    event = Field(Event)
+
+class Notification(BatchedObjectType):
     class Meta:
         model = NotificationModel
 
-class Flag(SQLAlchemyObjectType):
+class Flag(BatchedObjectType):
     class Meta:
         model = FlagModel
 
-class Ban(SQLAlchemyObjectType):
+class Ban(BatchedObjectType):
     class Meta:
         model = BanModel
 
+class AccountConnection(relay.Connection):
+    class Meta:
+        node = Account
+
+class PhotoConnection(relay.Connection):
+    class Meta:
+        node = Photo
+
+class EditConnection(relay.Connection):
+    class Meta:
+        node = Edit
+
+class ReplyConnection(relay.Connection):
+    class Meta:
+        node = Reply
+
+class ReactionConnection(relay.Connection):
+    class Meta:
+        node = Reaction
+
+class TagConnection(relay.Connection):
+    class Meta:
+        node = Tag
+
+class ManufacturerConnection(relay.Connection):
+    class Meta:
+        node = Manufacturer
+
+class CameraConnection(relay.Connection):
+    class Meta:
+        node = Camera
+
+class LensConnection(relay.Connection):
+    class Meta:
+        node = Lens
+
+class EditorConnection(relay.Connection):
+    class Meta:
+        node = Editor
+
+class FileConnection(relay.Connection):
+    class Meta:
+        node = File
+
+class EventConnection(relay.Connection):
+    class Meta:
+        node = Event
+
+class NotificationConnection(relay.Connection):
+    class Meta:
+        node = Notification
+
+class FlagConnection(relay.Connection):
+    class Meta:
+        node = Flag
+
+class BanConnection(relay.Connection):
+    class Meta:
+        node = Ban
+
 class Query(ObjectType):
     """Query resolvers"""
     # pylint: disable=too-many-public-methods
@@ -90,11 +189,11 @@ class Query(ObjectType):
     def resolve_account(self, info, account_email=None, account_handle=None):
         """Query for account by handle"""
         if account_email is not None:
-            return Account.get_query(info) \
+            return planned_query(Account, info) \
                           .filter(AccountModel.account_email == account_email) \
                           .first()
         if account_handle is not None:
-            return Account.get_query(info) \
+            return planned_query(Account, info) \
                           .filter(AccountModel.account_handle == account_handle) \
                           .first()
         return None
@@ -103,172 +202,296 @@ class Query(ObjectType):
                     before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_accounts(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all accounts"""
-        return Account.get_query(info) \
+        return planned_query(Account, info) \
                       .filter(AccountModel.edited_at < before) \
                       .filter(AccountModel.edited_at >= after) \
                       .order_by(AccountModel.edited_at.desc(), AccountModel.created_at.desc()) \
                       .limit(limit) \
                       .offset(offset)
 
+    accounts_connection = Field(AccountConnection, first=Argument(type=Int),
+                                                   after=Argument(type=String))
+    def resolve_accounts_connection(self, info, first=10, after=None):
+        """Page through accounts by edit date"""
+        query = planned_query(Account, info, ('edges', 'node'))
+        return keyset_connection(AccountConnection, query,
+                                 (AccountModel.edited_at, AccountModel.account_id), first, after)
+
     photo = Field(Photo, photo_id=Argument(type=ID, required=True))
     def resolve_photo(self, info, photo_id=None):
         """Query for photo by ID"""
-        return Photo.get_query(info).filter(PhotoModel.photo_id == photo_id).first()
+        return planned_query(Photo, info).filter(PhotoModel.photo_id == photo_id).first()
 
     photos = List(Photo, limit=Argument(type=Int), offset=Argument(type=Int),
                   before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_photos(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all photos"""
-        return Photo.get_query(info) \
+        return planned_query(Photo, info) \
                     .filter(PhotoModel.edited_at < before) \
                     .filter(PhotoModel.edited_at >= after) \
                     .order_by(PhotoModel.edited_at.desc(), PhotoModel.created_at.desc()) \
                     .limit(limit) \
                     .offset(offset)
 
+    photos_connection = Field(PhotoConnection, first=Argument(type=Int),
+                                               after=Argument(type=String))
+    def resolve_photos_connection(self, info, first=10, after=None):
+        """Page through photos by edit date"""
+        query = planned_query(Photo, info, ('edges', 'node'))
+        return keyset_connection(PhotoConnection, query,
+                                 (PhotoModel.edited_at, PhotoModel.photo_id), first, after)
+
     edit = Field(Edit, edit_id=Argument(type=ID, required=True))
     def resolve_edit(self, info, edit_id=None):
         """Query for edit by ID"""
-        return Edit.get_query(info).filter(EditModel.edit_id == edit_id).first()
+        return planned_query(Edit, info).filter(EditModel.edit_id == edit_id).first()
 
     edits = List(Edit, limit=Argument(type=Int), offset=Argument(type=Int),
                  before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_edits(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all edits"""
-        return Edit.get_query(info) \
+        return planned_query(Edit, info) \
                    .filter(EditModel.edited_at < before) \
                    .filter(EditModel.edited_at >= after) \
                    .order_by(EditModel.edited_at.desc(), EditModel.created_at.desc()) \
                    .limit(limit) \
                    .offset(offset)
 
+    edits_connection = Field(EditConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_edits_connection(self, info, first=10, after=None):
+        """Page through edits by edit date"""
+        query = planned_query(Edit, info, ('edges', 'node'))
+        return keyset_connection(EditConnection, query,
+                                 (EditModel.edited_at, EditModel.edit_id), first, after)
+
     reply = Field(Reply, reply_id=Argument(type=ID, required=True))
     def resolve_reply(self, info, reply_id=None):
         """Query for reply by ID"""
-        return Reply.get_query(info).filter(ReplyModel.reply_id == reply_id).first()
+        return planned_query(Reply, info).filter(ReplyModel.reply_id == reply_id).first()
 
     replies = List(Reply, limit=Argument(type=Int), offset=Argument(type=Int),
                    before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_replies(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all replies by date"""
-        return Reply.get_query(info) \
+        return planned_query(Reply, info) \
                     .filter(ReplyModel.edited_at < before) \
                     .filter(ReplyModel.edited_at >= after) \
                     .order_by(ReplyModel.edited_at.desc(), ReplyModel.created_at.desc()) \
                     .limit(limit) \
                     .offset(offset)
 
+    replies_connection = Field(ReplyConnection, first=Argument(type=Int),
+                                                after=Argument(type=String))
+    def resolve_replies_connection(self, info, first=10, after=None):
+        """Page through replies by edit date"""
+        query = planned_query(Reply, info, ('edges', 'node'))
+        return keyset_connection(ReplyConnection, query,
+                                 (ReplyModel.edited_at, ReplyModel.reply_id), first, after)
+
     reaction = Field(Reaction, reaction_id=Argument(type=ID, required=True))
     def resolve_reaction(self, info, reaction_id=None):
         """Query for reaction by ID"""
-        return Reaction.get_query(info).filter(ReactionModel.reaction_id == reaction_id).first()
+        return planned_query(Reaction, info).filter(ReactionModel.reaction_id == reaction_id) \
+                                             .first()
 
     reactions = List(Reaction, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_reactions(self, info, limit=10, offset=0):
         """Query for all reactions by date"""
-        return Reaction.get_query(info).limit(limit).offset(offset)
+        return planned_query(Reaction, info).limit(limit).offset(offset)
+
+    reactions_connection = Field(ReactionConnection, first=Argument(type=Int),
+                                                     after=Argument(type=String))
+    def resolve_reactions_connection(self, info, first=10, after=None):
+        """Page through reactions"""
+        query = planned_query(Reaction, info, ('edges', 'node'))
+        return keyset_connection(ReactionConnection, query,
+                                 (ReactionModel.reaction_id,), first, after, descending=False)
 
     tag = Field(Tag, tag_id=Argument(type=ID, required=True))
     def resolve_tag(self, info, tag_id=None):
         """Query for tag by ID"""
-        return Tag.get_query(info).filter(TagModel.tag_id == tag_id).first()
+        return planned_query(Tag, info).filter(TagModel.tag_id == tag_id).first()
 
     tags = List(Tag, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_tags(self, info, limit=10, offset=0):
         """Query for all tags"""
-        return Tag.get_query(info).limit(limit).offset(offset)
+        return planned_query(Tag, info).limit(limit).offset(offset)
+
+    tags_connection = Field(TagConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_tags_connection(self, info, first=10, after=None):
+        """Page through tags"""
+        query = planned_query(Tag, info, ('edges', 'node'))
+        return keyset_connection(TagConnection, query,
+                                 (TagModel.tag_id,), first, after, descending=False)
 
     manufacturer = Field(Manufacturer, manufacturer_id=Argument(type=ID, required=True))
     def resolve_manufacturer(self, info, manufacturer_id=None):
         """Query for manufacturer by ID"""
-        return Manufacturer.get_query(info) \
+        return planned_query(Manufacturer, info) \
                            .filter(ManufacturerModel.manufacturer_id == manufacturer_id) \
                            .first()
 
     manufacturers = List(Manufacturer, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_manufacturers(self, info, limit=10, offset=0):
         """Query for all manufacturers"""
-        return Manufacturer.get_query(info) \
+        return planned_query(Manufacturer, info) \
                            .order_by(ManufacturerModel.manufacturer_name) \
                            .limit(limit) \
                            .offset(offset)
 
+    manufacturers_connection = Field(ManufacturerConnection, first=Argument(type=Int),
+                                                             after=Argument(type=String))
+    def resolve_manufacturers_connection(self, info, first=10, after=None):
+        """Page through manufacturers by name"""
+        query = planned_query(Manufacturer, info, ('edges', 'node'))
+        return keyset_connection(ManufacturerConnection, query,
+                                 (ManufacturerModel.manufacturer_name,
+                                  ManufacturerModel.manufacturer_id),
+                                 first, after, descending=False)
+
     camera = Field(Camera, camera_id=Argument(type=ID, required=True))
     def resolve_camera(self, info, camera_id=None):
         """Query for camera by ID"""
-        return Camera.get_query(info).filter(CameraModel.camera_id == camera_id).first()
+        return planned_query(Camera, info).filter(CameraModel.camera_id == camera_id).first()
 
     cameras = List(Camera, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_cameras(self, info, limit=10, offset=0):
         """Query for all cameras"""
-        return Camera.get_query(info) \
+        return planned_query(Camera, info) \
                      .order_by(CameraModel.camera_model) \
                      .limit(limit) \
                      .offset(offset)
 
+    cameras_connection = Field(CameraConnection, first=Argument(type=Int),
+                                                 after=Argument(type=String))
+    def resolve_cameras_connection(self, info, first=10, after=None):
+        """Page through cameras by model"""
+        query = planned_query(Camera, info, ('edges', 'node'))
+        return keyset_connection(CameraConnection, query,
+                                 (CameraModel.camera_model, CameraModel.camera_id),
+                                 first, after, descending=False)
+
     lens = Field(Lens, lens_id=Argument(type=ID, required=True))
     def resolve_lens(self, info, lens_id=None):
         """Query for lens by ID"""
-        return Lens.get_query(info).filter(LensModel.lens_id == lens_id).first()
+        return planned_query(Lens, info).filter(LensModel.lens_id == lens_id).first()
 
     lenses = List(Lens, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_lenses(self, info, limit=10, offset=0):
         """Query for all lenses"""
-        return Lens.get_query(info) \
+        return planned_query(Lens, info) \
                    .order_by(LensModel.lens_model) \
                    .limit(limit) \
                    .offset(offset)
 
+    lenses_connection = Field(LensConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_lenses_connection(self, info, first=10, after=None):
+        """Page through lenses by model"""
+        query = planned_query(Lens, info, ('edges', 'node'))
+        return keyset_connection(LensConnection, query,
+                                 (LensModel.lens_model, LensModel.lens_id),
+                                 first, after, descending=False)
+
     editor = Field(Editor, editor_id=Argument(type=ID, required=True))
     def resolve_editor(self, info, editor_id=None):
         """Query for editor by ID"""
-        return Editor.get_query(info).filter(EditorModel.editor_id == editor_id).first()
+        return planned_query(Editor, info).filter(EditorModel.editor_id == editor_id).first()
 
     editors = List(Editor, limit=Argument(type=Int), offset=Argument(type=Int))
     def resolve_editors(self, info, limit=10, offset=0):
         """Query for all editors"""
-        return Editor.get_query(info) \
+        return planned_query(Editor, info) \
                      .order_by(EditorModel.editor_name) \
                      .limit(limit) \
                      .offset(offset)
 
+    editors_connection = Field(EditorConnection, first=Argument(type=Int),
+                                                 after=Argument(type=String))
+    def resolve_editors_connection(self, info, first=10, after=None):
+        """Page through editors by name"""
+        query = planned_query(Editor, info, ('edges', 'node'))
+        return keyset_connection(EditorConnection, query,
+                                 (EditorModel.editor_name, EditorModel.editor_id),
+                                 first, after, descending=False)
+
     file = Field(File, file_id=Argument(type=ID, required=True))
     def resolve_file(self, info, file_id=None):
         """Query for file by ID"""
-        return File.get_query(info).filter(FileModel.file_id == file_id).first()
+        return planned_query(File, info).filter(FileModel.file_id == file_id).first()
 
     files = List(File, limit=Argument(Int), offset=Argument(Int),
                  before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_files(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all files"""
-        return File.get_query(info) \
+        return planned_query(File, info) \
                    .filter(FileModel.created_at < before) \
                    .filter(FileModel.created_at >= after) \
                    .order_by(FileModel.created_at.desc()) \
                    .limit(limit) \
                    .offset(offset)
 
+    files_connection = Field(FileConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_files_connection(self, info, first=10, after=None):
+        """Page through files by creation date"""
+        query = planned_query(File, info, ('edges', 'node'))
+        return keyset_connection(FileConnection, query,
+                                 (FileModel.created_at, FileModel.file_id), first, after)
+
     event = Field(Event, event_id=Argument(type=ID, required=True))
     def resolve_event(self, info, event_id=None):
         if event_id is not None:
-            return Event.get_query(info).filter(EventModel.event_id == event_id).first()
+            return planned_query(Event, info).filter(EventModel.event_id == event_id).first()
         return None
 
     events = List(Event, limit=Argument(type=Int), offset=Argument(type=Int),
                   before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_events(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all event items"""
-        return Event.get_query(info) \
+        return planned_query(Event, info) \
                     .filter(EventModel.created_at < before) \
                     .filter(EventModel.created_at >= after) \
                     .order_by(EventModel.created_at.desc()) \
                     .limit(limit) \
                     .offset(offset)
 
+    events_connection = Field(EventConnection, first=Argument(type=Int),
+                                               after=Argument(type=String))
+    def resolve_events_connection(self, info, first=10, after=None):
+        """Page through events by creation date"""
+        query = planned_query(Event, info, ('edges', 'node'))
+        return keyset_connection(EventConnection, query,
+                                 (EventModel.created_at, EventModel.event_id), first, after)
+
+    feed = List(FeedItem, cursor=Argument(type=String), limit=Argument(type=Int))
+    def resolve_feed(self, info, cursor=None, limit=10):
+        """Read the global feed, newest first, after the item a cursor points to"""
+        query = planned_query(FeedItem, info).order_by(FeedItemModel.feed_item_id.desc())
+        if cursor is not None:
+            (feed_item_id,) = decode_cursor(cursor, (FeedItemModel.feed_item_id,))
+            query = query.filter(FeedItemModel.feed_item_id < feed_item_id)
+        return query.limit(limit)
+
+    timeline = List(TimelineItem, cursor=Argument(type=String), limit=Argument(type=Int))
+    def resolve_timeline(self, info, cursor=None, limit=10):
+        """Read the viewer's timeline of followed accounts, newest first, after a cursor"""
+        viewer = info.context['viewer']()
+        if viewer is None:
+            raise ValueError('Sign in to read a timeline')
+        before = None
+        if cursor is not None:
+            before = decode_cursor(cursor, (EventModel.created_at, EventModel.event_id))
+        keys = read_timeline(info.context['session'], viewer.account_id, before, limit)
+        events = planned_query(Event, info, ('event',)) \
+                     .filter(EventModel.event_id.in_([event_id for _, event_id in keys])) \
+                     .all()
+        events = {event.event_id: event for event in events}
+        return [TimelineItem(cursor=encode_cursor(key), event=events[key[1]])
+                for key in keys if key[1] in events]
+
     notification = Field(Notification, notification_id=Argument(type=ID, required=True))
     def resolve_notification(self, info, notification_id=None):
         """Query for notification by ID"""
-        return Notification.get_query(info) \
+        return planned_query(Notification, info) \
                            .filter(NotificationModel.notification_id == notification_id) \
                            .first()
 
@@ -277,43 +500,66 @@ class Query(ObjectType):
     def resolve_notifications(self, info, limit=10, offset=0,
                               before=datetime.max, after=datetime.min):
         """Query for all notifications"""
-        return Notification.get_query(info) \
+        return planned_query(Notification, info) \
                            .filter(NotificationModel.created_at < before) \
                            .filter(NotificationModel.created_at >= after) \
                            .order_by(NotificationModel.created_at.desc()) \
                            .limit(limit) \
                            .offset(offset)
 
+    notifications_connection = Field(NotificationConnection, first=Argument(type=Int),
+                                                             after=Argument(type=String))
+    def resolve_notifications_connection(self, info, first=10, after=None):
+        """Page through notifications by creation date"""
+        query = planned_query(Notification, info, ('edges', 'node'))
+        return keyset_connection(NotificationConnection, query,
+                                 (NotificationModel.created_at, NotificationModel.notification_id),
+                                 first, after)
+
     flag = Field(Flag, flag_id=Argument(type=ID, required=True))
     def resolve_flag(self, info, flag_id=None):
         """Query for flag by ID"""
-        return Flag.get_query(info).filter(FlagModel.flag_id == flag_id).first()
+        return planned_query(Flag, info).filter(FlagModel.flag_id == flag_id).first()
 
     flags = List(Flag, limit=Argument(type=Int), offset=Argument(type=Int),
                  before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_flags(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all flags"""
-        return Flag.get_query(info) \
+        return planned_query(Flag, info) \
                    .filter(FlagModel.created_at < before) \
                    .filter(FlagModel.created_at >= after) \
                    .order_by(FlagModel.created_at.desc()) \
                    .limit(limit) \
                    .offset(offset)
 
+    flags_connection = Field(FlagConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_flags_connection(self, info, first=10, after=None):
+        """Page through flags by creation date"""
+        query = planned_query(Flag, info, ('edges', 'node'))
+        return keyset_connection(FlagConnection, query,
+                                 (FlagModel.created_at, FlagModel.flag_id), first, after)
+
     ban = Field(Ban, ban_id=Argument(type=ID, required=True))
     def resolve_ban(self, info, ban_id):
         """Query for ban by ID"""
-        return Ban.get_query(info).filter(BanModel.ban_id == ban_id).first()
+        return planned_query(Ban, info).filter(BanModel.ban_id == ban_id).first()
 
     bans = List(Ban, limit=Argument(type=Int), offset=Argument(type=Int),
                 before=Argument(type=DateTime), after=Argument(type=DateTime))
     def resolve_bans(self, info, limit=10, offset=0, before=datetime.max, after=datetime.min):
         """Query for all bans"""
-        return Ban.get_query(info) \
+        return planned_query(Ban, info) \
                   .filter(BanModel.created_at < before) \
                   .filter(BanModel.created_at >= after) \
                   .order_by(BanModel.created_at.desc()) \
                   .limit(limit) \
                   .offset(offset)
 
+    bans_connection = Field(BanConnection, first=Argument(type=Int), after=Argument(type=String))
+    def resolve_bans_connection(self, info, first=10, after=None):
+        """Page through bans by creation date"""
+        query = planned_query(Ban, info, ('edges', 'node'))
+        return keyset_connection(BanConnection, query,
+                                 (BanModel.created_at, BanModel.ban_id), first, after)
+
 schema = Schema(query=Query)
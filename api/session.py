@@ -1,58 +1,139 @@
-import os
-import string
+import secrets
+import threading
+import time
 from datetime import datetime
-from random import SystemRandom
 from utils import load_config
 from mailer import sendSignInMagicLink
+from session_store import create_session_store
+from session_token import (DenyList, create_signed_token, is_signed_token, load_signing_keys,
+                           read_signed_token)
 
-unverified_sessions = {}
-sessions = {}
-session_insert_queue = []
+_store = None
+_store_lock = threading.RLock()
+_last_sweep_at = 0
+_deny_list = None
+_signing_keys = load_signing_keys()
+
+def get_store():
+    """Return the session store configured in config.json, creating it on first use"""
+    global _store # pylint: disable=global-statement
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_session_store(load_config().get('session_store'))
+    return _store
+
+def get_deny_list():
+    """Return the deny-list of revoked signed tokens, creating it on first use"""
+    global _deny_list # pylint: disable=global-statement
+    if _deny_list is None:
+        with _store_lock:
+            if _deny_list is None:
+                _deny_list = DenyList(get_store(), load_config('session_recycle_interval'))
+    return _deny_list
+
+def use_signed_tokens():
+    """Whether signed in sessions are issued as stateless signed tokens"""
+    return load_config().get('session_token_mode', 'opaque') == 'signed'
+
+def get_expiry(kind, now):
+    """Return the timestamp at which a session created or seen at `now` expires"""
+    if kind == 'unverified':
+        return now + load_config('magic_link_max_age')
+    return now + load_config('session_max_age')
+
+def sweep_sessions():
+    """Evict a batch of expired sessions, at most once per session_recycle_interval"""
+    global _last_sweep_at # pylint: disable=global-statement
+    now = time.time()
+    if now - _last_sweep_at < load_config('session_recycle_interval'):
+        return 0
+    _last_sweep_at = now
+    return get_store().sweep(now)
+
+def session_stats():
+    """Return counters of live, expired and evicted sessions"""
+    return get_store().stats()
 
 def create_token(length=192):
-    return ''.join([SystemRandom().choice(
-        string.ascii_uppercase + string.ascii_lowercase + string.digits
-    ) for _ in range(length)])
+    # token_urlsafe encodes 3 random bytes into every 4 characters
+    return secrets.token_urlsafe(length * 3 // 4)[:length]
 
 def create_session(account_email):
+    sweep_sessions()
     token = create_token()
     sendSignInMagicLink(account_email, token)
     now = datetime.now()
-    unverified_sessions[token] = {
+    get_store().put('unverified', token, {
         'created_at': now,
         'verified_at': None,
         'last_seen_at': now,
         'account_email': account_email,
-    }
+    }, get_expiry('unverified', time.time()))
     return None
 
 def authenticate_session(tmp_token):
-    if tmp_token in unverified_sessions:
-        session = unverified_sessions[tmp_token]
+    session = get_store().pop('unverified', tmp_token)
+    if session is not None and use_signed_tokens():
+        return create_signed_token(session['account_email'], load_config('session_max_age'),
+                                   _signing_keys)
+    if session is not None:
         token = create_token()
-        session['verified_at'] = datetime.now()
-        sessions[token] = session
-        del unverified_sessions[tmp_token]
+        session['verified_at'] = session['last_seen_at'] = datetime.now()
+        get_store().put('verified', token, session, get_expiry('verified', time.time()))
         return token
     return None
 
 def refresh_session(prev_token):
-    if prev_token in sessions:
+    if is_signed_token(prev_token):
+        session = get_session(prev_token)
+        if session is None:
+            return None
+        delete_session(prev_token)
+        return create_signed_token(session['account_email'], load_config('session_max_age'),
+                                   _signing_keys)
+    session = get_store().pop('verified', prev_token)
+    if session is not None:
         token = create_token()
-        sessions[token] = sessions[prev_token]
-        del unverified_sessions[prev_token]
+        get_store().put('verified', token, session, get_expiry('verified', time.time()))
         return token
     return None
 
 def verify_session(token):
-    return token in sessions
+    return get_session(token) is not None
+
+def get_signed_session(token):
+    """Build a session from a signed token's claims, without any session lookup"""
+    claims = read_signed_token(token, _signing_keys)
+    if claims is None or get_deny_list().is_revoked(claims):
+        return None
+    issued_at = datetime.fromtimestamp(claims['iat'])
+    return {
+        'created_at': issued_at,
+        'verified_at': issued_at,
+        'last_seen_at': issued_at,
+        'account_email': claims['e'],
+    }
 
 def get_session(token):
-    if token in sessions:
-        return sessions[token]
-    return None
+    if is_signed_token(token):
+        return get_signed_session(token)
+    sweep_sessions()
+    session = get_store().get('verified', token)
+    if session is None:
+        return None
+    # only write last_seen_at back once per interval, so lookups mostly stay reads
+    now = datetime.now()
+    if (now - session['last_seen_at']).total_seconds() >= load_config('session_recycle_interval'):
+        session['last_seen_at'] = now
+        get_store().put('verified', token, session, get_expiry('verified', time.time()))
+    return session
 
 def delete_session(token):
-    if token in sessions:
-        del sessions[token]
+    if is_signed_token(token):
+        claims = read_signed_token(token, _signing_keys)
+        if claims is not None:
+            get_deny_list().revoke(claims)
+        return None
+    get_store().delete('verified', token)
     return None
@@ -0,0 +1,422 @@
+"""
+Session storage backends
+
+Sessions are kept outside of the Flask worker's memory so that uWSGI can run
+more than one process and sessions survive worker restarts. Each backend
+stores three kinds of entries, keyed by token:
+- 'unverified': sessions waiting for their magic link to be clicked
+- 'verified':   sessions that have been authenticated
+- 'revoked':    ids of signed tokens that were signed out before they expired,
+                and the revocation version that tells workers to reload them
+
+Every session is stored with an expiry timestamp. Expired sessions are
+removed lazily when they are looked up, and in small batches by sweep().
+
+Backends are selected with the "session_store" object in config.json:
+- {"backend": "memory"}                                   single process only
+- {"backend": "sqlite", "path": "/tmp/sessions.sqlite3"}  shared by local processes
+- {"backend": "redis", "host": "redis", "port": 6379}     any Redis protocol server
+"""
+
+import abc
+import heapq
+import json
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+SESSION_KINDS = ('unverified', 'verified', 'revoked')
+SESSION_DATE_KEYS = ('created_at', 'verified_at', 'last_seen_at')
+SWEEP_BATCH_SIZE = 500 # max number of expired sessions evicted by one sweep
+
+def encode_session(session):
+    """Serialize a session dict to JSON"""
+    return json.dumps({
+        k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in session.items()
+    })
+
+def decode_session(data):
+    """Deserialize a session dict from JSON"""
+    session = json.loads(data)
+    for key in SESSION_DATE_KEYS:
+        if session.get(key) is not None:
+            session[key] = datetime.fromisoformat(session[key])
+    return session
+
+class SessionStore(abc.ABC):
+    """
+    Interface implemented by all session storage backends
+
+    Counters are kept per process:
+    - expired: sessions found to be expired when they were looked up
+    - evicted: expired sessions removed by sweep()
+    """
+    def __init__(self):
+        self.counters = {'expired': 0, 'evicted': 0}
+
+    @abc.abstractmethod
+    def get(self, kind, token, now=None):
+        """Return the session stored under a token, or None if it is missing or expired"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, kind, token, session, expires_at):
+        """Store a session under a token until the expires_at timestamp"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pop(self, kind, token, now=None):
+        """Atomically remove and return the session stored under a token, or None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, kind, token):
+        """Remove the session stored under a token"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def tokens(self, kind, now=None):
+        """Return the tokens of all live sessions of a kind"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sweep(self, now=None, limit=SWEEP_BATCH_SIZE):
+        """Remove up to limit expired sessions and return how many were removed"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self, now=None):
+        """Return the number of live sessions of each kind"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return counters of live, expired and evicted sessions"""
+        return {'live': self.count(), **self.counters}
+
+class MemorySessionStore(SessionStore):
+    """
+    Process-local store, only suitable when uWSGI runs a single process
+
+    Expiry times are indexed with a min-heap of (expires_at, kind, token).
+    Entries for sessions that were refreshed or deleted are left in the heap
+    and skipped when they reach the top.
+    """
+    def __init__(self):
+        super().__init__()
+        self.sessions = {kind: {} for kind in SESSION_KINDS}
+        self.expiry_heap = []
+        self.lock = threading.Lock()
+
+    def _remove_expired(self, kind, token, now):
+        entry = self.sessions[kind].get(token)
+        if entry is not None and entry[1] <= now:
+            del self.sessions[kind][token]
+            self.counters['expired'] += 1
+            return None
+        return entry
+
+    def get(self, kind, token, now=None):
+        with self.lock:
+            entry = self._remove_expired(kind, token, now or time.time())
+        return entry[0] if entry else None
+
+    def put(self, kind, token, session, expires_at):
+        with self.lock:
+            self.sessions[kind][token] = (session, expires_at)
+            heapq.heappush(self.expiry_heap, (expires_at, kind, token))
+            if len(self.expiry_heap) > 2 * sum(map(len, self.sessions.values())) + 64:
+                self._compact()
+
+    def _compact(self):
+        """Rebuild the heap without stale entries"""
+        self.expiry_heap = [(expires_at, kind, token)
+                            for kind, sessions in self.sessions.items()
+                            for token, (_, expires_at) in sessions.items()]
+        heapq.heapify(self.expiry_heap)
+
+    def pop(self, kind, token, now=None):
+        with self.lock:
+            entry = self._remove_expired(kind, token, now or time.time())
+            if entry is None:
+                return None
+            del self.sessions[kind][token]
+        return entry[0]
+
+    def delete(self, kind, token):
+        with self.lock:
+            self.sessions[kind].pop(token, None)
+
+    def tokens(self, kind, now=None):
+        now = now or time.time()
+        with self.lock:
+            return [token for token, (_, expires_at) in self.sessions[kind].items()
+                    if expires_at > now]
+
+    def sweep(self, now=None, limit=SWEEP_BATCH_SIZE):
+        now = now or time.time()
+        evicted = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now and evicted < limit:
+                expires_at, kind, token = heapq.heappop(self.expiry_heap)
+                entry = self.sessions[kind].get(token)
+                if entry is not None and entry[1] == expires_at:
+                    del self.sessions[kind][token]
+                    evicted += 1
+            self.counters['evicted'] += evicted
+        return evicted
+
+    def count(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            return {kind: sum(1 for _, expires_at in sessions.values() if expires_at > now)
+                    for kind, sessions in self.sessions.items()}
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Store shared by all processes on one host through an SQLite database in WAL mode
+
+    Connections are opened per thread and per process, since uWSGI forks
+    workers after the app module has been imported. Expiry times are indexed
+    so sweeps only visit expired rows.
+    """
+    def __init__(self, path, busy_timeout=5000):
+        super().__init__()
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS session ('
+                     'kind TEXT NOT NULL, '
+                     'token TEXT NOT NULL, '
+                     'data TEXT NOT NULL, '
+                     'expires_at REAL NOT NULL DEFAULT 0, '
+                     'PRIMARY KEY (kind, token)) WITHOUT ROWID')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(session)')]
+        if 'expires_at' not in columns:
+            conn.execute('ALTER TABLE session ADD COLUMN expires_at REAL NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS session_expires_at ON session (expires_at)')
+
+    def connect(self):
+        """Return this thread's connection, opening a new one after a fork"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000,
+                                   isolation_level=None)
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, kind, token, now=None):
+        row = self.connect().execute('SELECT data, expires_at FROM session '
+                                     'WHERE kind = ? AND token = ?', (kind, token)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= (now or time.time()):
+            self.delete(kind, token)
+            self.counters['expired'] += 1
+            return None
+        return decode_session(row[0])
+
+    def put(self, kind, token, session, expires_at):
+        self.connect().execute('INSERT OR REPLACE INTO session (kind, token, data, expires_at) '
+                               'VALUES (?, ?, ?, ?)',
+                               (kind, token, encode_session(session), expires_at))
+
+    def pop(self, kind, token, now=None):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data, expires_at FROM session '
+                               'WHERE kind = ? AND token = ?', (kind, token)).fetchone()
+            if row:
+                conn.execute('DELETE FROM session WHERE kind = ? AND token = ?', (kind, token))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        if row[1] <= (now or time.time()):
+            self.counters['expired'] += 1
+            return None
+        return decode_session(row[0])
+
+    def delete(self, kind, token):
+        self.connect().execute('DELETE FROM session WHERE kind = ? AND token = ?',
+                               (kind, token))
+
+    def tokens(self, kind, now=None):
+        rows = self.connect().execute('SELECT token FROM session '
+                                      'WHERE kind = ? AND expires_at > ?',
+                                      (kind, now or time.time()))
+        return [row[0] for row in rows]
+
+    def sweep(self, now=None, limit=SWEEP_BATCH_SIZE):
+        cursor = self.connect().execute(
+            'DELETE FROM session WHERE (kind, token) IN ('
+            'SELECT kind, token FROM session WHERE expires_at <= ? '
+            'ORDER BY expires_at LIMIT ?)', (now or time.time(), limit))
+        self.counters['evicted'] += cursor.rowcount
+        return cursor.rowcount
+
+    def count(self, now=None):
+        rows = self.connect().execute('SELECT kind, COUNT(*) FROM session '
+                                      'WHERE expires_at > ? GROUP BY kind',
+                                      (now or time.time(),)).fetchall()
+        return {kind: dict(rows).get(kind, 0) for kind in SESSION_KINDS}
+
+class RespError(Exception):
+    """Error reply from a Redis protocol server"""
+
+class RespClient:
+    """Minimal client for servers speaking the Redis serialization protocol (RESP2)"""
+    def __init__(self, host='localhost', port=6379, password=None, db=0, timeout=5):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        """Return this thread's socket reader, reconnecting after a fork"""
+        reader = getattr(self.local, 'reader', None)
+        if reader is None or self.local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.sock = sock
+            self.local.reader = sock.makefile('rb')
+            self.local.pid = os.getpid()
+            if self.password:
+                self.send('AUTH', self.password)
+            if self.db:
+                self.send('SELECT', self.db)
+        return self.local.reader
+
+    def close(self):
+        """Close this thread's connection"""
+        if getattr(self.local, 'reader', None) is not None:
+            self.local.reader.close()
+            self.local.sock.close()
+        self.local.reader = None
+
+    def send(self, *args):
+        """Send a single command and return its decoded reply"""
+        reader = self.connect()
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(f'${len(arg)}\r\n'.encode() + arg + b'\r\n')
+        self.local.sock.sendall(b''.join(parts))
+        return self.read_reply(reader)
+
+    def execute(self, *args):
+        """Send a command, reconnecting once if the connection was dropped"""
+        try:
+            return self.send(*args)
+        except (ConnectionError, OSError):
+            self.close()
+            return self.send(*args)
+
+    def read_reply(self, reader):
+        """Parse one reply from the server"""
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b'+':
+            return rest.decode()
+        if prefix == b'-':
+            raise RespError(rest.decode())
+        if prefix == b':':
+            return int(rest)
+        if prefix == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply(reader) for _ in range(length)]
+        raise RespError(f'Unknown reply type ({line!r})')
+
+class RedisSessionStore(SessionStore):
+    """
+    Store shared by all hosts through a Redis protocol server
+
+    Keys are written with a TTL, so the server takes care of expiry and
+    sweep() has nothing to do.
+    """
+    def __init__(self, host='localhost', port=6379, password=None, db=0, prefix='session'):
+        super().__init__()
+        self.client = RespClient(host=host, port=port, password=password, db=db)
+        self.prefix = prefix
+
+    def key(self, kind, token):
+        """Return the key a session is stored under"""
+        return f'{self.prefix}:{kind}:{token}'
+
+    def get(self, kind, token, now=None):
+        data = self.client.execute('GET', self.key(kind, token))
+        return decode_session(data) if data is not None else None
+
+    def put(self, kind, token, session, expires_at):
+        ttl = max(1, math.ceil((expires_at - time.time()) * 1000))
+        self.client.execute('SET', self.key(kind, token), encode_session(session), 'PX', ttl)
+
+    def pop(self, kind, token, now=None):
+        key = self.key(kind, token)
+        data = self.client.execute('GET', key)
+        # only the caller that actually deleted the key gets to use the session
+        if data is None or self.client.execute('DEL', key) != 1:
+            return None
+        return decode_session(data)
+
+    def delete(self, kind, token):
+        self.client.execute('DEL', self.key(kind, token))
+
+    def scan(self, kind):
+        """Iterate over the keys of all sessions of a kind"""
+        cursor = b'0'
+        while True:
+            cursor, keys = self.client.execute('SCAN', cursor, 'MATCH',
+                                               self.key(kind, '*'), 'COUNT', 1000)
+            yield from keys
+            if cursor in (b'0', 0):
+                break
+
+    def tokens(self, kind, now=None):
+        prefix_length = len(self.key(kind, ''))
+        return [key[prefix_length:].decode() for key in self.scan(kind)]
+
+    def sweep(self, now=None, limit=SWEEP_BATCH_SIZE):
+        return 0
+
+    def count(self, now=None):
+        return {kind: sum(1 for _ in self.scan(kind)) for kind in SESSION_KINDS}
+
+def create_session_store(options=None):
+    """Create the session store described by the "session_store" config object"""
+    options = dict(options or {})
+    backend = options.pop('backend', 'memory')
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'sqlite':
+        return SQLiteSessionStore(**options)
+    if backend == 'redis':
+        return RedisSessionStore(**options)
+    raise ValueError(f'Unknown session store backend ({backend})')
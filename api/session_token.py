@@ -0,0 +1,162 @@
+"""
+Stateless HMAC-signed session tokens
+
+A signed token carries everything needed to authorize a request, so any
+worker can verify it without a session lookup:
+
+    <key id>.<base64url payload>.<base64url HMAC-SHA256 signature>
+
+The payload holds the account email (e), issue time (iat), expiry (exp) and a
+random token id (jti). Signing keys are read from the SESSION_SIGNING_KEYS
+environment variable as comma separated "key_id:secret" pairs; the first key
+signs new tokens and the rest are only used to verify tokens signed before a
+key rotation.
+
+Revoked token ids are kept in a Bloom filter, so checking a token that was
+never revoked (nearly all of them) costs a few bit lookups, plus one read of
+the revocation version per process every second.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import secrets
+import threading
+import time
+
+REVOCATION_VERSION = '.version' # changed by every revocation, never a token id
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def load_signing_keys(value=None):
+    """Parse signing keys from "key_id:secret,..." into an ordered dict"""
+    value = os.environ.get('SESSION_SIGNING_KEYS', '') if value is None else value
+    keys = {}
+    for pair in value.split(','):
+        if ':' in pair:
+            key_id, secret = pair.strip().split(':', 1)
+            keys[key_id] = secret.encode()
+    return keys
+
+def sign(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+def create_signed_token(account_email, max_age, keys, now=None):
+    """Create a signed token for an account that expires after max_age seconds"""
+    if not keys:
+        raise ValueError('No session signing keys configured')
+    now = int(now or time.time())
+    key_id = next(iter(keys))
+    payload = b64encode(json.dumps({
+        'e': account_email,
+        'iat': now,
+        'exp': now + int(max_age),
+        'jti': secrets.token_urlsafe(16),
+    }, separators=(',', ':')).encode())
+    message = f'{key_id}.{payload}'
+    return f'{message}.{b64encode(sign(keys[key_id], message))}'
+
+def read_signed_token(token, keys, now=None):
+    """Return a signed token's payload, or None if it is malformed, forged or expired"""
+    parts = token.split('.')
+    if len(parts) != 3 or parts[0] not in keys:
+        return None
+    key_id, payload, signature = parts
+    try:
+        expected = sign(keys[key_id], f'{key_id}.{payload}')
+        if not hmac.compare_digest(expected, b64decode(signature)):
+            return None
+        claims = json.loads(b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('exp', 0) <= (now or time.time()):
+        return None
+    return claims
+
+def is_signed_token(token):
+    """Signed tokens contain dots, random opaque tokens never do"""
+    return token.count('.') == 2
+
+class BloomFilter:
+    """Fixed size Bloom filter over strings"""
+    def __init__(self, capacity=100000, error_rate=0.0001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        # derive every position from two 64 bit hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+class DenyList:
+    """
+    Revoked token ids, backed by the session store
+
+    Revocations are written to the store under the 'revoked' kind until the
+    token would have expired anyway, along with a new random version under
+    REVOCATION_VERSION. Each process reads the version every sync_interval
+    seconds and rebuilds its filter as soon as another worker has revoked a
+    token, and at least every refresh_interval seconds to drop ids whose
+    tokens have expired.
+    """
+    def __init__(self, store, refresh_interval=60, capacity=100000, sync_interval=1):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.sync_interval = sync_interval
+        self.capacity = capacity
+        self.filter = BloomFilter(capacity)
+        self.refreshed_at = 0
+        self.synced_at = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    def refresh(self, now=None):
+        """Rebuild the filter from the store if it is old or another worker revoked a token"""
+        now = now or time.time()
+        if now - self.synced_at < self.sync_interval:
+            return
+        with self.lock:
+            if now - self.synced_at < self.sync_interval:
+                return
+            # read the version first, so a revocation made during the rebuild changes it again
+            version = self.store.get('revoked', REVOCATION_VERSION, now)
+            if version != self.version or now - self.refreshed_at >= self.refresh_interval:
+                bloom = BloomFilter(self.capacity)
+                for jti in self.store.tokens('revoked', now):
+                    bloom.add(jti)
+                self.filter = bloom
+                self.refreshed_at = now
+            self.version = version
+            self.synced_at = now
+
+    def revoke(self, claims):
+        """Deny a token until it expires"""
+        self.store.put('revoked', claims['jti'], {}, claims['exp'])
+        self.store.put('revoked', REVOCATION_VERSION, {'version': secrets.token_hex(8)},
+                       claims['exp'])
+        self.filter.add(claims['jti'])
+
+    def is_revoked(self, claims):
+        """Check the filter, confirming hits against the store to rule out false positives"""
+        self.refresh()
+        if claims['jti'] not in self.filter:
+            return False
+        return self.store.get('revoked', claims['jti']) is not None
@@ -0,0 +1,69 @@
+"""
+Single-flight execution of identical concurrent requests
+
+When a popular page's cache entry expires, every request that arrives
+before it's stored again runs the same queries. SingleFlight lets the
+first request for a key do the work while later requests for the same key
+wait for its result. Followers wait at most max_wait seconds, then do the
+work themselves, so a slow leader can't hold up everyone behind it.
+
+Requests are only coalesced within a worker process, between the threads
+set in uwsgi.ini.
+"""
+
+import threading
+
+class Flight:
+    """One in-flight call and the result its followers are waiting for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+class SingleFlight:
+    """
+    Calls deduplicated by key
+
+    Counters are kept per process:
+    - leaders:   calls that did the work
+    - coalesced: calls that got a leader's result instead
+    - timeouts:  followers that gave up waiting and did the work themselves
+    - failures:  followers whose leader raised, which also did the work themselves
+    """
+    def __init__(self, max_wait=2.0):
+        self.max_wait = max_wait
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counters = {'leaders': 0, 'coalesced': 0, 'timeouts': 0, 'failures': 0}
+
+    def do(self, key, fn):
+        """Return fn()'s result and whether it came from another call with the same key"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.counters['leaders'] += 1
+        if leader:
+            try:
+                flight.result = fn()
+            except Exception:
+                flight.failed = True
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+            return flight.result, False
+        if not flight.done.wait(self.max_wait):
+            self.counters['timeouts'] += 1
+            return fn(), False
+        if flight.failed:
+            self.counters['failures'] += 1
+            return fn(), False
+        self.counters['coalesced'] += 1
+        return flight.result, True
+
+    def stats(self):
+        """Return the counters and the number of calls in flight"""
+        return dict(self.counters, in_flight=len(self.flights))
@@ -0,0 +1,8 @@
+"""Run tests against the repository's config.json and the modules in api/"""
+
+import os
+import sys
+
+os.environ.setdefault('FOCAL_CONFIG_PATH',
+                      os.path.join(os.path.dirname(__file__), '..', '..', 'config.json'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
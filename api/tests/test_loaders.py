@@ -0,0 +1,62 @@
+"""The number of queries a GraphQL request runs doesn't grow with its page size"""
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from loaders import Loaders
+from model import Account, Base, File, FileRendition, Photo, Tag
+from schema import schema
+
+PHOTOS_QUERY = '''
+query Photos($limit: Int) {
+  photos(limit: $limit) {
+    account { accountHandle }
+    previewFile { srcset }
+    tags { tagName }
+  }
+}
+'''
+
+@pytest.fixture(name='engine')
+def fixture_engine():
+    """A throwaway database with 50 photos, each by its own account"""
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        tags = [Tag(tag_name=f'tag{i}') for i in range(3)]
+        session.add_all(tags)
+        for i in range(50):
+            account = Account(account_name=f'account{i}', account_handle=f'account{i}',
+                              account_email=f'account{i}@example.com')
+            preview = File(file_path=f'/photos/{i}.jpg', file_name=f'{i}',
+                           file_extension='jpg', file_size=1)
+            preview.renditions = [FileRendition(file_path=f'/photos/{i}-640.jpg',
+                                                file_extension='jpg', file_size=1,
+                                                image_width=640, image_height=480)]
+            session.add(Photo(account=account, preview_file=preview, tags=tags,
+                              photo_title=f'photo{i}', photo_text='', lens_filter=''))
+        session.commit()
+    return engine
+
+def count_statements(engine, limit):
+    """Run the photos query with a fresh session and loaders, counting its statements"""
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        with Session(engine) as session:
+            context = {'session': session, 'loaders': Loaders(session)}
+            result = schema.execute(PHOTOS_QUERY, variable_values={'limit': limit},
+                                    context_value=context)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert result.errors is None
+    assert len(result.data['photos']) == limit
+    assert all(photo['account'] and photo['previewFile']['srcset'] and len(photo['tags']) == 3
+               for photo in result.data['photos'])
+    return len(statements)
+
+def test_query_count_is_constant(engine):
+    assert count_statements(engine, 5) == count_statements(engine, 50) == 5
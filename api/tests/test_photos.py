@@ -0,0 +1,80 @@
+"""Photo uploads fill in what the client didn't send from the files' EXIF tags"""
+
+import importlib
+import io
+import struct
+import pytest
+from PIL import Image
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+import db
+import fanout
+import feed
+import outbox
+import utils
+from exif import read_metadata_from_buffer
+from model import Account, Base, Photo
+
+TAG_EXIF_IFD = 0x8769
+TAG_EXPOSURE_TIME = 0x829A
+TAG_FLASH = 0x9209
+
+class PendingPreviews:
+    """Image pool that keeps previews instead of rendering them"""
+    def __init__(self):
+        self.previews = []
+
+    def submit_preview(self, file_id, *args):
+        self.previews.append(file_id)
+
+@pytest.fixture(name='client')
+def fixture_client(monkeypatch, tmp_path):
+    """A test client of the API on a throwaway database, signed in as one account"""
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, 'engine', engine)
+    monkeypatch.setattr(db.catalog, 'engine', engine)
+    db.db_session.configure(bind=engine)
+    # no background workers, they would share the test's connection
+    monkeypatch.setattr(feed.feed_builder, 'start', lambda: None)
+    monkeypatch.setattr(fanout.fanout_worker, 'start', lambda: None)
+    monkeypatch.setattr(outbox, 'get_outbox', lambda: None)
+    config = {**utils.load_config(), 'file_storage_path': str(tmp_path),
+              'config_reload_interval': 3600}
+    monkeypatch.setattr(utils, '_config', utils.ConfigSnapshot(config, utils._stat_config()))
+    monkeypatch.setattr(utils, '_config_checked_at', float('inf'))
+    app = importlib.import_module('app')
+    monkeypatch.setattr(app, 'get_session', lambda token: {'account_email': 'a@example.com'})
+    monkeypatch.setattr(app, 'get_image_pool', PendingPreviews)
+    session = db.db_session()
+    session.add(Account(account_name='a', account_handle='a', account_email='a@example.com'))
+    session.commit()
+    yield app.app.test_client()
+    db.db_session.remove()
+
+def jpeg_with_flash(flash):
+    """Encode a small JPEG whose EXIF has a Flash tag"""
+    exif = Image.Exif()
+    exif.get_ifd(TAG_EXIF_IFD)[TAG_FLASH] = flash
+    data = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(data, 'JPEG', exif=exif)
+    return data.getvalue()
+
+@pytest.mark.parametrize('flash, fired', [(0x19, True), (0x10, False)])
+def test_upload_reads_flash(client, flash, fired):
+    """The Flash tag is stored as a boolean, whether the flash fired or not"""
+    response = client.put('/photo', headers={'Authorization': 'token'}, data={
+        'photo_title': 'flash',
+        'preview_file': (io.BytesIO(jpeg_with_flash(flash)), 'flash.jpg'),
+    })
+    assert response.status_code == 201, response.data
+    photo = db.db_session().get(Photo, response.get_json()['photoId'])
+    assert photo.flash is fired
+
+def test_malformed_tag_only_drops_its_field():
+    """An ExposureTime without values doesn't keep the Flash tag from being read"""
+    entries = [(TAG_EXPOSURE_TIME, 5, 0, 0), (TAG_FLASH, 3, 1, 1)]
+    tiff = b'II*\0' + struct.pack('<L', 8) + struct.pack('<H', len(entries)) \
+           + b''.join(struct.pack('<HHLL', *entry) for entry in entries) + struct.pack('<L', 0)
+    assert read_metadata_from_buffer(tiff) == {'flash': True}
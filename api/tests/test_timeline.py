@@ -0,0 +1,55 @@
+"""Timelines page through followed accounts' events without a query per author"""
+
+import random
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from model import Account, AccountBlock, AccountFollow, Base, Event
+from timeline import Timelines
+
+@pytest.fixture(name='session')
+def fixture_session():
+    """A viewer following 30 accounts, one of which blocks them, with 1500 events"""
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    accounts = [Account(account_name=f'account{i}', account_handle=f'account{i}',
+                        account_email=f'account{i}@example.com') for i in range(31)]
+    session.add_all(accounts)
+    session.flush()
+    viewer, blocker, *authors = [account.account_id for account in accounts]
+    session.execute(AccountFollow.insert(), [{'follower_id': viewer, 'following_id': author}
+                                             for author in [blocker, *authors]])
+    session.execute(AccountBlock.insert(), [{'blocker_id': blocker, 'blocked_id': viewer}])
+    rng = random.Random(0)
+    start = datetime(2026, 1, 1)
+    session.add_all([Event(event_type='submit_photo', account_id=rng.choice([blocker, *authors]),
+                           created_at=start + timedelta(seconds=rng.randint(0, 3000)))
+                     for _ in range(1500)])
+    session.commit()
+    yield session, viewer, authors
+    session.close()
+
+def test_pages_match_a_full_sort(session):
+    session, viewer, authors = session
+    expected = [tuple(key) for key in
+                session.query(Event.created_at, Event.event_id)
+                       .filter(Event.account_id.in_(authors))
+                       .order_by(Event.created_at.desc(), Event.event_id.desc())]
+    statements = []
+    event.listen(session.get_bind(), 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    timelines = Timelines(head_size=3, author_ttl=1000)
+    keys, before, pages = [], None, 0
+    while True:
+        page = timelines.read(session, viewer, before, 10)
+        if not page:
+            break
+        keys += page
+        before = page[-1]
+        pages += 1
+    assert keys == expected
+    # one query for the follows, one for the authors' heads, then about one
+    # extension per page instead of one per author
+    assert len(statements) < 2 * pages
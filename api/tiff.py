@@ -0,0 +1,162 @@
+"""
+Minimal reader for TIFF structured files
+
+Most camera raw formats (NEF, CR2, ARW, DNG, ORF, RW2, PEF, ...) and EXIF
+blocks are TIFF files: a byte order mark, a magic number and a chain of
+image file directories (IFDs) whose entries point at values elsewhere in
+the file. This reader works on any buffer (bytes or an mmap) and only
+touches the bytes of the entries it is asked for, so it never reads image
+data.
+"""
+
+import struct
+
+# byte size of each TIFF field type
+TYPE_SIZES = {
+    1: 1,   # BYTE
+    2: 1,   # ASCII
+    3: 2,   # SHORT
+    4: 4,   # LONG
+    5: 8,   # RATIONAL
+    6: 1,   # SBYTE
+    7: 1,   # UNDEFINED
+    8: 2,   # SSHORT
+    9: 4,   # SLONG
+    10: 8,  # SRATIONAL
+    11: 4,  # FLOAT
+    12: 8,  # DOUBLE
+    13: 4,  # IFD
+}
+TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'L', 6: 'b', 8: 'h', 9: 'l', 11: 'f', 12: 'd', 13: 'L'}
+
+# magic numbers following the byte order mark
+TIFF_MAGIC = (
+    42,      # TIFF, DNG, NEF, CR2, ARW, PEF, ...
+    0x4F52,  # Olympus ORF ("RO")
+    0x5352,  # Olympus ORF ("RS")
+    0x0055,  # Panasonic RW2
+)
+
+TAG_SUB_IFDS = 0x014A
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+
+class TiffError(ValueError):
+    """The buffer isn't a TIFF structure or one of its offsets is out of bounds"""
+
+class Entry:
+    """One IFD entry, whose value is only decoded when asked for"""
+    __slots__ = ('reader', 'tag', 'type', 'count', 'value_offset')
+
+    def __init__(self, reader, tag, field_type, count, value_offset):
+        self.reader = reader
+        self.tag = tag
+        self.type = field_type
+        self.count = count
+        self.value_offset = value_offset
+
+    @property
+    def size(self):
+        return TYPE_SIZES.get(self.type, 1) * self.count
+
+    def raw(self):
+        """Return the entry's value bytes as a memoryview of the buffer"""
+        return self.reader.slice(self.value_offset, self.size)
+
+    def values(self):
+        """Decode the entry's value as a tuple"""
+        reader = self.reader
+        if self.type == 2:
+            return (bytes(self.raw()).split(b'\0', 1)[0].decode('utf-8', 'replace').strip(),)
+        if self.type in (5, 10):
+            fmt = 'L' if self.type == 5 else 'l'
+            numbers = reader.unpack(f'{2 * self.count}{fmt}', self.value_offset)
+            return tuple(numerator / denominator if denominator else None
+                         for numerator, denominator in zip(numbers[::2], numbers[1::2]))
+        if self.type in TYPE_FORMATS:
+            return reader.unpack(f'{self.count}{TYPE_FORMATS[self.type]}', self.value_offset)
+        return (bytes(self.raw()),)
+
+    def rationals(self):
+        """Decode a RATIONAL or SRATIONAL entry as (numerator, denominator) pairs"""
+        if self.type not in (5, 10):
+            raise TiffError(f'Entry is not a rational ({self.tag:#x})')
+        fmt = 'L' if self.type == 5 else 'l'
+        numbers = self.reader.unpack(f'{2 * self.count}{fmt}', self.value_offset)
+        return tuple(zip(numbers[::2], numbers[1::2]))
+
+    def value(self):
+        """Decode the entry's first value"""
+        values = self.values()
+        return values[0] if values else None
+
+class TiffReader:
+    """
+    Reader for the TIFF structure starting at `base` in a buffer
+
+    Offsets inside a TIFF structure are relative to its header, which is
+    not at the start of the buffer for EXIF blocks and MakerNotes.
+    """
+    def __init__(self, buffer, base=0):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.base = base
+        header = bytes(self.view[base:base + 8])
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            raise TiffError('Not a TIFF structure')
+        self.byte_order = '<' if header[:2] == b'II' else '>'
+        magic, self.first_ifd = struct.unpack(self.byte_order + 'HL', header[2:8])
+        if magic not in TIFF_MAGIC:
+            raise TiffError(f'Unknown TIFF magic number ({magic:#x})')
+
+    def slice(self, offset, length):
+        """Return a bounds checked memoryview of length bytes at a TIFF offset"""
+        start = self.base + offset
+        if offset < 0 or length < 0 or start + length > len(self.view):
+            raise TiffError(f'Offset out of bounds ({offset}+{length})')
+        return self.view[start:start + length]
+
+    def unpack(self, fmt, offset):
+        fmt = self.byte_order + fmt
+        return struct.unpack(fmt, self.slice(offset, struct.calcsize(fmt)))
+
+    def read_ifd(self, offset):
+        """Return a dict of tag -> Entry for the IFD at offset, and the next IFD's offset"""
+        count, = self.unpack('H', offset)
+        entries = {}
+        for i in range(count):
+            entry_offset = offset + 2 + 12 * i
+            tag, field_type, value_count = self.unpack('HHL', entry_offset)
+            entry = Entry(self, tag, field_type, value_count, entry_offset + 8)
+            if entry.size > 4:
+                entry.value_offset, = self.unpack('L', entry_offset + 8)
+            entries[tag] = entry
+        next_offset, = self.unpack('L', offset + 2 + 12 * count)
+        return entries, next_offset
+
+    def walk(self, offset=None, max_ifds=64):
+        """
+        Yield every IFD reachable from offset (the first IFD by default)
+
+        Follows next IFD pointers as well as SubIFD, EXIF and GPS pointers,
+        skipping any IFD that was already visited or can't be read.
+        """
+        pending = [self.first_ifd if offset is None else offset]
+        visited = set()
+        while pending and len(visited) < max_ifds:
+            offset = pending.pop(0)
+            if not offset or offset in visited:
+                continue
+            visited.add(offset)
+            try:
+                entries, next_offset = self.read_ifd(offset)
+            except (TiffError, struct.error):
+                continue
+            yield entries
+            for tag in (TAG_SUB_IFDS, TAG_EXIF_IFD, TAG_GPS_IFD):
+                if tag in entries:
+                    try:
+                        pending.extend(entries[tag].values())
+                    except (TiffError, struct.error):
+                        pass
+            pending.append(next_offset)
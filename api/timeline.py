@@ -0,0 +1,222 @@
+"""
+Personal home timelines
+
+A viewer's timeline is the events of the accounts they follow, newest
+first. Filtering events by an IN list of every followed account means
+sorting all of their events on every page, so instead each author's
+newest events are kept as a short list, newest first, and the timeline is
+a k-way merge of those lists through a heap:
+- the lists of authors missing from the cache are read in one query;
+- the heap and the keys merged so far are kept per viewer, so a page
+  finds its cursor in the merged keys with a binary search and only pops
+  the events it returns, O(limit · log k) for k authors;
+- an author's list is extended from the database when the merge drains
+  it, by max(head_size, limit) events along ix_event_account_id.
+
+The heap is built once per viewer every author_ttl seconds, from the
+followed authors left after removing those the viewer blocks or is blocked
+by and those with an active ban. A page whose cursor is newer than where a
+viewer's heap starts, or that comes after the heap expired, builds a new
+one starting at its cursor, reading the authors whose cached lists don't
+reach that far in one query. New events, follows, blocks and bans can take
+author_ttl seconds to show up.
+
+Options, set with the "timeline" object in config.json:
+- head_size:         newest events cached per author
+- author_ttl:        seconds an author's cached events and a viewer's heap are used for
+- capacity:          authors cached per process
+- viewer_capacity:   viewers whose heaps are kept per process
+"""
+
+import heapq
+import threading
+import time
+from sqlalchemy import and_, func, or_, tuple_
+from sqlalchemy.sql.functions import now
+from model import AccountBan, AccountBlock, AccountFollow, Ban, Event
+from utils import LRUCache, load_config
+
+TIMELINE_DEFAULTS = {
+    'head_size': 50,
+    'author_ttl': 10,
+    'capacity': 10000,
+    'viewer_capacity': 1000,
+}
+
+def followed_authors(session, viewer_id):
+    """Return the ids of the accounts a viewer follows, without blocked or banned ones"""
+    blocked = session.query(AccountBlock.c.blocker_id) \
+                     .filter(or_(and_(AccountBlock.c.blocker_id == viewer_id,
+                                      AccountBlock.c.blocked_id == AccountFollow.c.following_id),
+                                 and_(AccountBlock.c.blocker_id == AccountFollow.c.following_id,
+                                      AccountBlock.c.blocked_id == viewer_id)))
+    banned = session.query(AccountBan.c.account_id) \
+                    .join(Ban, Ban.ban_id == AccountBan.c.ban_id) \
+                    .filter(AccountBan.c.account_id == AccountFollow.c.following_id) \
+                    .filter(or_(Ban.expires_at.is_(None), Ban.expires_at > now()))
+    return [account_id for (account_id,) in
+            session.query(AccountFollow.c.following_id)
+                   .filter(AccountFollow.c.follower_id == viewer_id)
+                   .filter(~blocked.exists())
+                   .filter(~banned.exists())]
+
+def load_events(session, befores, count):
+    """
+    Read up to count event keys (created_at, event_id) of several authors in one query,
+    newest first, each before its own key if it has one
+    """
+    newest = [account_id for account_id, before in befores.items() if before is None]
+    conditions = [Event.account_id.in_(newest)] if newest else []
+    conditions += [and_(Event.account_id == account_id,
+                        tuple_(Event.created_at, Event.event_id) < tuple_(*before))
+                   for account_id, before in befores.items() if before is not None]
+    rank = func.row_number().over(partition_by=Event.account_id,
+                                  order_by=(Event.created_at.desc(), Event.event_id.desc()))
+    ranked = session.query(Event.account_id, Event.created_at, Event.event_id,
+                           rank.label('rank')) \
+                    .filter(or_(*conditions)) \
+                    .subquery()
+    events = {account_id: [] for account_id in befores}
+    for account_id, created_at, event_id in \
+            session.query(ranked.c.account_id, ranked.c.created_at, ranked.c.event_id) \
+                   .filter(ranked.c.rank <= count) \
+                   .order_by(ranked.c.account_id, ranked.c.rank):
+        events[account_id].append((created_at, event_id))
+    return events
+
+def seek(keys, before):
+    """Binary search a newest-first list of keys for the first one older than before"""
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) // 2
+        if keys[middle] < before:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+class AuthorEvents:
+    """The keys of each author's newest events, and whether those are all of them"""
+    def __init__(self, head_size=50, author_ttl=10, capacity=10000):
+        self.head_size = head_size
+        self.author_ttl = author_ttl
+        self.heads = LRUCache(capacity)
+
+    def get(self, session, account_ids, now_time=None):
+        """Return the cached newest events of several authors, loading the missing ones"""
+        now_time = now_time or time.time()
+        heads = {}
+        missing = []
+        for account_id in account_ids:
+            entry = self.heads.get(account_id)
+            if entry is not None and entry['expires_at'] > now_time:
+                heads[account_id] = entry['events'], entry['complete']
+            else:
+                missing.append(account_id)
+        if missing:
+            loaded = load_events(session, dict.fromkeys(missing), self.head_size)
+            for account_id, events in loaded.items():
+                complete = len(events) < self.head_size
+                self.heads.put(account_id, {'events': events, 'complete': complete,
+                                            'expires_at': now_time + self.author_ttl})
+                heads[account_id] = events, complete
+        return heads
+
+class HeapEntry:
+    """The next event of an author in a viewer's merge, ordered newest first"""
+    __slots__ = ('key', 'account_id', 'position')
+
+    def __init__(self, key, account_id, position):
+        self.key = key
+        self.account_id = account_id
+        self.position = position
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+class ViewerTimeline:
+    """A viewer's merge in progress: the keys merged so far and the heap of what's next"""
+    def __init__(self, lists, complete, since, expires_at):
+        self.lists = lists
+        self.complete = complete
+        self.since = since
+        self.expires_at = expires_at
+        self.keys = []
+        self.lock = threading.Lock()
+        self.heap = []
+        for account_id, events in lists.items():
+            position = 0 if since is None else seek(events, since)
+            if position < len(events):
+                self.heap.append(HeapEntry(events[position], account_id, position))
+        heapq.heapify(self.heap)
+
+    def covers(self, before, now_time):
+        """Check whether a page starting at before can be read from this merge"""
+        return self.expires_at > now_time and \
+               (self.since is None or (before is not None and before <= self.since))
+
+    def advance(self, session, count, extend_size):
+        """Merge until count keys are merged or every author is drained"""
+        while len(self.keys) < count and self.heap:
+            entry = heapq.heappop(self.heap)
+            self.keys.append(entry.key)
+            account_id = entry.account_id
+            events = self.lists[account_id]
+            position = entry.position + 1
+            if position == len(events) and not self.complete[account_id]:
+                events = load_events(session, {account_id: events[-1]},
+                                     extend_size)[account_id]
+                self.lists[account_id] = events
+                self.complete[account_id] = len(events) < extend_size
+                position = 0
+            if position < len(events):
+                heapq.heappush(self.heap, HeapEntry(events[position], account_id, position))
+
+    def page(self, session, before, limit, extend_size):
+        """Return the next limit keys before a key, merging as many more as that takes"""
+        with self.lock:
+            while True:
+                start = 0 if before is None else seek(self.keys, before)
+                if len(self.keys) >= start + limit or not self.heap:
+                    return self.keys[start:start + limit]
+                self.advance(session, start + limit, extend_size)
+
+class Timelines:
+    """Viewers' merges, built from the cached events of the authors they follow"""
+    def __init__(self, head_size=50, author_ttl=10, capacity=10000, viewer_capacity=1000):
+        self.author_events = AuthorEvents(head_size, author_ttl, capacity)
+        self.viewers = LRUCache(viewer_capacity)
+
+    def build(self, session, viewer_id, since, now_time):
+        """Start a viewer's merge at a key, or at their newest event"""
+        account_ids = followed_authors(session, viewer_id)
+        heads = self.author_events.get(session, account_ids, now_time)
+        lists = {account_id: events for account_id, (events, _) in heads.items()}
+        complete = {account_id: done for account_id, (_, done) in heads.items()}
+        if since is not None:
+            behind = {account_id: since for account_id, events in lists.items()
+                      if not complete[account_id] and seek(events, since) == len(events)}
+            if behind:
+                head_size = self.author_events.head_size
+                for account_id, events in load_events(session, behind, head_size).items():
+                    lists[account_id] = events
+                    complete[account_id] = len(events) < head_size
+        return ViewerTimeline(lists, complete, since,
+                              now_time + self.author_events.author_ttl)
+
+    def read(self, session, viewer_id, before=None, limit=10, now_time=None):
+        """Return the keys of a viewer's next limit timeline events before a key"""
+        # pylint: disable=too-many-arguments
+        now_time = now_time or time.time()
+        before = tuple(before) if before is not None else None
+        timeline = self.viewers.get(viewer_id)
+        if timeline is None or not timeline.covers(before, now_time):
+            timeline = self.build(session, viewer_id, before, now_time)
+            self.viewers.put(viewer_id, timeline)
+        return timeline.page(session, before, limit, max(self.author_events.head_size, limit))
+
+timelines = Timelines(**{**TIMELINE_DEFAULTS, **load_config().get('timeline', {})})
+
+def read_timeline(session, viewer_id, before=None, limit=10):
+    """Return the keys of a viewer's next limit timeline events before a key"""
+    return timelines.read(session, viewer_id, before, limit)
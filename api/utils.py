@@ -1,24 +1,112 @@
 import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 import json5 as json
 
+CONFIG_PATH = os.environ.get('FOCAL_CONFIG_PATH', '/config.json')
+CONFIG_RELOAD_INTERVAL = 10 # seconds between checks for changes to the config file
+
+class FrozenDict(dict):
+    """Read-only dict, so a shared config snapshot can't be changed by its callers"""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Config is read-only')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        return id(self)
+
+def freeze(value):
+    """Recursively convert parsed JSON into read-only dicts and tuples"""
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+class ConfigSnapshot:
+    """A parsed config file and the structures derived from it"""
+    def __init__(self, data, file_id):
+        self.data = freeze(data)
+        self.file_id = file_id
+        self.reload_interval = self.data.get('config_reload_interval', CONFIG_RELOAD_INTERVAL)
+        self.supported_extensions = FrozenDict(
+            (category, frozenset(extensions))
+            for category, extensions in self.data.get('supported_file_extensions', {}).items()
+        )
+
+_config_lock = threading.Lock()
+_config = None
+_config_checked_at = 0
+
+def _stat_config():
+    stat = os.stat(CONFIG_PATH)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def get_config():
+    """
+    Return the current config snapshot
+
+    The file is only stat()'d once every reload interval and is only parsed
+    again when its inode, modification time or size has changed.
+    """
+    global _config, _config_checked_at # pylint: disable=global-statement
+    snapshot = _config
+    now = time.monotonic()
+    if snapshot is not None and now - _config_checked_at < snapshot.reload_interval:
+        return snapshot
+    with _config_lock:
+        if _config is not None and now - _config_checked_at < _config.reload_interval:
+            return _config
+        try:
+            file_id = _stat_config()
+            if _config is None or _config.file_id != file_id:
+                with open(CONFIG_PATH, 'r') as f:
+                    _config = ConfigSnapshot(json.load(f), file_id)
+        except Exception as err:
+            if _config is None:
+                raise
+            # keep serving the last good config until the file is fixed
+            print('Could not reload config:\n', err)
+        _config_checked_at = now
+        return _config
+
 def load_config(prop=None):
-    config = None
-    # TODO: only reload this file every X seconds, instead of on every use
-    with open('/config.json', 'r') as f:
-        config = json.load(f)
-    if config is not None and prop is not None:
+    config = get_config().data
+    if prop is not None:
         return config[prop]
     return config
 
+def supported_extensions(category):
+    """Return the frozenset of supported file extensions for a file category"""
+    return get_config().supported_extensions[category]
+
+def worker_processes():
+    """Return the number of uWSGI worker processes, or 1 outside uWSGI"""
+    try:
+        import uwsgi # pylint: disable=import-outside-toplevel
+        return uwsgi.numproc
+    except ImportError:
+        return 1
+
+def create_digest():
+    """Create a hash object using the file_digest_algorithm set in config.json"""
+    config = load_config()
+    algorithm = config.get('file_digest_algorithm', 'md5')
+    if algorithm in ('blake2b', 'blake2s'):
+        return hashlib.new(algorithm, digest_size=config.get('file_digest_size', 16))
+    return hashlib.new(algorithm)
+
 def hash_file(file):
     BUFFER_SIZE = 65536 # 64kb chunks
-    md5 = hashlib.md5()
+    digest = create_digest()
     while True:
         data = file.read(BUFFER_SIZE)
         if not data:
             break
-        md5.update(data)
-    return md5
+        digest.update(data)
+    return digest
 
 def read_extension(file_name):
     return file_name.rsplit('.', 1)[1].lower()
@@ -26,3 +114,42 @@ def read_extension(file_name):
 def del_prop(object, property):
     if property in object:
         del object[property]
+
+def remove_file(file_path):
+    """Remove a file if it exists"""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+class LRUCache:
+    """Thread-safe mapping that drops its least recently used entries past capacity"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.counters['misses'] += 1
+                return default
+            self.counters['hits'] += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def __len__(self):
+        return len(self.entries)